@@ -0,0 +1,266 @@
+import os
+import stat
+import tarfile
+import logging
+import pwd
+import grp
+
+from integrity import new_hasher
+from sparse_io import BUFFER_SIZE, data_regions, has_holes, hash_zeros, is_sparse
+
+# Kopierpuffer des Tar-Streams (tarfile liest sonst in 16-KiB-Schritten)
+TAR_COPY_BUFFER = 1024 * 1024
+# Sparse-Einträge im Kopfblock eines GNU-Sparse-Headers und in jedem Erweiterungsblock
+_SPARSE_IN_HEADER = 4
+_SPARSE_IN_EXTENSION = 21
+
+
+def scan_tree(source_dir, rules=None, excluded=None):
+    # Einmaliger Durchlauf mit os.scandir: jeder Eintrag wird genau einmal per lstat abgefragt.
+    # Verzeichnisse werden vor ihrem Inhalt geliefert, Einträge sortiert nach Name.
+    # Von rules (FilterRules) ausgeschlossene Einträge werden übersprungen, ausgeschlossene
+    # Verzeichnisse gar nicht erst gelesen; ihre relativen Pfade landen in excluded.
+    if rules is not None and not rules.active:
+        rules = None
+    stack = [('', source_dir)]
+    while stack:
+        rel_dir, abs_dir = stack.pop()
+        try:
+            with os.scandir(abs_dir) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except PermissionError:
+            logging.warning(f'Zugriff verweigert: {abs_dir}')
+            continue
+        except FileNotFoundError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            except PermissionError:
+                logging.warning(f'Zugriff verweigert: {entry.path}')
+                continue
+            if rules is not None and rules.excluded(rel_path, st, entry.path):
+                if excluded is not None:
+                    excluded.append(rel_path)
+                continue
+            yield entry.path, rel_path, st
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append((rel_path, entry.path))
+
+        # Umgekehrt auf den Stack legen, damit die Unterverzeichnisse in sortierter Reihenfolge folgen
+        stack.extend(reversed(subdirs))
+
+
+class _FixedSizeReader:
+    # Liefert exakt `size` Bytes, auch wenn sich die Datei seit dem stat verändert hat.
+    # Ein kürzerer Lesevorgang würde sonst den Tar-Stream unbrauchbar machen.
+    def __init__(self, fileobj, size, path, hasher=None):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.path = path
+        self.truncated = False
+        # Prüfsumme über die tatsächlich ins Archiv geschriebenen Bytes
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            if not self.truncated:
+                logging.warning(f'Datei {self.path} wurde während des Backups verkürzt, fehlende Bytes werden aufgefüllt.')
+                self.truncated = True
+            data += b'\0' * (size - len(data))
+        self.remaining -= len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+
+class _SparseReader:
+    # Liefert die Datenbereiche einer Sparse-Datei lückenlos hintereinander, wie sie im Archiv
+    # stehen. Die Löcher werden nicht gelesen, gehen aber als Nullen in die Prüfsumme ein, damit sie
+    # der Prüfsumme der vollständigen Datei entspricht.
+    def __init__(self, fileobj, regions, size, path, hasher):
+        self.fileobj = fileobj
+        self.regions = iter(regions)
+        self.size = size
+        self.path = path
+        self.hasher = hasher
+        self.position = 0
+        self.current = None
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if self.current is None:
+                region = next(self.regions, None)
+                if region is None:
+                    hash_zeros(self.hasher, self.size - self.position)
+                    self.position = self.size
+                    break
+                offset, length = region
+                hash_zeros(self.hasher, offset - self.position)
+                self.fileobj.seek(offset)
+                self.current = _FixedSizeReader(self.fileobj, length, self.path, self.hasher)
+                self.position = offset + length
+            data = self.current.read(size)
+            if not data:
+                self.current = None
+                continue
+            parts.append(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def finish(self):
+        # Ein Loch am Dateiende wird nie gelesen; es geht hier in die Prüfsumme ein
+        hash_zeros(self.hasher, self.size - self.position)
+        self.position = self.size
+
+
+class StreamingTarWriter:
+    # wrap_reader kann die gelesenen Quelldateien umhüllen, z. B. um die Leserate zu begrenzen
+    def __init__(self, tar, wrap_reader=None):
+        self.tar = tar
+        self.tar.copybufsize = TAR_COPY_BUFFER
+        self.wrap_reader = wrap_reader
+        # Prüfsumme (hex) des Inhalts der zuletzt hinzugefügten Datei, None bei anderen Einträgen
+        self.last_checksum = None
+        self._inodes = {}
+        self._unames = {}
+        self._gnames = {}
+
+    def _uname(self, uid):
+        if uid not in self._unames:
+            try:
+                self._unames[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._unames[uid] = ''
+        return self._unames[uid]
+
+    def _gname(self, gid):
+        if gid not in self._gnames:
+            try:
+                self._gnames[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._gnames[gid] = ''
+        return self._gnames[gid]
+
+    def tarinfo_from_stat(self, path, arcname, st):
+        # Entspricht TarFile.gettarinfo, verwendet aber das bereits vorhandene stat-Ergebnis
+        tarinfo = self.tar.tarinfo(arcname)
+        mode = st.st_mode
+        tarinfo.size = 0
+        if stat.S_ISREG(mode):
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and inode in self._inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self._inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = st.st_size
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        elif stat.S_ISFIFO(mode):
+            tarinfo.type = tarfile.FIFOTYPE
+        else:
+            # Sockets und Gerätedateien werden nicht gesichert
+            return None
+
+        tarinfo.mode = stat.S_IMODE(mode)
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.mtime = st.st_mtime
+        tarinfo.uname = self._uname(st.st_uid)
+        tarinfo.gname = self._gname(st.st_gid)
+        return tarinfo
+
+    def linked_inodes(self):
+        # Bereits geschriebene Dateien mit mehreren Hardlinks, für Checkpoints
+        return [[ino, dev, arcname] for (ino, dev), arcname in self._inodes.items()]
+
+    def restore_linked_inodes(self, items):
+        self._inodes.update({(ino, dev): arcname for ino, dev, arcname in items})
+
+    def add(self, path, arcname, st):
+        # Gibt die Anzahl der geschriebenen Nutzdaten-Bytes zurück
+        self.last_checksum = None
+        tarinfo = self.tarinfo_from_stat(path, arcname, st)
+        if tarinfo is None:
+            return 0
+        if tarinfo.isreg():
+            hasher = new_hasher()
+            with open(path, 'rb') as f:
+                source = self.wrap_reader(f) if self.wrap_reader else f
+                regions = data_regions(f.fileno(), tarinfo.size) if is_sparse(st) else None
+                if regions is not None and has_holes(regions, tarinfo.size):
+                    self._add_sparse(tarinfo, _SparseReader(source, regions, tarinfo.size, path, hasher), regions)
+                else:
+                    self.tar.addfile(tarinfo, _FixedSizeReader(source, tarinfo.size, path, hasher))
+            self.last_checksum = hasher.hexdigest()
+            if st.st_nlink > 1:
+                self._inodes[(st.st_ino, st.st_dev)] = arcname
+            return tarinfo.size
+        self.tar.addfile(tarinfo)
+        return 0
+
+    def _add_sparse(self, tarinfo, reader, regions):
+        # Schreibt eine Sparse-Datei im GNU-Format (Typ 'S'): nur die Datenbereiche stehen im Archiv,
+        # die Liste der Bereiche im Header. tarfile kann das lesen, aber nicht schreiben. Das PAX-Format
+        # 1.0 scheidet aus, weil tarfile es bei mehr als 8 GiB Daten falsch liest; der GNU-Header
+        # speichert große Zahlen binär. Lange oder nicht-ASCII-Namen stehen wie sonst im PAX-Header davor.
+        tar = self.tar
+        size = tarinfo.size
+        if not regions or regions[-1][0] + regions[-1][1] < size:
+            # Abschließender leerer Bereich legt die Dateigröße fest (wie bei GNU tar)
+            regions = regions + [(size, 0)]
+        stored = sum(length for _, length in regions)
+        tarinfo.size = 0
+        buf = bytearray(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+        header = buf[-tarfile.BLOCKSIZE:]
+        header[156:157] = tarfile.GNUTYPE_SPARSE
+        header[257:265] = tarfile.GNU_MAGIC
+        header[124:136] = tarfile.itn(stored, 12, tarfile.GNU_FORMAT)
+        # Im GNU-Format liegen hier atime, ctime und die Sparse-Felder statt des ustar-Präfixes
+        header[345:500] = bytes(155)
+        extensions = [regions[i:i + _SPARSE_IN_EXTENSION]
+                      for i in range(_SPARSE_IN_HEADER, len(regions), _SPARSE_IN_EXTENSION)]
+        _pack_sparse(header, 386, regions[:_SPARSE_IN_HEADER])
+        header[482] = 1 if extensions else 0
+        header[483:495] = tarfile.itn(size, 12, tarfile.GNU_FORMAT)
+        header[148:156] = b'%06o\0 ' % tarfile.calc_chksums(bytes(header))[0]
+        buf[-tarfile.BLOCKSIZE:] = header
+        for i, extension in enumerate(extensions):
+            block = bytearray(tarfile.BLOCKSIZE)
+            _pack_sparse(block, 0, extension)
+            block[504] = 1 if i + 1 < len(extensions) else 0
+            buf += block
+
+        tar.fileobj.write(buf)
+        tar.offset += len(buf)
+        tarfile.copyfileobj(reader, tar.fileobj, stored, bufsize=BUFFER_SIZE)
+        reader.finish()
+        blocks, remainder = divmod(stored, tarfile.BLOCKSIZE)
+        if remainder:
+            tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        tar.offset += blocks * tarfile.BLOCKSIZE
+        tarinfo.size = size
+        tar.members.append(tarinfo)
+
+
+def _pack_sparse(block, position, regions):
+    for offset, length in regions:
+        block[position:position + 12] = tarfile.itn(offset, 12, tarfile.GNU_FORMAT)
+        block[position + 12:position + 24] = tarfile.itn(length, 12, tarfile.GNU_FORMAT)
+        position += 24
@@ -1,146 +1,1183 @@
 import os
+import re
+import time
+import errno
+import bisect
+import functools
 import logging
-import subprocess
 import tarfile
 import socket
+import shutil
+import stat
+import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from progress import open_progress
+from archive_writer import StreamingTarWriter, scan_tree
+from compression import archive_extension, is_archive, open_reader, open_reader_at, open_writer
+from manifest import MANIFEST_NAME, ArchiveManifest
+from catalog import CATALOG_NAME, BackupCatalog
+from restore_pipeline import ParallelRestorer, apply_metadata, resolves_inside, restore_tar_stream, safe_join
+from chunk_store import INDEX_EXTENSION, ChunkStore, is_chunk_index, read_index, write_index
+from stat_cache import StatCache
+from snapshot import SNAPSHOT_PREFIX, SnapshotError, create_snapshot_provider
+from throttle import ResourceGovernor, lowered_priority
+from inventory import DELTA_SUFFIX, BackupInventory, merge_verifications, parse_backup_date
+from lease import LEASE_TTL, Lease, LeaseError, LeaseLost
+from retention import RetentionPolicy, delete_backups, remove_stale_deletions
+from integrity import VerifyResult, file_checksum, verify_archive, verify_chunks, verify_directory
+from metrics import RunMetrics
+from jobs import JobCancelled
+from filters import FilterRules, rsync_exclude_pattern
+from sparse_io import LARGE_FILE_SIZE, copy_file, is_sparse
+from checkpoint import (CHECKPOINT_BYTES, ArchiveCheckpoint, RunCheckpoint, cleanup_incomplete, partial_path,
+                        publish)
+
+# Fehler, die bei NFS-Aussetzern auftreten und einen erneuten Versuch rechtfertigen
+TRANSIENT_ERRNOS = {errno.ESTALE, errno.EIO, errno.ENOTCONN, errno.ETIMEDOUT, errno.EHOSTUNREACH}
+NFS_RETRIES = 3
+NFS_RETRY_DELAY = 10
+
+# Sperrdateien: pro Host für Backup und Rotation, im Wurzelverzeichnis für die Garbage Collection
+HOST_LEASE_NAME = '.host.lease'
+GC_LEASE_NAME = '.gc.lease'
+# Host-Angabe für Operationen über alle Hosts des Repositorys
+ALL_HOSTS = '*'
+
+def _governed(method):
+    # Führt Backup und Restore mit der konfigurierten CPU- und I/O-Priorität aus
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with lowered_priority(self.nice_level, self.io_class, self.io_level):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _measured(phase):
+    # Erfasst Dauer und Fehler der Methode als Phase in den Laufmetriken
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
-from tqdm import tqdm
 
 class BackupManager:
-    def __init__(self, nfs_mount_point, retention_days, notifier, compress_backups):
+    def __init__(self, nfs_mount_point, retention_days, notifier, compress_backups,
+                 backup_workers=1, max_io_jobs=0, compression_level=None, compression_threads=0,
+                 incremental_snapshots=False, incremental_archives=False, full_backup_interval=6,
+                 dedup_backups=False, restore_workers=4, skip_unchanged=False, snapshot_provider='',
+                 snapshot_size='', read_limit_mb=0, write_limit_mb=0, adaptive_throttle=False, nice_level=0,
+                 io_class='', io_level=4, maintenance_workers=4, lease_timeout=LEASE_TTL, keep_daily=0,
+                 keep_weekly=0, keep_monthly=0, keep_yearly=0, scrub_budget_gb=0, scrub_sample_percent=100,
+                 metrics_textfile='', metrics_json_dir='', filters=None, user_filters=None):
         self.nfs_mount_point = nfs_mount_point
         self.retention_days = retention_days
+        # Zusätzlich zu retention_days: neueste Backups der letzten N Tage, Wochen, Monate und Jahre
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+        self.keep_yearly = keep_yearly
         self.notifier = notifier
+        # Codec für komprimierte Backups ('gzip', 'zstd', 'lz4'), leer für unkomprimierte rsync-Backups
         self.compress_backups = compress_backups
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        # Unkomprimierte Backups als Hardlink-Snapshots gegen den letzten Snapshot anlegen
+        self.incremental_snapshots = incremental_snapshots
+        # Komprimierte Backups als Kette aus Vollbackup und Deltas; nach full_backup_interval Deltas folgt ein neues Vollbackup
+        self.incremental_archives = incremental_archives
+        self.full_backup_interval = full_backup_interval
+        # Dedupliziertes Chunk-Repository auf dem NFS-Share, hat Vorrang vor Archiven und rsync
+        self.dedup_backups = dedup_backups
+        self.restore_workers = restore_workers
+        # Benutzer, deren Home seit dem letzten Backup unverändert ist, nicht erneut sichern
+        self.skip_unchanged = skip_unchanged
+        # Snapshot vor dem Backup: '', 'auto', 'btrfs', 'lvm', 'zfs' oder 'directory'
+        self.snapshot_provider = snapshot_provider
+        self.snapshot_size = snapshot_size
+        # Bandbreitenlimits (MB/s, 0 = unbegrenzt) für Backup und Restore, gemeinsam für alle Worker
+        self.governor = ResourceGovernor(read_limit_mb * 1024 * 1024, write_limit_mb * 1024 * 1024, adaptive_throttle)
+        # CPU- und I/O-Priorität während Backup und Restore (nice 0-19, io_class '', 'best-effort' oder 'idle')
+        self.nice_level = nice_level
+        self.io_class = io_class
+        self.io_level = io_level
+        # Anzahl paralleler Benutzer-Backups und gleichzeitiger Schreibjobs auf das NFS (0 = wie backup_workers)
+        self.backup_workers = max(1, backup_workers)
+        self.max_io_jobs = max_io_jobs
+        # Worker für Operationen über alle Hosts und Gültigkeit der Sperren (Sekunden)
+        self.maintenance_workers = max(1, maintenance_workers)
+        self.lease_timeout = lease_timeout
+        # Rollierende Prüfung: gelesene Datenmenge pro Lauf (GB, 0 = aus) und Stichprobe bei Snapshots und Chunks (%)
+        self.scrub_budget_gb = scrub_budget_gb
+        self.scrub_sample_percent = scrub_sample_percent
+        # Metriken des laufenden Durchgangs; write_metrics exportiert sie für den node-exporter und als JSON
+        self.metrics = RunMetrics()
+        self.metrics_textfile = metrics_textfile
+        self.metrics_json_dir = metrics_json_dir
+        # Ein- und Ausschlussregeln des Hosts und je Benutzer (siehe ConfigManager.filters)
+        self.filters = filters or {}
+        self.user_filters = user_filters or {}
+        self.home_dir = '/home'
+        # Nur für lokale Testziele (z. B. Benchmarks) abschalten
+        self.require_mount = True
+        # Fortschrittsbalken auf dem Terminal; im Service-Modus abgeschaltet, dann wird tqdm nicht geladen
+        self.show_progress = True
+        self._progress_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, notifier):
+        return cls(
+            config.nfs_mount_point,
+            config.retention_days,
+            notifier,
+            config.compress_backups,
+            backup_workers=config.backup_workers,
+            max_io_jobs=config.max_io_jobs,
+            compression_level=config.compression_level,
+            compression_threads=config.compression_threads,
+            incremental_snapshots=config.incremental_snapshots,
+            incremental_archives=config.incremental_archives,
+            full_backup_interval=config.full_backup_interval,
+            dedup_backups=config.dedup_backups,
+            restore_workers=config.restore_workers,
+            skip_unchanged=config.skip_unchanged,
+            snapshot_provider=config.snapshot_provider,
+            snapshot_size=config.snapshot_size,
+            read_limit_mb=config.read_bandwidth_limit,
+            write_limit_mb=config.write_bandwidth_limit,
+            adaptive_throttle=config.adaptive_throttle,
+            nice_level=config.nice_level,
+            io_class=config.io_class,
+            io_level=config.io_level,
+            maintenance_workers=config.maintenance_workers,
+            lease_timeout=config.lease_timeout,
+            keep_daily=config.keep_daily,
+            keep_weekly=config.keep_weekly,
+            keep_monthly=config.keep_monthly,
+            keep_yearly=config.keep_yearly,
+            scrub_budget_gb=config.scrub_budget_gb,
+            scrub_sample_percent=config.scrub_sample_percent,
+            metrics_textfile=config.metrics_textfile,
+            metrics_json_dir=config.metrics_json_dir,
+            filters=config.filters,
+            user_filters=config.user_filters
+        )
+
+    @property
+    def retention_policy(self):
+        return RetentionPolicy(self.retention_days, self.keep_daily, self.keep_weekly, self.keep_monthly, self.keep_yearly)
+
+    def filter_rules(self, user):
+        # Regeln des Hosts ergänzt um die des Benutzers, einmal pro Backup kompiliert
+        return FilterRules.from_config(self.filters, self.user_filters.get(user))
+
+    def _source_reader(self, fileobj):
+        # Gelesene Quelldaten: Zeit und Bytes messen, dann drosseln (Wartezeit zählt nicht als Lesezeit)
+        return self.governor.reader(self.metrics.reader(fileobj))
+
+    def _target_writer(self, fileobj):
+        return self.governor.writer(self.metrics.writer(fileobj))
+
+    def write_metrics(self):
+        # Exportiert die Metriken des Laufs; Fehler beim Export lassen den Lauf nicht scheitern
+        if self.metrics_textfile and not os.path.isdir(os.path.dirname(os.path.abspath(self.metrics_textfile))):
+            # Kein node-exporter installiert
+            logging.info(f'Verzeichnis für {self.metrics_textfile} fehlt, Metriken werden nur als Bericht geschrieben.')
+        elif self.metrics_textfile:
+            try:
+                self.metrics.write_prometheus(self.metrics_textfile)
+            except OSError as e:
+                logging.warning(f'Metriken konnten nicht nach {self.metrics_textfile} geschrieben werden: {e}')
+        if self.metrics_json_dir:
+            try:
+                self.metrics.write_json(self.metrics_json_dir)
+            except OSError as e:
+                logging.warning(f'Laufbericht konnte nicht in {self.metrics_json_dir} geschrieben werden: {e}')
+
+    @property
+    def chunk_store(self):
+        # Gemeinsam für alle Hosts und Benutzer, damit identische Daten nur einmal gespeichert werden
+        return ChunkStore(os.path.join(self.nfs_mount_point, '.chunks'))
 
-    def backup_homes(self):
+    @_governed
+    def backup_homes(self, dirty=None, cancel=None):
+        # dirty: Benutzer -> Verzeichnisse mit gemeldeten Änderungen (relativ zum Home, None = ganzes Home
+        # neu lesen); dann werden nur diese Benutzer gesichert (Daemon-Modus, siehe dirty_tracker).
+        # cancel (threading.Event) bricht den Lauf vor der nächsten Datei ab; der nächste Lauf setzt fort.
         date_str = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         hostname = socket.gethostname()
 
+        # Überprüfen, ob NFS gemountet ist
+        if self.require_mount and not os.path.ismount(self.nfs_mount_point):
+            logging.error(f'NFS-Share {self.nfs_mount_point} ist nicht gemountet.')
+            self.notifier.send_notification(f'🔴 Backup fehlgeschlagen: NFS-Share {self.nfs_mount_point} ist nicht gemountet.')
+            return False
+
         # Pfad zum Host-Verzeichnis
         host_dir = os.path.join(self.nfs_mount_point, hostname)
 
         # Sicherstellen, dass das Host-Verzeichnis existiert
         os.makedirs(host_dir, exist_ok=True)
 
-        # Benutzerverzeichnisse ermitteln
-        home_dir = '/home'
-        user_dirs = [d for d in os.listdir(home_dir) if os.path.isdir(os.path.join(home_dir, d))]
+        # Eine gerade laufende Wartung dieses Hosts (z. B. Rotation von einem Admin-Knoten) abwarten
+        try:
+            lease = self._host_lease(hostname).acquire(wait=self.lease_timeout)
+        except LeaseError as e:
+            logging.error(f'Backup nicht möglich: {e}')
+            self.notifier.send_notification(f'🔴 Backup fehlgeschlagen: {e}')
+            return False
+        try:
+            return self._backup_host(host_dir, date_str, dirty, cancel, lease)
+        except LeaseLost as e:
+            # Ein anderer Host wartet diesen Host inzwischen; der nächste Lauf setzt das Backup fort
+            logging.error(f'Backup abgebrochen: {e}')
+            self.notifier.send_notification(f'🔴 Backup abgebrochen: {e}')
+            return False
+        finally:
+            lease.release()
+
+    def _backup_host(self, host_dir, date_str, dirty=None, cancel=None, lease=None):
+        # Ein abgebrochener Lauf wird mit seinem Zeitstempel fortgesetzt; fertige Benutzer werden übersprungen.
+        # Geht die Sperre verloren, endet der Lauf wie nach einem Abbruch vor der nächsten Datei (LeaseLost).
+        if lease is not None:
+            lease.check()
+            cancel = _LeaseGuard(lease, cancel)
+        run = RunCheckpoint(host_dir)
+        if run.resume_or_start(date_str):
+            logging.info(f'Setze abgebrochenen Backup-Lauf vom {run.date_str} fort, '
+                         f'{len(run.completed)} Benutzer bereits gesichert.')
+            self.cleanup_incomplete_backups(host_dir, f'backup_{run.date_str}')
+        else:
+            self.cleanup_incomplete_backups(host_dir)
 
-        for user in user_dirs:
-            user_home = os.path.join(home_dir, user)
+        # Aus einem schreibgeschützten Snapshot sichern, damit Dateien nicht während des Lesens verändert werden
+        snapshot = self._create_snapshot()
+        try:
+            source_root = snapshot.path if snapshot else self.home_dir
+            results = self._backup_users(source_root, host_dir, run, dirty, cancel)
+        finally:
+            if snapshot:
+                try:
+                    snapshot.release()
+                except SnapshotError as e:
+                    logging.error(f'Snapshot {snapshot.path} konnte nicht freigegeben werden: {e}')
+                    self.notifier.send_notification(f'🔴 Snapshot {snapshot.path} konnte nicht freigegeben werden: {e}')
+
+        if lease is not None:
+            lease.check()
+        if cancel is not None and cancel.is_set():
+            # Wie nach einem Absturz: der nächste Lauf setzt mit demselben Zeitstempel fort
+            logging.info('Backup abgebrochen.')
+            self.notifier.send_notification('🟡 Backup abgebrochen, der nächste Lauf setzt es fort.')
+            return False
+        # Nur ein unterbrochener Lauf wird fortgesetzt; fehlgeschlagene Benutzer sichert der nächste Lauf neu
+        run.finish()
+        failed = {user: error for user, (ok, error) in results.items() if not ok}
+        # Die häufigen Läufe des Daemons melden sich nur bei Fehlern
+        if results and (dirty is None or failed):
+            self._notify_backup_summary(results, failed)
+        return not failed
+
+    def cleanup_incomplete_backups(self, host_dir, keep_prefix=None):
+        # Entfernt unfertige Backups abgebrochener Läufe samt ihrer Katalogeinträge.
+        # Unfertige Backups, deren Name mit keep_prefix beginnt, werden fortgesetzt und bleiben erhalten.
+        for user in os.listdir(host_dir):
             user_backup_dir = os.path.join(host_dir, user)
-            os.makedirs(user_backup_dir, exist_ok=True)
+            if user.startswith('.') or not os.path.isdir(user_backup_dir):
+                continue
+            removed = cleanup_incomplete(user_backup_dir, keep_prefix)
+            if removed and os.path.exists(os.path.join(user_backup_dir, CATALOG_NAME)):
+                try:
+                    with BackupCatalog(user_backup_dir) as catalog:
+                        catalog.remove_backups(removed)
+                except sqlite3.Error as e:
+                    logging.warning(f'Katalogeinträge unfertiger Backups in {user_backup_dir} nicht entfernt: {e}')
 
-            if self.compress_backups:
-                backup_filename = f'backup_{date_str}.tar.gz'
-                backup_path = os.path.join(user_backup_dir, backup_filename)
-            else:
-                backup_dirname = f'backup_{date_str}'
-                backup_path = os.path.join(user_backup_dir, backup_dirname)
+    def _create_snapshot(self):
+        if not self.snapshot_provider:
+            return None
+        try:
+            snapshot = create_snapshot_provider(self.snapshot_provider, self.home_dir, snapshot_size=self.snapshot_size)
+            if snapshot is None:
+                logging.warning(f'Kein Snapshot-Provider für {self.home_dir} verfügbar, Backup erfolgt vom laufenden System.')
+                return None
+            snapshot.create()
+            logging.info(f'Snapshot ({snapshot.name}) von {self.home_dir} unter {snapshot.path} erstellt.')
+            return snapshot
+        except (SnapshotError, ValueError) as e:
+            # Ohne Snapshot wird wie bisher vom laufenden System gesichert
+            logging.warning(f'Snapshot von {self.home_dir} fehlgeschlagen, Backup erfolgt vom laufenden System: {e}')
+            self.notifier.send_notification(f'🟡 Snapshot fehlgeschlagen, Backup erfolgt vom laufenden System: {e}')
+            return None
 
-            # Überprüfen, ob NFS gemountet ist
-            if not os.path.ismount(self.nfs_mount_point):
-                logging.error(f'NFS-Share {self.nfs_mount_point} ist nicht gemountet.')
-                self.notifier.send_notification(f'🔴 Backup fehlgeschlagen: NFS-Share {self.nfs_mount_point} ist nicht gemountet.')
-                return False
+    def _backup_users(self, source_root, host_dir, run, dirty=None, cancel=None):
+        # Benutzerverzeichnisse ermitteln; Reste abgebrochener Snapshots sind keine Benutzer
+        user_dirs = sorted(
+            d for d in os.listdir(source_root)
+            if os.path.isdir(os.path.join(source_root, d)) and not d.startswith(f'.{SNAPSHOT_PREFIX}')
+            and (dirty is None or d in dirty)
+        )
+        dirty = dirty or {}
+        if not user_dirs:
+            return {}
 
-            try:
-                if self.compress_backups:
-                    # Komprimiertes Backup erstellen
-                    self.create_tar_with_progress(backup_path, user_home)
-                    logging.info(f'Komprimiertes Backup für Benutzer {user} erfolgreich erstellt: {backup_path}')
-                else:
-                    # Unkomprimiertes Backup erstellen
-                    self.rsync_backup(backup_path, user_home)
-                    logging.info(f'Backup für Benutzer {user} erfolgreich auf {backup_path} erstellt.')
+        workers = min(self.backup_workers, len(user_dirs))
+        io_slots = threading.Semaphore(self.max_io_jobs or workers)
+
+        # Gemeinsamer Fortschrittsbalken für alle Worker
+        with open_progress(self.show_progress, total=0, unit='B', unit_scale=True, desc="Erstelle Backups") as progress_bar:
+            progress_bar.set_postfix({'Benutzer': f'0/{len(user_dirs)}'})
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup') as executor:
+                futures = {
+                    user: executor.submit(self._backup_user, user, source_root, host_dir, run, io_slots, progress_bar,
+                                          dirty.get(user), cancel)
+                    for user in user_dirs
+                }
+                results = {}
+                for done, (user, future) in enumerate(futures.items(), 1):
+                    results[user] = future.result()
+                    with self._progress_lock:
+                        progress_bar.set_postfix({'Benutzer': f'{done}/{len(user_dirs)}'})
+        return results
+
+    def _backup_user(self, user, source_root, host_dir, run, io_slots, progress_bar, dirty=None, cancel=None):
+        # Ein Fehler betrifft nur diesen Benutzer, die übrigen Backups laufen weiter
+        if user in run.completed:
+            logging.info(f'Backup für Benutzer {user} wurde im fortgesetzten Lauf bereits erstellt.')
+            return True, run.completed[user]
+        if cancel is not None and cancel.is_set():
+            return False, JobCancelled('abgebrochen')
+        start = time.monotonic()
+        ok, result = self._backup_user_attempts(user, source_root, host_dir, run, io_slots, progress_bar, dirty, cancel)
+        self.metrics.set('user_duration_seconds', time.monotonic() - start, user=user)
+        self.metrics.set('user_success', 1 if ok else 0, user=user)
+        if not ok:
+            self.metrics.count('errors', phase='backup')
+        return ok, result
 
-                self.notifier.send_notification(f'🟢 Backup für Benutzer {user} erfolgreich erstellt: {backup_path}')
+    def _backup_user_attempts(self, user, source_root, host_dir, run, io_slots, progress_bar, dirty=None, cancel=None):
+        for attempt in range(1, NFS_RETRIES + 1):
+            try:
+                result = self._backup_user_once(user, source_root, host_dir, run.date_str, io_slots, progress_bar, dirty,
+                                                cancel)
+                run.mark_done(user, result)
+                return True, result
+            except JobCancelled as e:
+                # Das unfertige Backup bleibt mit seinem Checkpoint für die Fortsetzung liegen
+                logging.info(f'Backup für Benutzer {user} abgebrochen.')
+                return False, e
+            except OSError as e:
+                # Kurze NFS-Aussetzer: erneut versuchen, das unfertige Backup wird ab dem letzten Checkpoint fortgesetzt
+                if e.errno not in TRANSIENT_ERRNOS or attempt == NFS_RETRIES:
+                    logging.error(f'Backup für Benutzer {user} fehlgeschlagen: {e}')
+                    return False, e
+                logging.warning(f'Backup für Benutzer {user} unterbrochen ({e}), Versuch {attempt + 1}/{NFS_RETRIES} '
+                                f'in {NFS_RETRY_DELAY * attempt} s.')
+                time.sleep(NFS_RETRY_DELAY * attempt)
             except Exception as e:
                 logging.error(f'Backup für Benutzer {user} fehlgeschlagen: {e}')
-                self.notifier.send_notification(f'🔴 Backup für Benutzer {user} fehlgeschlagen: {e}')
-                return False
+                return False, e
 
-        return True
+    def _backup_user_once(self, user, source_root, host_dir, date_str, io_slots, progress_bar, dirty=None, cancel=None):
+        user_home = os.path.join(source_root, user)
+        user_backup_dir = os.path.join(host_dir, user)
+        os.makedirs(user_backup_dir, exist_ok=True)
+        rules = self.filter_rules(user)
 
+        # Ein Scan über das Home liefert Digests für Home und Unterbäume sowie die stat-Ergebnisse für das Backup.
+        # Mit dirty werden nur die gemeldeten Verzeichnisse gelesen (Teilscan).
+        cache = None
+        tree = None
+        if self._uses_stat_cache():
+            cache = StatCache(user_backup_dir)
+            with self.metrics.phase('walk'):
+                tree = cache.scan(user_home, rules, dirty)
+            previous_path = os.path.join(user_backup_dir, cache.backup) if cache.backup else None
+            if self.skip_unchanged and previous_path and tree.unchanged() and os.path.exists(previous_path):
+                logging.info(f'Home von Benutzer {user} seit {cache.backup} unverändert, Backup übersprungen.')
+                self.metrics.count('users_skipped')
+                return f'{previous_path} (unverändert)'
 
+        manifest = None
+        parent = None
+        if self.dedup_backups:
+            backup_path = os.path.join(user_backup_dir, f'backup_{date_str}{INDEX_EXTENSION}')
+        elif self.compress_backups:
+            if self.incremental_archives:
+                manifest = ArchiveManifest(user_backup_dir)
+                parent = self._delta_parent(manifest, user_backup_dir)
+            suffix = DELTA_SUFFIX if parent else ''
+            backup_filename = f'backup_{date_str}{suffix}{archive_extension(self.compress_backups)}'
+            backup_path = os.path.join(user_backup_dir, backup_filename)
+        else:
+            backup_dirname = f'backup_{date_str}'
+            backup_path = os.path.join(user_backup_dir, backup_dirname)
+        # Unveränderte Unterbäume nur überspringen, wenn der Cache genau den Vorgänger beschreibt
+        prune = manifest is not None and parent is not None and cache.backup == parent
+        if tree is not None and tree.partial and not prune:
+            # Nur ein Delta kommt mit dem Teilscan aus, alle anderen Arten brauchen den ganzen Baum
+            with self.metrics.phase('walk'):
+                tree = cache.scan(user_home, rules)
 
-    def create_tar_with_progress(self, backup_path, source_dir):
-        file_list = []
-        total_size = 0
+        with io_slots:
+            if self.dedup_backups:
+                # Nur bisher unbekannte Chunks werden übertragen, das Backup selbst ist ein Index
+                previous_index = self._previous_chunk_index(user_backup_dir, cache)
+                new_bytes = self.chunk_backup(backup_path, user_home, progress_bar, tree, previous_index, rules, cancel)
+                logging.info(f'Dedupliziertes Backup für Benutzer {user} erfolgreich erstellt: {backup_path} ({new_bytes} neue Bytes)')
+            elif manifest is not None:
+                # Delta enthält nur Dateien, deren Größe, mtime oder Inode sich geändert hat
+                previous_state = manifest.state if parent else {}
+                state = self.create_tar_with_progress(backup_path, user_home, progress_bar, previous_state, tree, prune,
+                                                      cancel=cancel)
+                deleted = set(previous_state) - set(state)
+                manifest.add_archive(backup_filename, parent, state, deleted)
+                manifest.save()
+                logging.info(f'{"Inkrementelles" if parent else "Vollständiges"} Backup für Benutzer {user} erfolgreich erstellt: {backup_path}')
+            elif self.compress_backups:
+                # Komprimiertes Backup erstellen
+                self.create_tar_with_progress(backup_path, user_home, progress_bar, tree=tree, rules=rules, cancel=cancel)
+                logging.info(f'Komprimiertes Backup für Benutzer {user} erfolgreich erstellt: {backup_path}')
+            else:
+                # Unkomprimiertes Backup erstellen, unveränderte Dateien ggf. als Hardlinks auf den letzten Snapshot
+                link_dest = self.find_latest_snapshot(user_backup_dir) if self.incremental_snapshots else None
+                # rsync selbst wird nicht unterbrochen, nur vor dem Start geprüft
+                _check_cancelled(cancel)
+                self.rsync_backup(backup_path, user_home, link_dest, rules, tree)
+                self._catalog_directory_backup(backup_path, link_dest)
+                logging.info(f'Backup für Benutzer {user} erfolgreich auf {backup_path} erstellt.')
+        self._record_inventory(host_dir, user, backup_path)
+        if cache is not None:
+            self._save_stat_cache(cache, tree, backup_path)
+        return backup_path
 
-        # Sammeln aller Dateien und Berechnung der Gesamtgröße
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_list.append(file_path)
-                try:
-                    total_size += os.path.getsize(file_path)
-                except FileNotFoundError:
-                    continue
+    def _record_inventory(self, host_dir, user, backup_path):
+        # Dateianzahl und Datenmenge stammen aus dem Katalog, der während des Backups geschrieben wurde.
+        # Bei Verzeichnis-Snapshots ist die Größe die Datenmenge, da Hardlinks keinen Platz belegen.
+        user_backup_dir, name = os.path.split(backup_path)
+        try:
+            files = data_size = None
+            if os.path.exists(os.path.join(user_backup_dir, CATALOG_NAME)):
+                with BackupCatalog(user_backup_dir) as catalog:
+                    if catalog.has_backup(name):
+                        files, data_size = catalog.summary(name)
+            size = data_size if os.path.isdir(backup_path) else os.path.getsize(backup_path)
+            self.metrics.set('user_files', files or 0, user=user)
+            self.metrics.set('user_bytes', data_size or 0, user=user)
+            with self._inventory(os.path.basename(host_dir)) as inventory:
+                inventory.record_backup(user, name, size, data_size, files)
+        except (OSError, sqlite3.Error) as e:
+            # Der nächste Abgleich nimmt das Backup ohne Größenangaben auf
+            logging.warning(f'Backup {backup_path} konnte nicht im Bestand erfasst werden: {e}')
 
-        with tarfile.open(backup_path, 'w:gz') as tar:
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc="Erstelle Backup") as progress_bar:
-                for file_path in file_list:
+    def _uses_stat_cache(self):
+        return self.skip_unchanged or self.dedup_backups or bool(self.compress_backups and self.incremental_archives)
+
+    def _save_stat_cache(self, cache, tree, backup_path):
+        cache.update(tree, os.path.basename(backup_path))
+        try:
+            cache.save()
+        except OSError as e:
+            # Ohne Cache wird beim nächsten Lauf nur wieder alles als verändert betrachtet
+            logging.warning(f'Stat-Cache {cache.path} konnte nicht gespeichert werden: {e}')
+
+    def _previous_chunk_index(self, user_backup_dir, cache):
+        # Chunk-Listen des Backups, zu dem der Stat-Cache gehört; unveränderte Dateien übernehmen sie ohne erneutes Lesen
+        if cache is None or not cache.backup or not is_chunk_index(cache.backup):
+            return {}
+        index_path = os.path.join(user_backup_dir, cache.backup)
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            return {entry['path']: entry['chunks'] for entry in read_index(index_path) if entry.get('type') == 'file'}
+        except (OSError, ValueError) as e:
+            logging.warning(f'Index {index_path} konnte nicht gelesen werden: {e}')
+            return {}
+
+    def _delta_parent(self, manifest, user_backup_dir):
+        # Vorgänger für ein Delta oder None, wenn ein neues Vollbackup fällig ist
+        latest = manifest.latest_archive()
+        if latest is None:
+            return None
+        try:
+            chain = manifest.chain(latest)
+        except ValueError:
+            return None
+        if len(chain) - 1 >= self.full_backup_interval:
+            return None
+        if not all(os.path.exists(os.path.join(user_backup_dir, name)) for name in chain):
+            # Unvollständige Kette: Wiederherstellung wäre nicht möglich
+            return None
+        return latest
+
+    def _notify_backup_summary(self, results, failed):
+        # Eine Nachricht pro Lauf statt einer pro Benutzer
+        lines = []
+        for user, (ok, detail) in results.items():
+            if ok:
+                lines.append(f'🟢 Backup für Benutzer {user} erfolgreich erstellt: {detail}')
+            else:
+                lines.append(f'🔴 Backup für Benutzer {user} fehlgeschlagen: {detail}')
+        header = f'Backup abgeschlossen: {len(results) - len(failed)}/{len(results)} Benutzer erfolgreich.'
+        self.notifier.send_notification('\n'.join([header] + lines))
+
+    def create_tar_with_progress(self, backup_path, source_dir, progress_bar=None, previous_state=None, tree=None, prune=False,
+                                 rules=None, cancel=None):
+        # Das Archiv wird geschrieben, während der Baum noch durchlaufen wird.
+        # Die Gesamtgröße wird aus dem letzten Lauf geschätzt statt vorab gescannt.
+        # Mit previous_state werden unveränderte Dateien übersprungen und der neue Zustand zurückgegeben.
+        # Mit einem TreeScan (tree) entfällt der erneute Durchlauf; prune überspringt unveränderte Unterbäume.
+        # rules (FilterRules) gilt nur ohne tree, ein TreeScan ist bereits gefiltert.
+        size_cache = os.path.join(os.path.dirname(backup_path), '.last_backup_size')
+        estimate = self._read_size_estimate(size_cache)
+
+        own_bar = progress_bar is None
+        if own_bar:
+            progress_bar = open_progress(self.show_progress, total=estimate or None, unit='B', unit_scale=True, desc="Erstelle Backup")
+        elif estimate:
+            with self._progress_lock:
+                progress_bar.total += estimate
+                progress_bar.refresh()
+
+        written = 0
+        state = {} if previous_state is not None else None
+        # Geschrieben wird unter einem versteckten Namen; ein Checkpoint erlaubt das Fortsetzen nach einem Abbruch
+        partial = partial_path(backup_path)
+        checkpoint = ArchiveCheckpoint(partial)
+        resume = checkpoint.load()
+        done = {}
+        if resume is not None:
+            try:
+                done = checkpoint.read_journal(resume['journal_size'])
+                logging.info(f'Setze {backup_path} nach {len(done)} Einträgen fort.')
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f'Checkpoint von {backup_path} unbrauchbar, beginne neu: {e}')
+                resume = None
+        checkpoint.open_journal(resume['journal_size'] if resume else 0)
+        recorder = _CatalogRecorder(backup_path, resume['uncompressed_offset'] if resume else None)
+        checkpointed = resume is not None
+        completed = False
+        out = None
+        try:
+            with open_writer(partial, self.compress_backups, self.compression_level, self.compression_threads,
+                             self._target_writer,
+                             (resume['uncompressed_offset'], resume['compressed_offset'], resume['blocks']) if resume else None) as out, \
+                    tarfile.open(fileobj=out, mode='w') as tar:
+                writer = StreamingTarWriter(tar, self._source_reader)
+                if resume:
+                    writer.restore_linked_inodes(resume['links'])
+                last_checkpoint = tar.offset
+                entries = self.metrics.timed(tree.walk(prune) if tree is not None else scan_tree(source_dir, rules), 'walk')
+                for file_path, arcname, st in entries:
+                    _check_cancelled(cancel)
+                    if arcname in done:
+                        # Bereits vor dem Abbruch geschrieben
+                        if state is not None:
+                            state[arcname] = done[arcname]
+                        continue
+                    file_state = None
+                    if state is not None:
+                        file_state = [st.st_size, st.st_mtime_ns, st.st_ino]
+                        state[arcname] = file_state
+                        # Verzeichnisse werden immer aufgenommen, damit leere Verzeichnisse und Rechte erhalten bleiben
+                        if not stat.S_ISDIR(st.st_mode) and previous_state.get(arcname) == file_state:
+                            self.metrics.count('files_skipped')
+                            continue
                     try:
-                        arcname = os.path.relpath(file_path, source_dir)
-                        tar.add(file_path, arcname=arcname)
-                        # Aktualisieren des Fortschrittsbalkens
-                        file_size = os.path.getsize(file_path)
-                        progress_bar.update(file_size)
-                        progress_bar.set_postfix({'Datei': os.path.basename(file_path)})
-                    except PermissionError:
-                        logging.warning(f'Zugriff verweigert: {file_path}')
+                        offset = tar.offset
+                        file_size = writer.add(file_path, arcname, st)
+                        recorder.add(arcname, st, offset, writer.last_checksum)
+                        checkpoint.record(arcname, file_state)
+                        self.metrics.count('files')
+                    except (PermissionError, FileNotFoundError) as e:
+                        if out.error is not None:
+                            raise
+                        if isinstance(e, PermissionError):
+                            logging.warning(f'Zugriff verweigert: {file_path}')
+                            self.metrics.count('errors', phase='read')
+                        self._forget_state(state, arcname, tree)
+                        continue
                     except Exception as e:
+                        # Schreibfehler auf dem Ziel brechen das Archiv ab, Lesefehler betreffen nur die Datei
+                        if out.error is not None:
+                            raise
                         logging.error(f'Fehler beim Hinzufügen von {file_path}: {e}')
+                        self.metrics.count('errors', phase='read')
+                        self._forget_state(state, arcname, tree)
+                        continue
 
+                    if tar.offset - last_checkpoint >= CHECKPOINT_BYTES:
+                        # Block an der Member-Grenze abschließen, dann Katalog, Journal und Offsets sichern
+                        uncompressed_offset, compressed_offset = out.flush_block()
+                        recorder.flush()
+                        checkpoint.save({
+                            'uncompressed_offset': uncompressed_offset,
+                            'compressed_offset': compressed_offset,
+                            'blocks': out.blocks,
+                            'links': writer.linked_inodes(),
+                        })
+                        checkpointed = True
+                        last_checkpoint = tar.offset
 
-    def get_directory_size(self, directory):
-        total = 0
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
+                    # Aktualisieren des Fortschrittsbalkens
+                    written += file_size
+                    with self._progress_lock:
+                        if progress_bar.total is not None and progress_bar.n + file_size > progress_bar.total:
+                            progress_bar.total = progress_bar.n + file_size
+                        progress_bar.update(file_size)
+                        if own_bar:
+                            progress_bar.set_postfix({'Datei': os.path.basename(file_path)})
+            recorder.add_blocks(out.blocks)
+            completed = True
+        finally:
+            if out is not None:
+                self.metrics.add_time('compress', out.compress_seconds)
+                self.metrics.add_time('fsync', out.fsync_seconds)
+            # Nach einem Checkpoint bleiben die Katalogeinträge für die Fortsetzung erhalten
+            recorder.finish(completed, keep=checkpointed)
+            checkpoint.close()
+            if not own_bar and estimate:
+                # Schätzung des gemeinsamen Balkens durch den tatsächlichen Wert ersetzen
+                with self._progress_lock:
+                    progress_bar.total = max(progress_bar.n, progress_bar.total - estimate + written)
+                    progress_bar.refresh()
+            if own_bar:
+                progress_bar.close()
+        publish(partial, backup_path)
+
+        if state is not None and prune:
+            # Übersprungene Unterbäume behalten ihren bisherigen Zustand
+            for arcname, st in tree.pruned_entries():
+                state[arcname] = previous_state.get(arcname)
+                if state[arcname] is None:
+                    tree.mark_failed(arcname)
+        if state is None:
+            self._write_size_estimate(size_cache, written)
+        return state
+
+    def chunk_backup(self, backup_path, source_dir, progress_bar=None, tree=None, previous_chunks=None, rules=None,
+                     cancel=None):
+        # Gibt die Anzahl der neu im Chunk-Store abgelegten Bytes zurück.
+        # Dateien, die laut Stat-Cache unverändert sind, übernehmen ihre Chunk-Liste aus previous_chunks.
+        previous_chunks = previous_chunks or {}
+        store = self.chunk_store
+        own_bar = progress_bar is None
+        if own_bar:
+            progress_bar = open_progress(self.show_progress, total=None, unit='B', unit_scale=True, desc="Erstelle Backup")
+        new_bytes = 0
+        recorder = _CatalogRecorder(backup_path)
+        completed = False
+        # Das Journal hält die Chunk-Listen bereits gespeicherter Dateien fest; nach einem Abbruch
+        # werden unveränderte Dateien daraus übernommen, sofern ihre Chunks noch vorhanden sind
+        partial = partial_path(backup_path)
+        checkpoint = ArchiveCheckpoint(partial)
+        journaled = checkpoint.read_journal()
+        if journaled:
+            logging.info(f'Setze {backup_path} nach {len(journaled)} Dateien fort.')
+        checkpoint.open_journal()
+        for arcname, file_state in journaled.items():
+            checkpoint.record(arcname, file_state)
+        checkpoint.sync()
+        unsynced = 0
+        # (st_dev, st_ino) -> Pfad der ersten gesicherten Datei mit mehreren Hardlinks; weitere Namen
+        # derselben Datei werden wie im Archiv nur als Verweis darauf gespeichert
+        inodes = {}
+
+        def entries():
+            nonlocal new_bytes, unsynced
+            for file_path, arcname, st in self.metrics.timed(tree.walk() if tree is not None else scan_tree(source_dir, rules), 'walk'):
+                _check_cancelled(cancel)
+                entry = {
+                    'path': arcname,
+                    'mode': stat.S_IMODE(st.st_mode),
+                    'uid': st.st_uid,
+                    'gid': st.st_gid,
+                    'mtime': st.st_mtime,
+                }
+                if is_sparse(st):
+                    # Beim Restore bleiben Null-Chunks Löcher
+                    entry['sparse'] = True
                 try:
-                    total += os.path.getsize(fp)
+                    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                        entry['type'] = 'hardlink'
+                        entry['target'] = inodes[(st.st_dev, st.st_ino)]
+                    elif stat.S_ISREG(st.st_mode):
+                        entry['type'] = 'file'
+                        entry['size'] = st.st_size
+                        file_state = [st.st_size, st.st_mtime_ns, st.st_ino]
+                        resumed = journaled.get(arcname)
+                        if arcname in previous_chunks and tree.file_unchanged(arcname, st):
+                            entry['chunks'] = previous_chunks[arcname]
+                            self.metrics.count('files_skipped')
+                        elif resumed and resumed[0] == file_state and all(map(store.has_chunk, resumed[1])):
+                            entry['chunks'] = resumed[1]
+                        else:
+                            entry['chunks'], stored = store.store_file(file_path, self._source_reader)
+                            new_bytes += stored
+                            self.metrics.count('bytes', stored, direction='written')
+                            unsynced += st.st_size
+                        checkpoint.record(arcname, [file_state, entry['chunks']])
+                        if unsynced >= CHECKPOINT_BYTES:
+                            checkpoint.sync()
+                            unsynced = 0
+                        if st.st_nlink > 1:
+                            entry['nlink'] = st.st_nlink
+                            inodes[(st.st_dev, st.st_ino)] = arcname
+                    elif stat.S_ISDIR(st.st_mode):
+                        entry['type'] = 'dir'
+                    elif stat.S_ISLNK(st.st_mode):
+                        entry['type'] = 'symlink'
+                        entry['linkname'] = os.readlink(file_path)
+                    else:
+                        continue
+                except PermissionError:
+                    logging.warning(f'Zugriff verweigert: {file_path}')
+                    self.metrics.count('errors', phase='read')
+                    self._forget_state(None, arcname, tree)
+                    continue
                 except FileNotFoundError:
+                    self._forget_state(None, arcname, tree)
+                    continue
+                with self._progress_lock:
+                    progress_bar.update(entry.get('size', 0))
+                recorder.add(arcname, st)
+                self.metrics.count('files')
+                yield entry
+
+        try:
+            write_index(partial, entries())
+            completed = True
+        finally:
+            recorder.finish(completed)
+            checkpoint.close()
+            if own_bar:
+                progress_bar.close()
+        publish(partial, backup_path)
+        return new_bytes
+
+    def restore_chunk_backup(self, index_path, target_path, only_path=None):
+        # Stellt den gesamten Index oder nur only_path (Datei oder Verzeichnis) wieder her;
+        # die Dateien werden parallel aus dem Chunk-Store zusammengesetzt
+        store = self.chunk_store
+        restorer = ParallelRestorer(target_path, self.restore_workers, self.governor)
+        found = False
+        # Übersprungene Dateien mit mehreren Hardlinks, falls ein Verweis darauf im Unterbaum liegt
+        outside = {}
+        try:
+            for entry in read_index(index_path):
+                relative_path = entry['path']
+                if only_path and relative_path != only_path and not relative_path.startswith(only_path.rstrip('/') + '/'):
+                    if entry.get('nlink'):
+                        outside[relative_path] = entry
+                    continue
+                found = True
+                if entry['type'] == 'dir':
+                    restorer.directory(relative_path, entry)
+                elif entry['type'] == 'symlink':
+                    restorer.symlink(relative_path, entry['linkname'], entry)
+                elif entry['type'] == 'hardlink' and entry['target'] in outside:
+                    # Das Ziel wird nicht wiederhergestellt, der Verweis daher als eigene Datei
+                    target = outside[entry['target']]
+                    restorer.file_from(relative_path, dict(entry, size=target['size']),
+                                       functools.partial(store.write_file, target['chunks'], sparse=target.get('sparse', False)))
+                elif entry['type'] == 'hardlink':
+                    restorer.hardlink(relative_path, entry['target'], entry)
+                else:
+                    restorer.file_from(relative_path, entry,
+                                      functools.partial(store.write_file, entry['chunks'], sparse=entry.get('sparse', False)))
+            restorer.finish()
+        except BaseException:
+            restorer.abort()
+            raise
+        if only_path and not found:
+            raise FileNotFoundError(f'{only_path} nicht in {index_path} gefunden')
+
+    def _all_chunk_indexes(self):
+        # Alle Backup-Indizes aller Hosts, da der Chunk-Store gemeinsam genutzt wird
+        indexes = []
+        for hostname in os.listdir(self.nfs_mount_point):
+            host_dir = os.path.join(self.nfs_mount_point, hostname)
+            if hostname.startswith('.') or not os.path.isdir(host_dir):
+                continue
+            for user in os.listdir(host_dir):
+                user_backup_dir = os.path.join(host_dir, user)
+                if not os.path.isdir(user_backup_dir):
                     continue
+                indexes.extend(os.path.join(user_backup_dir, item)
+                               for item in os.listdir(user_backup_dir) if is_chunk_index(item))
+        return indexes
+
+    def _forget_state(self, state, arcname, tree=None):
+        # Nicht gesicherte Dateien gelten weder als gelöscht noch beim nächsten Delta als unverändert
+        if state is not None:
+            state[arcname] = None
+        if tree is not None:
+            tree.mark_failed(arcname)
+
+    def _read_size_estimate(self, size_cache):
+        try:
+            with open(size_cache) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def _write_size_estimate(self, size_cache, size):
+        try:
+            with open(size_cache, 'w') as f:
+                f.write(str(size))
+        except OSError as e:
+            logging.warning(f'Größenschätzung konnte nicht gespeichert werden: {e}')
+
+    def get_directory_size(self, directory):
+        total = 0
+        for _, _, st in scan_tree(directory):
+            if stat.S_ISREG(st.st_mode):
+                total += st.st_size
         return total
 
-    def rsync_backup(self, backup_path, source_dir):
-        subprocess.run(['rsync', '-a', f'{source_dir}/', backup_path], check=True)
+    @_measured('rsync')
+    def rsync_backup(self, backup_path, source_dir, link_dest=None, rules=None, tree=None):
+        # rsync schreibt in ein verstecktes Verzeichnis; ein abgebrochener Lauf überträgt beim
+        # Fortsetzen nur noch fehlende Dateien, --delete entfernt inzwischen gelöschte
+        import subprocess
+        command = self._rsync_command() + ['--delete']
+        if link_dest:
+            # Unveränderte Dateien werden als Hardlinks auf den vorherigen Snapshot angelegt
+            command.append(f'--link-dest={os.path.abspath(link_dest)}')
+        partial = partial_path(backup_path)
 
-    def rotate_backups(self):
-        cutoff_date = datetime.now() - timedelta(days=self.retention_days)
-        hostname = socket.gethostname()
-        host_dir = os.path.join(self.nfs_mount_point, hostname)
+        # Ein Durchlauf über die Quelle (oder der vorhandene TreeScan) liefert die Ausschlüsse und die
+        # großen Dateien. rsync kennt weder Altersgrenzen noch CACHEDIR.TAG und wertet Muster anders
+        # aus; es erhält die Ausschlüsse daher als exakte Pfade, sodass alle Backup-Arten dieselben
+        # Dateien enthalten. Große Dateien kopiert nicht rsync durch den Benutzeradressraum, sondern
+        # _copy_large_file im Kernel; im Ziel sind sie vor --delete geschützt (Regel 'P').
+        excluded = tree.excluded if tree is not None else []
+        entries = tree.walk() if tree is not None else scan_tree(source_dir, rules, excluded)
+        large = [(path, arcname, st) for path, arcname, st in entries
+                 if stat.S_ISREG(st.st_mode) and st.st_size >= LARGE_FILE_SIZE]
+        filters = [f'- {rsync_exclude_pattern(path)}' for path in excluded]
+        for _, arcname, _ in large:
+            filters += [f'P {rsync_exclude_pattern(arcname)}', f'- {rsync_exclude_pattern(arcname)}']
+        filter_file = None
+        if filters:
+            filter_file = f'{partial}.filter.tmp'
+            with open(filter_file, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.write(''.join(rule + '\0' for rule in filters))
+            command += ['--from0', f'--filter=. {filter_file}']
+        if excluded:
+            # Nach geänderten Regeln auch bereits übertragene, jetzt ausgeschlossene Dateien entfernen
+            command.append('--delete-excluded')
+        try:
+            subprocess.run(command + [f'{source_dir}/', partial], check=True)
+        finally:
+            if filter_file is not None:
+                os.remove(filter_file)
+        for path, arcname, st in large:
+            self._copy_large_file(path, arcname, st, partial, link_dest)
+        publish(partial, backup_path)
+
+    def _copy_large_file(self, source, arcname, st, target_dir, link_dest=None):
+        # Unverändert gegenüber dem vorherigen Snapshot (Kriterien wie rsync): Hardlink wie bei --link-dest.
+        # Sonst Reflink, copy_file_range oder sendfile; Löcher bleiben erhalten.
+        target = os.path.join(target_dir, arcname)
+        for candidate in ([os.path.join(link_dest, arcname)] if link_dest else []) + [target]:
+            try:
+                existing = os.lstat(candidate)
+            except FileNotFoundError:
+                continue
+            if (stat.S_ISREG(existing.st_mode) and existing.st_size == st.st_size
+                    and int(existing.st_mtime) == int(st.st_mtime) and existing.st_mode == st.st_mode
+                    and (existing.st_uid, existing.st_gid) == (st.st_uid, st.st_gid)):
+                if candidate != target:
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.link(candidate, target)
+                # Bei einem fortgesetzten Lauf bereits vollständig kopiert
+                return 0
+        if os.path.lexists(target):
+            os.remove(target)
+        throttle = self._throttle_copy if self.governor.active else None
+        start = time.perf_counter()
+        copied = copy_file(source, target, throttle)
+        self.metrics.add_time('copy', time.perf_counter() - start, copied, 'written')
+        # Die mtime zuletzt: eine abgebrochene Kopie gilt beim Fortsetzen damit nicht als vollständig
+        apply_metadata(target, {'uid': st.st_uid, 'gid': st.st_gid, 'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime})
+        return copied
+
+    def _throttle_copy(self, amount):
+        # Eine Kopie liest und schreibt dieselbe Menge
+        self.governor.read(amount)
+        self.governor.write(amount)
+
+    def _catalog_directory_backup(self, backup_path, link_dest=None):
+        # Katalog mit Prüfsummen. Dateien, die rsync als Hardlink auf den vorherigen Snapshot angelegt hat,
+        # übernehmen dessen Prüfsumme und werden nicht erneut gelesen.
+        previous = self._catalog_checksums(link_dest) if link_dest else {}
+        recorder = _CatalogRecorder(backup_path)
+        completed = False
+        try:
+            for file_path, arcname, st in scan_tree(backup_path):
+                checksum = None
+                if stat.S_ISREG(st.st_mode):
+                    checksum = self._snapshot_checksum(file_path, arcname, st, link_dest, previous)
+                recorder.add(arcname, st, checksum=checksum)
+            completed = True
+        finally:
+            recorder.finish(completed)
+
+    def _catalog_checksums(self, backup_path):
+        # Pfad -> Prüfsumme eines katalogisierten Backups (leer, wenn es keine gibt)
+        user_backup_dir, name = os.path.split(backup_path)
+        try:
+            with self._open_catalog(user_backup_dir) as catalog:
+                if not catalog.has_backup(name):
+                    return {}
+                return {path: checksum for path, (_, _, checksum) in catalog.checksums(name).items() if checksum}
+        except sqlite3.Error as e:
+            logging.warning(f'Prüfsummen von {backup_path} nicht lesbar: {e}')
+            return {}
+
+    def _snapshot_checksum(self, file_path, arcname, st, link_dest, previous):
+        checksum = previous.get(arcname)
+        if checksum is not None:
+            try:
+                if os.lstat(os.path.join(link_dest, arcname)).st_ino == st.st_ino:
+                    return checksum
+            except OSError:
+                pass
+        try:
+            return file_checksum(file_path, self._source_reader)
+        except OSError as e:
+            logging.warning(f'Prüfsumme von {file_path} nicht berechnet: {e}')
+            return None
+
+    def _rsync_command(self):
+        # --sparse legt Nullbereiche im Ziel als Löcher an
+        command = ['rsync', '-a', '--sparse']
+        bwlimit = self.governor.rsync_bwlimit()
+        if bwlimit:
+            command.append(f'--bwlimit={bwlimit}')
+        return command
+
+    def find_latest_snapshot(self, user_backup_dir):
+        # Neuester vorhandener Verzeichnis-Snapshot eines Benutzers
+        snapshots = []
+        for item in os.listdir(user_backup_dir):
+            item_date = parse_backup_date(item)
+            item_path = os.path.join(user_backup_dir, item)
+            if item_date and not is_archive(item) and os.path.isdir(item_path):
+                snapshots.append((item_date, item_path))
+        if not snapshots:
+            return None
+        return max(snapshots)[1]
 
+    def rotate_backups(self, host=None, dry_run=False):
+        # Rotation der Backups dieses Hosts bzw. von host; gibt den Bericht je Host zurück (siehe _rotate_host)
+        return self._rotate_hosts([host or socket.gethostname()], dry_run)
+
+    def rotate_all_hosts(self, dry_run=False):
+        # Wartung des gesamten Repositorys: alle Hosts parallel rotieren, danach eine gemeinsame Garbage Collection
+        return self._rotate_hosts(self.list_hosts(), dry_run)
+
+    @_measured('rotate')
+    def _rotate_hosts(self, hosts, dry_run):
+        if not hosts:
+            return {}
+        # Ein gemeinsamer Pool für die Löscharbeit aller Hosts, damit die Anzahl paralleler NFS-Zugriffe begrenzt bleibt
+        with ThreadPoolExecutor(max_workers=self.maintenance_workers, thread_name_prefix='delete') as deleter, \
+                ThreadPoolExecutor(max_workers=min(self.maintenance_workers, len(hosts)), thread_name_prefix='rotate') as executor:
+            reports = dict(zip(hosts, executor.map(lambda host: self._rotate_host_locked(host, deleter, dry_run), hosts)))
+        if not dry_run:
+            self._finish_rotation(reports)
+        return reports
+
+    def _rotate_host_locked(self, hostname, deleter, dry_run=False):
+        # Ein belegter oder fehlerhafter Host wird übersprungen, die übrigen werden weiter rotiert
+        try:
+            if dry_run:
+                return self._rotate_host(hostname, deleter, dry_run)
+            with self._host_lease(hostname) as lease:
+                return self._rotate_host(hostname, deleter, check=lease.check)
+        except LeaseLost as e:
+            logging.error(f'Rotation von {hostname} abgebrochen: {e}')
+            return _rotation_report(error=f'abgebrochen: {e}')
+        except LeaseError as e:
+            logging.warning(f'Rotation von {hostname} übersprungen: {e}')
+            return _rotation_report(error=f'übersprungen: {e}')
+        except Exception as e:
+            logging.error(f'Rotation von {hostname} fehlgeschlagen: {e}')
+            return _rotation_report(error=str(e))
+
+    def _rotate_host(self, hostname, deleter, dry_run=False, check=None):
+        # Der Plan wird vollständig aus dem Bestand berechnet, bevor etwas gelöscht wird.
+        # check() wird vor jedem Löschschritt aufgerufen und wirft LeaseLost, wenn die Sperre verloren ist.
+        # Bericht: plans (Benutzer -> RetentionPlan), deleted (Pfade), errors (Pfad -> Fehler),
+        # freed (Bytes laut Bestand), chunks (Chunk-Indizes gelöscht), error (Fehler des Hosts)
+        report = _rotation_report()
+        host_dir = os.path.join(self.nfs_mount_point, hostname)
         if not os.path.exists(host_dir):
+            return report
+
+        by_user = {}
+        for backup in self.list_backups(host=hostname):
+            by_user.setdefault(backup['user'], []).append(backup)
+        for user, backups in by_user.items():
+            # Das neueste Backup bleibt immer erhalten: es ist die Basis für den nächsten
+            # Hardlink-Snapshot und die einzige Sicherung, falls länger kein Backup lief.
+            # Hardlinks teilen sich Inodes, daher entfernt das Löschen älterer Snapshots
+            # nur Verzeichniseinträge und lässt neuere Snapshots unberührt.
+            plan = self.retention_policy.plan(backups)
+            plan.protect(self._protected_chain_members(os.path.join(host_dir, user), plan.keep), 'Kette')
+            report['plans'][user] = plan
+        if dry_run:
+            return report
+
+        check = check or (lambda: None)
+        check()
+        for user in by_user:
+            remove_stale_deletions(os.path.join(host_dir, user))
+        doomed = {backup['path']: (user, backup) for user, plan in report['plans'].items() for backup in plan.delete}
+        deleted, report['errors'] = delete_backups(list(doomed), deleter, check)
+        report['deleted'] = deleted
+
+        deleted_by_user = {}
+        for path in deleted:
+            user, backup = doomed[path]
+            deleted_by_user.setdefault(user, []).append(backup['backup'])
+            report['freed'] += backup.get('size') or 0
+            report['chunks'] = report['chunks'] or is_chunk_index(path)
+        for user, deleted_names in deleted_by_user.items():
+            try:
+                self._forget_deleted(hostname, user, deleted_names, check)
+            except LeaseLost as e:
+                report['error'] = f'abgebrochen: {e}'
+        if report['error']:
+            logging.error(f'Rotation von {hostname} {report["error"]}')
+        return report
+
+    def _forget_deleted(self, hostname, user, deleted, check=None):
+        # Der eigene Bestand wird immer bereinigt; Manifest und Katalog auf dem Share nur mit gehaltener Sperre
+        user_backup_dir = os.path.join(self.nfs_mount_point, hostname, user)
+        self._forget_in_inventory(hostname, user, deleted)
+        if check is not None:
+            check()
+
+        if os.path.exists(os.path.join(user_backup_dir, MANIFEST_NAME)):
+            manifest = ArchiveManifest(user_backup_dir)
+            manifest.remove_archives(deleted)
+            manifest.save()
+
+        if os.path.exists(os.path.join(user_backup_dir, CATALOG_NAME)):
+            try:
+                with BackupCatalog(user_backup_dir) as catalog:
+                    catalog.remove_backups(deleted)
+            except sqlite3.Error as e:
+                logging.warning(f'Katalog in {user_backup_dir} konnte nicht bereinigt werden: {e}')
+
+    def _finish_rotation(self, reports):
+        if any(report['chunks'] for report in reports.values()):
+            # Nicht mehr referenzierte Chunks entfernen
+            self.collect_chunk_garbage()
+
+        # Ein gemeinsamer Bericht pro Rotation statt einer Nachricht pro gelöschtem Backup
+        deleted = sum(len(report['deleted']) for report in reports.values())
+        self.metrics.count('backups_deleted', deleted)
+        failed = {host: report for host, report in reports.items() if report['errors'] or report['error']}
+        if not deleted and not failed:
             return
+        freed = sum(report['freed'] for report in reports.values())
+        kept = sum(len(plan.keep) for report in reports.values() for plan in report['plans'].values())
+        lines = [f'{"🔴" if failed else "🟡"} Rotation: {deleted} Backups gelöscht ({freed / (1024 ** 3):.2f} GB), {kept} behalten.']
+        for host, report in sorted(reports.items()):
+            if report['error']:
+                lines.append(f'- {host}: {report["error"]}')
+            elif report['deleted'] or report['errors']:
+                lines.append(f'- {host}: {len(report["deleted"])} gelöscht, {len(report["errors"])} Fehler')
+            for path, error in report['errors'].items():
+                lines.append(f'  - {path}: {error}')
+        self.notifier.send_notification('\n'.join(lines))
 
-        for user in os.listdir(host_dir):
-            user_backup_dir = os.path.join(host_dir, user)
-            if not os.path.isdir(user_backup_dir):
+    def collect_chunk_garbage(self):
+        # Der Chunk-Store ist gemeinsam für alle Hosts; nur ein Host darf gleichzeitig bereinigen
+        try:
+            with Lease(os.path.join(self.nfs_mount_point, GC_LEASE_NAME), self.lease_timeout) as lease:
+                self.chunk_store.collect_garbage(self._all_chunk_indexes(), lease.check)
+        except LeaseLost as e:
+            logging.error(f'Garbage Collection abgebrochen: {e}')
+        except LeaseError as e:
+            logging.info(f'Garbage Collection übersprungen, sie läuft bereits: {e}')
+
+    def _host_lease(self, hostname):
+        return Lease(os.path.join(self.nfs_mount_point, hostname, HOST_LEASE_NAME), self.lease_timeout)
+
+    def list_hosts(self):
+        # Alle Hosts, die Backups auf das Share schreiben
+        return sorted(
+            name for name in os.listdir(self.nfs_mount_point)
+            if not name.startswith('.') and os.path.isdir(os.path.join(self.nfs_mount_point, name))
+        )
+
+    def _protected_chain_members(self, user_backup_dir, keep):
+        # Archive einer inkrementellen Kette werden nur gemeinsam gelöscht:
+        # solange ein Delta behalten wird, bleiben Vollbackup und alle Vorgänger erhalten
+        if not os.path.exists(os.path.join(user_backup_dir, MANIFEST_NAME)):
+            return set()
+        manifest = ArchiveManifest(user_backup_dir)
+        protected = set()
+        for name in keep:
+            if name not in manifest.archives:
                 continue
-            for item in os.listdir(user_backup_dir):
-                item_path = os.path.join(user_backup_dir, item)
-                # Datum aus dem Backup-Namen extrahieren
-                date_str = item.replace('backup_', '').replace('.tar.gz', '')
-                try:
-                    item_date = datetime.strptime(date_str, '%Y-%m-%d_%H-%M-%S')
-                    if item_date < cutoff_date:
-                        if os.path.isfile(item_path) or os.path.islink(item_path):
-                            os.remove(item_path)
-                        elif os.path.isdir(item_path):
-                            shutil.rmtree(item_path)
-                        logging.info(f'Altes Backup {item_path} gelöscht.')
-                        self.notifier.send_notification(f'🟡 Altes Backup gelöscht: {item_path}')
-                except ValueError:
-                    continue
+            try:
+                protected.update(manifest.chain(name))
+            except ValueError:
+                continue
+        return protected
 
+    def list_backups(self, user=None, since=None, until=None, host=None):
+        # Backups aus den Beständen der Hosts, nach Name (und damit Datum) sortiert; standardmäßig die dieses
+        # Hosts, mit host=ALL_HOSTS die aller Hosts. Vorher werden nur Verzeichnisse neu gelesen, die sich seit
+        # dem letzten Abgleich geändert haben. Bestände anderer Hosts werden nur gelesen, nie geschrieben.
+        host = host or socket.gethostname()
+        hosts = self.list_hosts() if host == ALL_HOSTS else [host]
+        backups = []
+        verifications = []
+        for name in hosts:
+            try:
+                with self._inventory(name) as inventory:
+                    inventory.refresh()
+                    backups.extend(inventory.query(user=user, since=since, until=until))
+                    verifications.append(inventory.verifications())
+            except sqlite3.Error as e:
+                logging.warning(f'Backup-Bestand von {name} nicht verfügbar, lese das Share direkt: {e}')
+                backups.extend(
+                    backup for backup in self._scan_backups(name)
+                    if (user is None or backup['user'] == user)
+                    and (since is None or backup['date'] >= since)
+                    and (until is None or backup['date'] <= until)
+                )
+        if socket.gethostname() not in hosts:
+            # Eigene Prüfergebnisse für Backups anderer Hosts
+            try:
+                with self._inventory() as inventory:
+                    verifications.append(inventory.verifications())
+            except sqlite3.Error as e:
+                logging.warning(f'Eigener Backup-Bestand nicht lesbar: {e}')
+        backups.sort(key=lambda x: x['backup'])
+        return merge_verifications(backups, verifications)
 
-    def list_backups(self):
+    def _inventory(self, hostname=None):
+        # Den Bestand eines Hosts schreibt nur dieser selbst, die anderer Hosts werden nur gelesen
+        hostname = hostname or socket.gethostname()
+        return BackupInventory(self.nfs_mount_point, hostname, readonly=hostname != socket.gethostname())
+
+    def _scan_backups(self, host):
         backups = []
-        host_dir = os.path.join(self.nfs_mount_point, socket.gethostname())
+        host_dir = os.path.join(self.nfs_mount_point, host)
         if not os.path.exists(host_dir):
             return backups
 
@@ -149,127 +1186,417 @@ class BackupManager:
             if not os.path.isdir(user_backup_dir):
                 continue
             for backup in os.listdir(user_backup_dir):
-                backup_path = os.path.join(user_backup_dir, backup)
+                backup_date = parse_backup_date(backup)
+                if backup_date is None:
+                    continue
                 backups.append({
+                    'host': host,
                     'user': user,
                     'backup': backup,
-                    'path': backup_path
+                    'path': os.path.join(user_backup_dir, backup),
+                    'date': backup_date,
+                    'size': None,
                 })
-        # Sortieren der Backups nach Datum (optional)
         backups.sort(key=lambda x: x['backup'])
         return backups
 
+    def _forget_in_inventory(self, host, user, names):
+        # Backups anderer Hosts entfernt deren eigener Abgleich anhand der geänderten Verzeichnis-mtime
+        if host != socket.gethostname():
+            return
+        try:
+            with self._inventory() as inventory:
+                inventory.remove_backups(user, names)
+        except sqlite3.Error as e:
+            # Der nächste Abgleich entfernt die Einträge anhand der geänderten Verzeichnis-mtime
+            logging.warning(f'Bestand konnte nach der Rotation nicht aktualisiert werden: {e}')
+
 
-    def restore_backup(self, backup_path, target_user):
+    @_governed
+    @_measured('restore')
+    def restore_backup(self, backup_path, target_user, cancel=None):
         if not os.path.exists(backup_path):
             logging.error(f"Backup {backup_path} existiert nicht.")
             self.notifier.send_notification(f"🔴 Restore fehlgeschlagen: Backup {backup_path} existiert nicht.")
             return False
 
-        user_home_dir = f"/home/{target_user}"
+        user_home_dir = os.path.join(self.home_dir, target_user)
         os.makedirs(user_home_dir, exist_ok=True)
 
+        # subprocess wird nur für rsync gebraucht und daher erst hier geladen
+        import subprocess
         try:
-            if backup_path.endswith('.tar.gz'):
-                # Verzeichnisse auslesen und erstellen
-                self.ensure_directories_exist(backup_path, user_home_dir)
+            if is_archive(backup_path):
+                # Bei inkrementellen Archiven die Kette vom Vollbackup an der Reihe nach anwenden
+                manifest, chain = self._archive_chain(backup_path)
+                for archive_name in chain:
+                    archive_path = os.path.join(os.path.dirname(backup_path), archive_name)
 
-                # Komprimiertes Backup wiederherstellen mit Fortschrittsanzeige
-                self.restore_with_progress(backup_path, user_home_dir)
+                    # Komprimiertes Backup wiederherstellen mit Fortschrittsanzeige
+                    self.restore_with_progress(archive_path, user_home_dir, cancel)
+                    if manifest is not None:
+                        self._remove_deleted_paths(manifest.archives[archive_name]['deleted'], user_home_dir)
+                logging.info(f"Backup {backup_path} erfolgreich für Benutzer {target_user} wiederhergestellt.")
+            elif is_chunk_index(backup_path):
+                # Dateien aus dem Chunk-Store zusammensetzen
+                _check_cancelled(cancel)
+                self.restore_chunk_backup(backup_path, user_home_dir)
                 logging.info(f"Backup {backup_path} erfolgreich für Benutzer {target_user} wiederhergestellt.")
             else:
                 # Unkomprimiertes Backup wiederherstellen
-                subprocess.run(['rsync', '-a', backup_path + '/', user_home_dir + '/'], check=True)
+                _check_cancelled(cancel)
+                subprocess.run(self._rsync_command() + [backup_path + '/', user_home_dir + '/'], check=True)
                 logging.info(f"Backup {backup_path} erfolgreich für Benutzer {target_user} wiederhergestellt.")
 
             self.notifier.send_notification(f"🟢 Restore erfolgreich für Benutzer {target_user}: {backup_path}")
             return True
-        except subprocess.CalledProcessError as e:
+        except JobCancelled:
+            logging.info(f"Restore von {backup_path} abgebrochen.")
+            self.notifier.send_notification(f"🟡 Restore für Benutzer {target_user} abgebrochen: {backup_path}")
+            return False
+        except (subprocess.CalledProcessError, OSError, tarfile.TarError, ValueError) as e:
             logging.error(f"Restore fehlgeschlagen: {e}")
             self.notifier.send_notification(f"🔴 Restore fehlgeschlagen: {e}")
             return False
 
-    def restore_with_progress(self, backup_path, target_path):
-        try:
-            with tarfile.open(backup_path, 'r:gz') as tar:
-                members = tar.getmembers()
-                total_size = sum(member.size for member in members)
+    def _archive_chain(self, backup_path):
+        # Liefert das Manifest (oder None) und die für die Wiederherstellung nötigen Archivnamen
+        backup_name = os.path.basename(backup_path)
+        manifest = ArchiveManifest(os.path.dirname(backup_path))
+        if backup_name not in manifest.archives:
+            return None, [backup_name]
+        chain = manifest.chain(backup_name)
+        for name in chain:
+            if not os.path.exists(os.path.join(os.path.dirname(backup_path), name)):
+                raise FileNotFoundError(f'Basisarchiv {name} für {backup_name} fehlt')
+        return manifest, chain
 
-                with tqdm(total=total_size, unit='B', unit_scale=True, desc="Wiederherstellen") as progress_bar:
-                    for member in members:
-                        tar.extract(member, path=target_path)
-                        progress_bar.update(member.size)
+    def _remove_deleted_paths(self, deleted_paths, target_path):
+        # Im Delta als gelöscht vermerkte Pfade entfernen
+        for relative_path in deleted_paths:
+            full_path = safe_join(target_path, relative_path)
+            # Nicht durch einen Link außerhalb des Ziels löschen
+            if not resolves_inside(target_path, full_path):
+                logging.warning(f'{relative_path} liegt hinter einem symbolischen Link und wird nicht entfernt')
+                continue
+            try:
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    shutil.rmtree(full_path)
+                else:
+                    os.remove(full_path)
+            except FileNotFoundError:
+                continue
+
+    def restore_with_progress(self, backup_path, target_path, cancel=None):
+        # Ein einziger Durchlauf über das Archiv: Verzeichnisse entstehen beim Eintreffen, Dateien werden
+        # parallel geschrieben, Metadaten am Ende gesetzt. Der Fortschritt bezieht sich auf die gelesenen
+        # komprimierten Bytes.
+        restorer = ParallelRestorer(target_path, self.restore_workers, self.governor)
+        try:
+            with open_progress(self.show_progress, total=os.path.getsize(backup_path), unit='B', unit_scale=True, desc="Wiederherstellen") as progress_bar, \
+                    open(backup_path, 'rb') as raw, \
+                    open_reader(backup_path, _ProgressReader(self.governor.reader(raw), progress_bar)) as reader, \
+                    tarfile.open(fileobj=reader, mode='r|') as tar:
+                for _ in restore_tar_stream(tar, restorer):
+                    _check_cancelled(cancel)
+            restorer.finish()
+        except JobCancelled:
+            restorer.abort()
+            raise
         except Exception as e:
+            restorer.abort()
             logging.error(f"Fehler bei der Wiederherstellung mit Fortschrittsanzeige: {e}")
             raise
 
-    def ensure_directories_exist(self, backup_path, target_path):
-        try:
-            result = subprocess.run(['tar', '-tf', backup_path], capture_output=True, text=True, check=True)
-            directories = set()
-            for line in result.stdout.splitlines():
-                if line.endswith('/'):
-                    directories.add(line.rstrip('/'))
-
-            for directory in sorted(directories):
-                full_path = os.path.join(target_path, directory)
-                os.makedirs(full_path, exist_ok=True)
-                logging.info(f"Erstelle fehlendes Verzeichnis: {full_path}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Fehler beim Auslesen der Verzeichnisse aus {backup_path}: {e}")
-            raise
+    def _iter_archive_members(self, backup_path):
+        with open_reader(backup_path) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                yield member
 
-    def search_file_in_backup(self, backup, search_query):
+    @_measured('search')
+    def search_file_in_backup(self, backup, search_query, mode='substring'):
+        # Suche über den Katalog; noch nicht erfasste Backups werden bei der ersten Suche indiziert.
+        # mode: 'substring', 'prefix', 'glob' oder 'regex'
         backup_path = backup['path']
-        matching_files = []
+        user_backup_dir = os.path.dirname(backup_path)
         try:
-            if backup_path.endswith('.tar.gz'):
-                # Inhalte des Archivs auflisten
-                result = subprocess.run(['tar', '-tzf', backup_path], capture_output=True, text=True)
-                files = result.stdout.splitlines()
+            if is_archive(backup_path):
+                # Bei Deltas den Stand der gesamten Kette
+                manifest, chain = self._archive_chain(backup_path)
             else:
-                # Dateien im Verzeichnis auflisten
-                files = []
-                for root, dirs, filenames in os.walk(backup_path):
-                    for filename in filenames:
-                        file_path = os.path.join(root, filename)
-                        relative_path = os.path.relpath(file_path, backup_path)
-                        files.append(relative_path)
-
-            # Suche nach der Datei
-            for file in files:
-                if search_query in file:
-                    matching_files.append(file)
-
-            return matching_files
-        except subprocess.CalledProcessError as e:
+                manifest, chain = None, [os.path.basename(backup_path)]
+
+            with self._open_catalog(user_backup_dir) as catalog:
+                for name in chain:
+                    self._ensure_cataloged(catalog, user_backup_dir, name)
+                rows = catalog.search(search_query, mode, chain)
+
+            if manifest is None:
+                return [row[1] for row in rows]
+            files = set()
+            for archive_name in chain:
+                files.update(row[1] for row in rows if row[0] == archive_name)
+                files.difference_update(manifest.archives[archive_name]['deleted'])
+            return sorted(files)
+        except (OSError, tarfile.TarError, ValueError, re.error, sqlite3.Error) as e:
+            logging.error(f"Suche fehlgeschlagen: {e}")
+            return []
+
+    def search_all_hosts(self, search_query, mode='substring', user=None):
+        # Sucht parallel in den Backups aller Benutzer (bzw. von user) auf allen Hosts
+        pairs = sorted({(b['host'], b['user']) for b in self.list_backups(user=user, host=ALL_HOSTS)})
+        if not pairs:
+            return []
+
+        def search(pair):
+            host, pair_user = pair
+            return [dict(match, host=host, user=pair_user)
+                    for match in self.search_user_backups(pair_user, search_query, mode, host)]
+
+        with ThreadPoolExecutor(max_workers=min(self.maintenance_workers, len(pairs)), thread_name_prefix='search') as executor:
+            return [match for matches in executor.map(search, pairs) for match in matches]
+
+    @_measured('search')
+    def search_user_backups(self, user, search_query, mode='substring', host=None):
+        # Sucht in allen Backups eines Benutzers; liefert je Treffer Backup-Name und Pfad
+        host = host or socket.gethostname()
+        user_backup_dir = os.path.join(self.nfs_mount_point, host, user)
+        names = [b['backup'] for b in self.list_backups(user=user, host=host)]
+        if not names:
+            return []
+        try:
+            with self._open_catalog(user_backup_dir) as catalog:
+                for name in names:
+                    self._ensure_cataloged(catalog, user_backup_dir, name)
+                rows = catalog.search(search_query, mode, names)
+            return [{'backup': row[0], 'path': row[1], 'size': row[2], 'mtime': row[3]} for row in rows]
+        except (OSError, tarfile.TarError, ValueError, re.error, sqlite3.Error) as e:
             logging.error(f"Suche fehlgeschlagen: {e}")
             return []
 
+    def verify_backups(self, host=None, sample_percent=100):
+        # Prüft alle Backups dieses Hosts (host=ALL_HOSTS: aller Hosts) parallel auf Lesbarkeit und Vollständigkeit.
+        # Gibt Pfad -> Fehlerbeschreibung der fehlerhaften Backups zurück.
+        return self._verify_many(self.list_backups(host=host), sample_percent)
+
+    def scrub(self, budget_gb=None, sample_percent=None, host=None):
+        # Rollierende Prüfung innerhalb eines Lese-Budgets: zuerst nie geprüfte, dann die am längsten nicht
+        # geprüften Backups. Über mehrere Läufe wird so nach und nach das ganze Repository geprüft.
+        budget = (self.scrub_budget_gb if budget_gb is None else budget_gb) * 1024 ** 3
+        sample_percent = self.scrub_sample_percent if sample_percent is None else sample_percent
+        backups = sorted(self.list_backups(host=host),
+                         key=lambda b: (b.get('verified_at') is not None, b.get('verified_at') or b['date'], b['date']))
+        selected = []
+        used = 0
+        for backup in backups:
+            cost = _scrub_cost(backup, sample_percent)
+            if selected and used + cost > budget:
+                break
+            selected.append(backup)
+            used += cost
+        logging.info(f'Prüfe {len(selected)} von {len(backups)} Backups (ca. {used / 1024 ** 3:.1f} GB).')
+        return self._verify_many(selected, sample_percent)
+
+    @_measured('verify')
+    def _verify_many(self, backups, sample_percent=100):
+        if not backups:
+            return {}
+        # Backups werden parallel geprüft, Dateien und Chunks innerhalb eines Backups über einen gemeinsamen Pool
+        with ThreadPoolExecutor(max_workers=self.restore_workers, thread_name_prefix='verify-file') as files, \
+                ThreadPoolExecutor(max_workers=min(self.maintenance_workers, len(backups)), thread_name_prefix='verify') as executor:
+            results = list(executor.map(lambda b: self.verify_backup(b, sample_percent, files), backups))
+        self._record_verifications(backups, results)
+        failed = {backup['path']: result.describe() for backup, result in zip(backups, results) if not result.ok}
+        self.metrics.count('backups_corrupt', len(failed))
+        if failed:
+            self.notifier.send_notification(
+                '\n'.join([f'🔴 {len(failed)} von {len(backups)} Backups fehlerhaft:']
+                          + [f'- {path}: {error}' for path, error in failed.items()])
+            )
+        logging.info(f'Prüfung abgeschlossen: {len(backups) - len(failed)}/{len(backups)} Backups in Ordnung.')
+        return failed
+
+    def _record_verifications(self, backups, results):
+        # Die Ergebnisse stehen im Bestand dieses Hosts, auch für Backups anderer Hosts
+        try:
+            os.makedirs(os.path.join(self.nfs_mount_point, socket.gethostname()), exist_ok=True)
+            with self._inventory() as inventory:
+                for backup, result in zip(backups, results):
+                    if 'host' in backup:
+                        inventory.record_verification(backup['host'], backup['user'], backup['backup'],
+                                                      'ok' if result.ok else 'corrupt')
+                inventory.prune_verifications()
+        except (OSError, sqlite3.Error) as e:
+            # Die Backups werden beim nächsten Lauf erneut ausgewählt
+            logging.warning(f'Prüfergebnisse konnten nicht im Bestand erfasst werden: {e}')
 
+    def verify_backup(self, backup, sample_percent=100, executor=None):
+        # Liefert ein VerifyResult. Archive werden vollständig gelesen und jede Datei mit der Prüfsumme aus
+        # dem Katalog verglichen, bei Snapshots die Dateien selbst und bei Chunk-Indizes die Chunks
+        # (beides ggf. nur als Stichprobe von sample_percent Prozent).
+        backup_path = backup['path']
+        user_backup_dir, name = os.path.split(backup_path)
+        sample = sample_percent / 100
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.restore_workers, thread_name_prefix='verify-file')
+        try:
+            if is_chunk_index(backup_path):
+                digests = [digest for entry in read_index(backup_path) for digest in entry.get('chunks', ())]
+                result = verify_chunks(self.chunk_store.root, digests, executor, sample)
+            else:
+                with self._open_catalog(user_backup_dir) as catalog:
+                    expected = catalog.checksums(name) if catalog.has_backup(name) else {}
+                if is_archive(backup_path):
+                    with open(backup_path, 'rb') as raw, open_reader(backup_path, self.governor.reader(raw)) as reader:
+                        result = verify_archive(reader, expected)
+                else:
+                    result = verify_directory(backup_path, expected, executor, sample, self.governor.reader)
+        except FileNotFoundError as e:
+            result = VerifyResult()
+            if os.path.exists(backup_path):
+                result.error = str(e)
+            # Sonst inzwischen rotiert
+        except (OSError, EOFError, tarfile.TarError, ValueError, sqlite3.Error) as e:
+            result = VerifyResult()
+            result.error = str(e) or type(e).__name__
+        finally:
+            if own_executor:
+                executor.shutdown()
+        if not result.ok:
+            logging.error(f'Backup {backup_path} fehlerhaft: {result.describe()}')
+        return result
+
+    def _open_catalog(self, user_backup_dir):
+        # Kataloge anderer Hosts werden nur gelesen; schreiben darf sie nur der Host selbst
+        # (und die Rotation unter seiner Sperre)
+        host = os.path.basename(os.path.dirname(user_backup_dir))
+        return BackupCatalog(user_backup_dir, readonly=host != socket.gethostname())
+
+    def _ensure_cataloged(self, catalog, user_backup_dir, name):
+        # Nachträgliche Indizierung von Backups, die vor Einführung des Katalogs entstanden sind
+        if catalog.has_backup(name):
+            return
+        backup_path = os.path.join(user_backup_dir, name)
+        if catalog.readonly:
+            logging.warning(f'Backup {backup_path} ist nicht im Katalog und wird erst bei einer Suche auf seinem Host indiziert.')
+            return
+        logging.info(f"Indiziere Backup {backup_path} für die Suche.")
+        if is_archive(backup_path):
+            files = ((member.name.rstrip('/'), _member_type(member), member.size, member.mtime, member.offset)
+                     for member in self._iter_archive_members(backup_path))
+        elif is_chunk_index(backup_path):
+            files = ((entry['path'], {'symlink': 'link', 'hardlink': 'link'}.get(entry['type'], entry['type']), entry.get('size', 0), entry['mtime'], None)
+                     for entry in read_index(backup_path))
+        else:
+            files = ((arcname, _stat_type(st), st.st_size, st.st_mtime, None)
+                     for _, arcname, st in scan_tree(backup_path))
+        catalog.index_backup(name, files)
+
+    @_governed
+    @_measured('restore')
     def restore_file_from_backup(self, backup, file_path):
+        # file_path ist relativ zum Home-Verzeichnis und kann eine Datei oder ein Verzeichnis sein
         backup_path = backup['path']
+        target_home = os.path.join(self.home_dir, backup['user'])
+        import subprocess
         try:
-            if backup_path.endswith('.tar.gz'):
-                # Einzelne Datei aus dem Archiv extrahieren
-                subprocess.run(['tar', '-xzf', backup_path, '-C', '/', file_path], check=True)
+            if is_archive(backup_path):
+                # Aus dem neuesten Archiv der Kette extrahieren, das den Pfad enthält
+                _, chain = self._archive_chain(backup_path)
+                for archive_name in reversed(chain):
+                    try:
+                        self._extract_member(os.path.join(os.path.dirname(backup_path), archive_name), file_path, target_home)
+                        break
+                    except FileNotFoundError:
+                        if archive_name == chain[0]:
+                            raise
+                logging.info(f"Datei {file_path} erfolgreich aus {backup_path} wiederhergestellt.")
+            elif is_chunk_index(backup_path):
+                self.restore_chunk_backup(backup_path, target_home, file_path)
                 logging.info(f"Datei {file_path} erfolgreich aus {backup_path} wiederhergestellt.")
             else:
                 # Einzelne Datei mit rsync wiederherstellen
                 src_path = os.path.join(backup_path, file_path)
-                dest_path = os.path.join('/', file_path)
+                dest_path = safe_join(target_home, file_path)
+                # Ein vom Benutzer angelegter Link im Home darf das Ziel nicht nach außen umlenken
+                if not resolves_inside(target_home, dest_path):
+                    raise ValueError(f'{file_path} liegt hinter einem symbolischen Link in {target_home}')
                 dest_dir = os.path.dirname(dest_path)
                 os.makedirs(dest_dir, exist_ok=True)
-                subprocess.run(['rsync', '-a', src_path, dest_path], check=True)
+                if os.path.isdir(src_path):
+                    src_path, dest_path = src_path + '/', dest_path + '/'
+                subprocess.run(self._rsync_command() + [src_path, dest_path], check=True)
                 logging.info(f"Datei {file_path} erfolgreich aus {backup_path} wiederhergestellt.")
 
             self.notifier.send_notification(f"🟢 Datei {file_path} erfolgreich wiederhergestellt aus {backup_path}")
             return True
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError, tarfile.TarError, ValueError) as e:
             logging.error(f"Wiederherstellung der Datei fehlgeschlagen: {e}")
             self.notifier.send_notification(f"🔴 Wiederherstellung der Datei fehlgeschlagen: {e}")
             return False
 
+    def _extract_member(self, backup_path, member_name, target_path):
+        # Extrahiert eine Datei oder einen Unterbaum. Mit Katalog und Blockindex wird direkt
+        # zum ersten Member gesprungen und nur bis zum letzten gelesen, sonst sequentiell.
+        member_name = member_name.strip('/')
+        located = self._locate_members(backup_path, member_name)
+        if located is None:
+            self._extract_member_sequential(backup_path, member_name, target_path)
+            return
+
+        members, block = located
+        start_offset = members[0][1]
+        end_offset = members[-1][1]
+        wanted = {path for path, _ in members}
+        # Wie beim vollständigen Restore über den ParallelRestorer, der im Home keinen Links folgt
+        restorer = ParallelRestorer(target_path, self.restore_workers, self.governor)
+        try:
+            with open(backup_path, 'rb') as raw, \
+                    open_reader_at(backup_path, self.governor.reader(raw), block, start_offset) as reader, \
+                    tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in restore_tar_stream(tar, restorer, wanted.__contains__):
+                    # Offsets im Teilstrom sind relativ zum Startpunkt
+                    if start_offset + member.offset >= end_offset:
+                        break
+            restorer.finish()
+        except BaseException:
+            restorer.abort()
+            raise
+
+    def _locate_members(self, backup_path, member_name):
+        # Liefert ([(Pfad, Offset)], Block) oder None, wenn kein Blockindex vorhanden ist
+        user_backup_dir = os.path.dirname(backup_path)
+        if not os.path.exists(os.path.join(user_backup_dir, CATALOG_NAME)):
+            return None
+        try:
+            with self._open_catalog(user_backup_dir) as catalog:
+                name = os.path.basename(backup_path)
+                rows = catalog.members_with_prefix(name, member_name)
+                blocks = catalog.blocks(name)
+        except sqlite3.Error as e:
+            logging.warning(f'Katalog in {user_backup_dir} nicht lesbar: {e}')
+            return None
+        if not rows or not blocks or any(row[3] is None for row in rows):
+            return None
+        members = [(row[0], row[3]) for row in rows]
+        index = bisect.bisect_right([block[0] for block in blocks], members[0][1]) - 1
+        return members, blocks[index]
+
+    def _extract_member_sequential(self, backup_path, member_name, target_path):
+        found = False
+        restorer = ParallelRestorer(target_path, self.restore_workers, self.governor)
+        try:
+            with open_reader(backup_path) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+                for _ in restore_tar_stream(tar, restorer,
+                                            lambda name: name == member_name or name.startswith(member_name + '/')):
+                    found = True
+            restorer.finish()
+        except BaseException:
+            restorer.abort()
+            raise
+        if not found:
+            raise FileNotFoundError(f'{member_name} nicht in {backup_path} gefunden')
 
     def restore_file(self):
         backups = self.backup_manager.list_backups()
@@ -360,4 +1687,132 @@ class BackupManager:
                     print("Wiederherstellung abgebrochen.")
                     return
             except ValueError:
-                print("Ungültige Auswahl. Bitte versuchen Sie es erneut.")
\ No newline at end of file
+                print("Ungültige Auswahl. Bitte versuchen Sie es erneut.")
+
+
+def _check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled('abgebrochen')
+
+
+class _LeaseGuard:
+    # Verhält sich wie das Abbruch-Event eines Jobs und gilt zusätzlich als gesetzt, sobald die Sperre
+    # nicht mehr sicher gehalten wird, damit ein Lauf auch dann vor der nächsten Datei endet
+    def __init__(self, lease, cancel=None):
+        self.lease = lease
+        self.cancel = cancel
+
+    def is_set(self):
+        return not self.lease.held() or (self.cancel is not None and self.cancel.is_set())
+
+
+def _scrub_cost(backup, sample_percent):
+    # Zu lesende Bytes: Archive werden immer ganz gelesen, Snapshots und Chunks ggf. als Stichprobe
+    if backup.get('kind') in ('full', 'delta'):
+        return backup.get('size') or 0
+    return (backup.get('data_size') or backup.get('size') or 0) * sample_percent / 100
+
+
+def _rotation_report(error=None):
+    return {'plans': {}, 'deleted': [], 'errors': {}, 'freed': 0, 'chunks': False, 'error': error}
+
+
+class _ProgressReader:
+    # Leitet Lesezugriffe an die Datei weiter und aktualisiert dabei den Fortschrittsbalken
+    def __init__(self, fileobj, progress_bar):
+        self.fileobj = fileobj
+        self.progress_bar = progress_bar
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress_bar.update(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = self.fileobj.readinto(buffer)
+        self.progress_bar.update(count or 0)
+        return count
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _stat_type(st):
+    if stat.S_ISDIR(st.st_mode):
+        return 'dir'
+    if stat.S_ISLNK(st.st_mode):
+        return 'link'
+    return 'file'
+
+
+def _member_type(member):
+    if member.isdir():
+        return 'dir'
+    if member.issym() or member.islnk():
+        return 'link'
+    return 'file'
+
+
+class _CatalogRecorder:
+    # Schreibt den Suchkatalog während des Backups. Katalogfehler (auch nicht speicherbare Werte) lassen
+    # das Backup nicht scheitern, das Backup wird dann bei der ersten Suche nachträglich indiziert.
+    def __init__(self, backup_path, resume_offset=None):
+        self.catalog = None
+        self.writer = None
+        try:
+            self.catalog = BackupCatalog(os.path.dirname(backup_path))
+            self.writer = self.catalog.writer(os.path.basename(backup_path), resume_offset)
+        except (sqlite3.Error, ValueError) as e:
+            self._disable(e)
+
+    def _disable(self, error):
+        logging.warning(f'Suchkatalog konnte nicht geschrieben werden: {error}')
+        self.writer = None
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+
+    def add(self, arcname, st, offset=None, checksum=None):
+        if self.writer is None:
+            return
+        try:
+            self.writer.add(arcname, _stat_type(st), st.st_size, st.st_mtime, offset, checksum)
+        except (sqlite3.Error, ValueError) as e:
+            self._disable(e)
+
+    def add_blocks(self, blocks):
+        if self.writer is None:
+            return
+        try:
+            self.writer.add_blocks(blocks)
+        except (sqlite3.Error, ValueError) as e:
+            self._disable(e)
+
+    def flush(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.flush()
+        except (sqlite3.Error, ValueError) as e:
+            self._disable(e)
+
+    def finish(self, success, keep=False):
+        # keep: bei einem Abbruch die bisherigen Einträge für eine spätere Fortsetzung behalten
+        if self.writer is None:
+            return
+        try:
+            if success:
+                self.writer.commit()
+            elif keep:
+                self.writer.flush()
+            else:
+                self.writer.abort()
+        except (sqlite3.Error, ValueError) as e:
+            self._disable(e)
+            return
+        self.catalog.close()
+        self.catalog = None
+        self.writer = None
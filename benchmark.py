@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+# Fortschrittsbalken würden die Messungen verfälschen
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+from backup_manager import BackupManager
+from notification_manager import NotificationManager
+
+# Verteilungen der synthetischen Home-Verzeichnisse: (Anteil, minimale Größe, maximale Größe, Verschachtelungstiefe)
+PROFILES = {
+    'dotfiles': [(1.0, 16, 4 * 1024, 3)],
+    'binaries': [(1.0, 8 * 1024 * 1024, 64 * 1024 * 1024, 2)],
+    'deep': [(1.0, 128, 16 * 1024, 24)],
+    'mixed': [
+        (0.85, 16, 4 * 1024, 4),
+        (0.14, 64 * 1024, 1024 * 1024, 8),
+        (0.01, 8 * 1024 * 1024, 32 * 1024 * 1024, 2),
+    ],
+}
+
+
+def generate_tree(home_dir, users, files_per_user, profile, seed):
+    # Reproduzierbarer Baum: gleicher Seed ergibt identische Pfade, Größen und Inhalte
+    rng = random.Random(seed)
+    total_bytes = 0
+    total_files = 0
+    # Halb zufällige, halb wiederholte Daten, damit die Kompression realistisch arbeitet
+    pool = rng.randbytes(1024 * 1024) + bytes(1024 * 1024)
+    for user_index in range(users):
+        user_home = os.path.join(home_dir, f'user{user_index:03d}')
+        os.makedirs(user_home, exist_ok=True)
+        for file_index in range(files_per_user):
+            share, min_size, max_size, depth = _pick_class(rng, PROFILES[profile])
+            parts = [f'.dir{rng.randrange(8)}' if level == 0 else f'd{rng.randrange(4)}'
+                     for level in range(rng.randrange(depth + 1))]
+            directory = os.path.join(user_home, *parts)
+            os.makedirs(directory, exist_ok=True)
+            size = rng.randint(min_size, max_size)
+            path = os.path.join(directory, f'file{file_index:06d}.dat')
+            with open(path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    start = rng.randrange(len(pool) // 2)
+                    piece = pool[start:start + min(remaining, len(pool) // 2)]
+                    f.write(piece)
+                    remaining -= len(piece)
+            total_bytes += size
+            total_files += 1
+    return total_bytes, total_files
+
+
+def _pick_class(rng, classes):
+    value = rng.random()
+    for item in classes:
+        value -= item[0]
+        if value <= 0:
+            return item
+    return classes[-1]
+
+
+def _read_proc_io():
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key.strip()] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _measure_child(connection, operation, args):
+    # Läuft in einem eigenen Prozess, damit Spitzen-RSS und I/O-Zähler je Phase getrennt erfasst werden
+    io_before = _read_proc_io()
+    started = time.perf_counter()
+    try:
+        result = operation(*args)
+        error = None
+    except Exception as e:
+        result = None
+        error = repr(e)
+    elapsed = time.perf_counter() - started
+    io_after = _read_proc_io()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    connection.send({
+        'seconds': elapsed,
+        'peak_rss_kb': max(own.ru_maxrss, children.ru_maxrss),
+        'cpu_seconds': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'read_syscalls': io_after.get('syscr', 0) - io_before.get('syscr', 0),
+        'write_syscalls': io_after.get('syscw', 0) - io_before.get('syscw', 0),
+        'read_bytes': io_after.get('rchar', 0) - io_before.get('rchar', 0),
+        'write_bytes': io_after.get('wchar', 0) - io_before.get('wchar', 0),
+        'result': result,
+        'error': error,
+    })
+    connection.close()
+
+
+def measure(operation, *args):
+    context = multiprocessing.get_context('fork')
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_child, args=(child, operation, args))
+    process.start()
+    child.close()
+    metrics = parent.recv()
+    process.join()
+    return metrics
+
+
+def _manager(nfs_dir, home_dir, compress, retention_days=7):
+    manager = BackupManager(nfs_dir, retention_days, NotificationManager(''), compress)
+    manager.home_dir = home_dir
+    manager.require_mount = False
+    return manager
+
+
+def _op_backup(nfs_dir, home_dir, compress):
+    return _manager(nfs_dir, home_dir, compress).backup_homes()
+
+
+def _op_restore(nfs_dir, home_dir, compress, restore_dir):
+    manager = _manager(nfs_dir, home_dir, compress)
+    backups = manager.list_backups()
+    manager.home_dir = restore_dir
+    return all(manager.restore_backup(backup['path'], backup['user']) for backup in _newest_per_user(backups))
+
+
+def _op_search(nfs_dir, home_dir, compress, query):
+    manager = _manager(nfs_dir, home_dir, compress)
+    return sum(len(manager.search_file_in_backup(backup, query)) for backup in _newest_per_user(manager.list_backups()))
+
+
+def _op_list(nfs_dir, home_dir, compress):
+    return len(_manager(nfs_dir, home_dir, compress).list_backups())
+
+
+def _op_rotate(nfs_dir, home_dir, compress):
+    _manager(nfs_dir, home_dir, compress, retention_days=0).rotate_backups()
+    return len(_manager(nfs_dir, home_dir, compress).list_backups())
+
+
+def _newest_per_user(backups):
+    newest = {}
+    for backup in backups:
+        newest[backup['user']] = backup
+    return list(newest.values())
+
+
+def run_benchmark(work_dir, users, files_per_user, profile, seed, modes, query):
+    home_dir = os.path.join(work_dir, 'home')
+    started = time.perf_counter()
+    total_bytes, total_files = generate_tree(home_dir, users, files_per_user, profile, seed)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'cpu_count': os.cpu_count(),
+            'profile': profile,
+            'seed': seed,
+            'users': users,
+            'files_per_user': files_per_user,
+            'total_files': total_files,
+            'total_bytes': total_bytes,
+            'generate_seconds': time.perf_counter() - started,
+        },
+        'results': {},
+    }
+
+    for mode in modes:
+        compress = '' if mode == 'rsync' else mode
+        if mode == 'rsync' and shutil.which('rsync') is None:
+            report['results'][f'{mode}/backup'] = {'skipped': 'rsync nicht installiert'}
+            continue
+        nfs_dir = os.path.join(work_dir, f'nfs-{mode}')
+        restore_dir = os.path.join(work_dir, f'restore-{mode}')
+        os.makedirs(nfs_dir, exist_ok=True)
+
+        phases = [
+            ('backup', _op_backup, (nfs_dir, home_dir, compress), True),
+            # Zweiter Lauf, damit Rotation und inkrementelle Modi etwas zu tun haben
+            ('backup_second', _op_backup, (nfs_dir, home_dir, compress), True),
+            ('list', _op_list, (nfs_dir, home_dir, compress), False),
+            ('search', _op_search, (nfs_dir, home_dir, compress, query), False),
+            ('restore', _op_restore, (nfs_dir, home_dir, compress, restore_dir), True),
+            ('rotate', _op_rotate, (nfs_dir, home_dir, compress), False),
+        ]
+        for name, operation, args, data_phase in phases:
+            metrics = measure(operation, *args)
+            if data_phase and metrics['seconds'] > 0:
+                metrics['mb_per_second'] = total_bytes / metrics['seconds'] / (1024 * 1024)
+                metrics['files_per_second'] = total_files / metrics['seconds']
+            report['results'][f'{mode}/{name}'] = metrics
+            # Sekunden für das nächste Backup, damit sich die Zeitstempel im Namen unterscheiden
+            if name == 'backup':
+                time.sleep(1)
+        shutil.rmtree(restore_dir, ignore_errors=True)
+    return report
+
+
+def compare(current, baseline):
+    # Verhältnis aktuell/Basis je Phase für Laufzeit, Spitzen-RSS und Systemaufrufe
+    lines = [f"{'Phase':<24}{'Zeit':>10}{'RSS':>10}{'Syscalls':>10}"]
+    for name, metrics in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base or 'seconds' not in metrics or 'seconds' not in base:
+            continue
+        syscalls = metrics['read_syscalls'] + metrics['write_syscalls']
+        base_syscalls = base['read_syscalls'] + base['write_syscalls']
+        lines.append(
+            f"{name:<24}"
+            f"{_ratio(metrics['seconds'], base['seconds']):>10}"
+            f"{_ratio(metrics['peak_rss_kb'], base['peak_rss_kb']):>10}"
+            f"{_ratio(syscalls, base_syscalls):>10}"
+        )
+    return '\n'.join(lines)
+
+
+def _ratio(value, base):
+    if not base:
+        return '-'
+    return f'{value / base:.2f}x'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark für Backup, Restore, Suche, Auflistung und Rotation.')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--files', type=int, default=2000, help='Dateien pro Benutzer')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='mixed')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--modes', default='gzip,rsync', help='Kommagetrennt: gzip, zstd, lz4, rsync')
+    parser.add_argument('--query', default='file0001')
+    parser.add_argument('--work-dir', help='Arbeitsverzeichnis (Standard: temporär, wird gelöscht)')
+    parser.add_argument('--output', help='JSON-Ergebnisdatei (Standard: stdout)')
+    parser.add_argument('--compare', help='Vorheriges Ergebnis zum Vergleich')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='backup-bench-')
+    try:
+        report = run_benchmark(work_dir, args.users, args.files, args.profile, args.seed,
+                               [mode.strip() for mode in args.modes.split(',') if mode.strip()], args.query)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
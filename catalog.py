@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import sqlite3
+from urllib.parse import quote
+
+CATALOG_NAME = '.catalog.sqlite'
+
+SEARCH_MODES = ('substring', 'prefix', 'glob', 'regex')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    backup TEXT NOT NULL,
+    path BLOB NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    offset INTEGER,
+    checksum TEXT,
+    PRIMARY KEY (backup, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE TABLE IF NOT EXISTS blocks (
+    backup TEXT NOT NULL,
+    uncompressed_offset INTEGER NOT NULL,
+    compressed_offset INTEGER NOT NULL,
+    PRIMARY KEY (backup, uncompressed_offset)
+) WITHOUT ROWID;
+'''
+# Version 1: Pfade als Bytes (BLOB) statt als Text
+SCHEMA_VERSION = 1
+
+
+def _regexp(pattern, value):
+    return re.search(pattern, os.fsdecode(value)) is not None
+
+
+class BackupCatalog:
+    # Durchsuchbarer Dateikatalog aller Backups eines Benutzers (SQLite im Backup-Verzeichnis).
+    # Pro Eintrag: Pfad, Typ ('file', 'dir', 'link'), Größe, mtime und Offset des Tar-Headers
+    # im unkomprimierten Datenstrom (nur bei Archiven) sowie die Prüfsumme des Inhalts. Zusätzlich die Blockgrenzen der komprimierten
+    # Archive, über die einzelne Dateien ohne Dekomprimieren des ganzen Archivs gelesen werden.
+    # Pfade werden als Bytes (os.fsencode) gespeichert, damit auch Namen, die kein gültiges UTF-8 sind, erfasst werden.
+    # Mit readonly (Katalog eines anderen Hosts) wird die Datei nur gelesen, da SQLite-Sperren über NFS
+    # unzuverlässig sind; ein veralteter Katalog wird dann nur in einer Kopie im Speicher migriert.
+    def __init__(self, user_backup_dir, readonly=False):
+        self.path = os.path.join(user_backup_dir, CATALOG_NAME)
+        self.readonly = readonly
+        if not readonly:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self._migrate()
+        elif os.path.exists(self.path):
+            self.connection = sqlite3.connect(f'file:{quote(self.path)}?mode=ro', uri=True, timeout=30)
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                source, self.connection = self.connection, sqlite3.connect(':memory:')
+                try:
+                    source.backup(self.connection)
+                finally:
+                    source.close()
+                self._migrate()
+        else:
+            self.connection = sqlite3.connect(':memory:')
+            self._migrate()
+        self.connection.create_function('REGEXP', 2, _regexp, deterministic=True)
+
+    def _migrate(self):
+        self.connection.executescript(_SCHEMA)
+        # Kataloge älterer Versionen kennen noch keine Prüfsummen
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(files)')}
+        if 'checksum' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE files ADD COLUMN checksum TEXT')
+        # Ältere Kataloge speichern Pfade als Text; Text und Bytes sind in SQLite nie gleich
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            with self.connection:
+                self.connection.execute("UPDATE files SET path = CAST(path AS BLOB) WHERE typeof(path) = 'text'")
+                self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def has_backup(self, name):
+        row = self.connection.execute('SELECT 1 FROM backups WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    def writer(self, name, resume_offset=None):
+        return CatalogWriter(self, name, resume_offset)
+
+    def index_backup(self, name, files):
+        # files: iterierbar aus (Pfad, Typ, Größe, mtime, Offset)
+        with self.writer(name) as writer:
+            for path, kind, size, mtime, offset in files:
+                writer.add(path, kind, size, mtime, offset)
+
+    def remove_backups(self, names):
+        with self.connection:
+            for name in names:
+                self.connection.execute('DELETE FROM files WHERE backup = ?', (name,))
+                self.connection.execute('DELETE FROM blocks WHERE backup = ?', (name,))
+                self.connection.execute('DELETE FROM backups WHERE name = ?', (name,))
+
+    def search(self, query, mode='substring', backups=None):
+        # Liefert (Backup, Pfad, Größe, mtime, Offset) aller Nicht-Verzeichnisse, sortiert nach Backup und Pfad
+        if mode == 'substring':
+            condition, params = 'instr(path, ?) > 0', [os.fsencode(query)]
+        elif mode == 'prefix':
+            # Untere Grenze für den Index auf path, der Vergleich der ersten Bytes für den Rest
+            prefix = os.fsencode(query)
+            condition, params = 'path >= ? AND substr(path, 1, ?) = ?', [prefix, len(prefix), prefix]
+        elif mode == 'glob':
+            # GLOB vergleicht nur Text; als Text gelesen behalten beide Seiten ihre Bytes
+            condition, params = 'CAST(path AS TEXT) GLOB CAST(? AS TEXT)', [os.fsencode(query)]
+        elif mode == 'regex':
+            re.compile(query)
+            condition, params = 'path REGEXP ?', [query]
+        else:
+            raise ValueError(f'Unbekannter Suchmodus: {mode}')
+
+        sql = f"SELECT backup, path, size, mtime, offset FROM files WHERE type != 'dir' AND {condition}"
+        if backups is not None:
+            backups = list(backups)
+            sql += f' AND backup IN ({",".join("?" * len(backups))})'
+            params += backups
+        sql += ' ORDER BY backup, path'
+        return [(backup, os.fsdecode(path), size, mtime, offset)
+                for backup, path, size, mtime, offset in self.connection.execute(sql, params)]
+
+    def summary(self, backup):
+        # (Anzahl, Gesamtgröße) der Nicht-Verzeichnisse eines Backups
+        return self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE backup = ? AND type != 'dir'", (backup,)
+        ).fetchone()
+
+    def checksums(self, backup):
+        # Pfad -> (Typ, Größe, Prüfsumme) aller Nicht-Verzeichnisse eines Backups
+        rows = self.connection.execute(
+            "SELECT path, type, size, checksum FROM files WHERE backup = ? AND type != 'dir'", (backup,)
+        )
+        return {os.fsdecode(path): (kind, size, checksum) for path, kind, size, checksum in rows}
+
+    def lookup(self, backup, path):
+        return self.connection.execute(
+            'SELECT type, size, mtime, offset FROM files WHERE backup = ? AND path = ?', (backup, os.fsencode(path))
+        ).fetchone()
+
+    def blocks(self, backup):
+        return self.connection.execute(
+            'SELECT uncompressed_offset, compressed_offset FROM blocks WHERE backup = ? ORDER BY uncompressed_offset',
+            (backup,)
+        ).fetchall()
+
+    def members_with_prefix(self, backup, prefix):
+        # Alle Einträge eines Unterbaums, sortiert nach Offset im Archiv ('0' folgt als Byte direkt auf '/')
+        prefix = os.fsencode(prefix)
+        rows = self.connection.execute(
+            'SELECT path, type, size, offset FROM files WHERE backup = ? AND (path = ? OR (path >= ? AND path < ?)) ORDER BY offset',
+            (backup, prefix, prefix + b'/', prefix + b'0')
+        )
+        return [(os.fsdecode(path), kind, size, offset) for path, kind, size, offset in rows]
+
+
+class CatalogWriter:
+    # Sammelt Einträge während des Backups und schreibt sie blockweise; erst commit() macht das Backup im Katalog sichtbar
+    BATCH_SIZE = 10000
+
+    def __init__(self, catalog, name, resume_offset=None):
+        # resume_offset: bei einem fortgesetzten Archiv bleiben die Einträge vor diesem Offset erhalten
+        self.catalog = catalog
+        self.name = name
+        self._rows = []
+        with catalog.connection:
+            if resume_offset is None:
+                catalog.connection.execute('DELETE FROM files WHERE backup = ?', (name,))
+            else:
+                catalog.connection.execute('DELETE FROM files WHERE backup = ? AND (offset IS NULL OR offset >= ?)',
+                                           (name, resume_offset))
+            catalog.connection.execute('DELETE FROM blocks WHERE backup = ?', (name,))
+            catalog.connection.execute('DELETE FROM backups WHERE name = ?', (name,))
+
+    def add(self, path, kind, size, mtime, offset=None, checksum=None):
+        self._rows.append((self.name, os.fsencode(path), kind, size, mtime, offset, checksum))
+        if len(self._rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self.catalog.connection:
+            self.catalog.connection.executemany(
+                'INSERT OR REPLACE INTO files (backup, path, type, size, mtime, offset, checksum) VALUES (?, ?, ?, ?, ?, ?, ?)', self._rows
+            )
+        self._rows = []
+
+    def add_blocks(self, blocks):
+        with self.catalog.connection:
+            self.catalog.connection.executemany(
+                'INSERT OR REPLACE INTO blocks (backup, uncompressed_offset, compressed_offset) VALUES (?, ?, ?)',
+                [(self.name, uncompressed, compressed) for uncompressed, compressed in blocks]
+            )
+
+    def commit(self):
+        self.flush()
+        with self.catalog.connection:
+            self.catalog.connection.execute(
+                'INSERT OR REPLACE INTO backups (name, indexed_at) VALUES (?, ?)', (self.name, time.time())
+            )
+
+    def abort(self):
+        self._rows = []
+        with self.catalog.connection:
+            self.catalog.connection.execute('DELETE FROM files WHERE backup = ?', (self.name,))
+            self.catalog.connection.execute('DELETE FROM blocks WHERE backup = ?', (self.name,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+# Unfertige Backups liegen versteckt unter '.<Name>.partial' und werden erst nach Abschluss umbenannt,
+# damit list_backups und rotate_backups sie nie als gültiges Backup sehen
+PARTIAL_SUFFIX = '.partial'
+CHECKPOINT_SUFFIX = '.checkpoint'
+JOURNAL_SUFFIX = '.journal'
+RUN_CHECKPOINT_NAME = '.backup_run.json'
+
+# Ein abgebrochener Lauf wird nur innerhalb dieser Zeit fortgesetzt, danach beginnt ein neuer Lauf,
+# damit der nächste geplante Lauf nicht alle bereits gesicherten Benutzer überspringt
+RESUME_MAX_AGE = 12 * 3600
+# Abstand der Checkpoints in unkomprimierten Archivbytes
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+
+
+def partial_path(backup_path):
+    directory, name = os.path.split(backup_path)
+    return os.path.join(directory, f'.{name}{PARTIAL_SUFFIX}')
+
+
+def publish(partial, backup_path):
+    # Erst die Umbenennung macht das Backup sichtbar; sie ist auf demselben Dateisystem atomar
+    os.replace(partial, backup_path)
+    for suffix in (CHECKPOINT_SUFFIX, JOURNAL_SUFFIX):
+        try:
+            os.remove(partial + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunCheckpoint:
+    # Fortschritt eines Laufs pro Host: Zeitstempel des Laufs und bereits fertige Benutzer.
+    # Ein abgebrochener Lauf wird mit demselben Zeitstempel fortgesetzt, sodass unfertige
+    # Backups unter ihrem bisherigen Namen weitergeschrieben werden können.
+    def __init__(self, host_dir):
+        self.path = os.path.join(host_dir, RUN_CHECKPOINT_NAME)
+        self.date_str = None
+        self.started = None
+        self.completed = {}
+        self._lock = threading.Lock()
+
+    def resume_or_start(self, date_str):
+        # Gibt True zurück, wenn ein abgebrochener Lauf fortgesetzt wird
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if time.time() - data['started'] < RESUME_MAX_AGE:
+                self.date_str = data['date_str']
+                self.started = data['started']
+                self.completed = data.get('completed', {})
+                return True
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f'Checkpoint {self.path} ist nicht lesbar und wird verworfen: {e}')
+        self.date_str = date_str
+        self.started = time.time()
+        self.completed = {}
+        self._save()
+        return False
+
+    def mark_done(self, user, result):
+        with self._lock:
+            self.completed[user] = result
+            self._save()
+
+    def finish(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        _write_json(self.path, {'date_str': self.date_str, 'started': self.started, 'completed': self.completed})
+
+
+class ArchiveCheckpoint:
+    # Wiederaufnahmepunkt eines unfertigen Archivs. Das Journal enthält pro geschriebenem Eintrag
+    # eine Zeile [Pfad, Zustand]; der Checkpoint hält die Offsets und die Journallänge zu einem
+    # Zeitpunkt fest, an dem ein Kompressionsblock genau an einer Member-Grenze endet.
+    def __init__(self, partial):
+        self.partial = partial
+        self.path = partial + CHECKPOINT_SUFFIX
+        self.journal_path = partial + JOURNAL_SUFFIX
+        self._journal = None
+
+    def load(self):
+        # Gespeicherter Checkpoint oder None, wenn nicht fortgesetzt werden kann
+        if not os.path.exists(self.partial):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_journal(self, size=None):
+        # Nur Zeilen bis zur Journallänge des Checkpoints, spätere gehören zu verworfenen Daten.
+        # Ohne size wird das ganze Journal gelesen; eine abgeschnittene letzte Zeile wird ignoriert.
+        entries = {}
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read(size) if size is not None else f.read()
+        except FileNotFoundError:
+            return entries
+        for line in data.splitlines():
+            try:
+                arcname, state = json.loads(line)
+            except ValueError:
+                if size is not None:
+                    raise
+                break
+            entries[arcname] = state
+        return entries
+
+    def open_journal(self, size=0, append=False):
+        # size: Journal auf diese Länge kürzen und fortsetzen; append: unverändert fortsetzen
+        if size:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(size)
+        self._journal = open(self.journal_path, 'ab' if size or append else 'wb')
+
+    def record(self, arcname, state):
+        self._journal.write(json.dumps([arcname, state], separators=(',', ':')).encode('utf-8', 'surrogateescape'))
+        self._journal.write(b'\n')
+
+    def sync(self):
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        return self._journal.tell()
+
+    def save(self, data):
+        data['journal_size'] = self.sync()
+        _write_json(self.path, data)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def cleanup_incomplete(user_backup_dir, keep_prefix=None):
+    # Entfernt unfertige Backups und temporäre Dateien abgebrochener Läufe. Unfertige Backups,
+    # deren Name mit keep_prefix beginnt, gehören zum fortgesetzten Lauf und bleiben erhalten.
+    # Gibt die Namen der verworfenen Backups (ohne Präfix und Endung) zurück.
+    removed = []
+    try:
+        names = os.listdir(user_backup_dir)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        base = name
+        for suffix in (CHECKPOINT_SUFFIX, JOURNAL_SUFFIX):
+            if base.endswith(suffix):
+                base = base[:-len(suffix)]
+        is_partial = base.startswith('.') and base.endswith(PARTIAL_SUFFIX)
+        if not (is_partial or name.endswith('.tmp')):
+            continue
+        if is_partial and keep_prefix and base[1:].startswith(keep_prefix):
+            continue
+        path = os.path.join(user_backup_dir, name)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+        logging.info(f'Unvollständiges Backup-Artefakt {path} entfernt.')
+        if is_partial and base == name:
+            removed.append(base[1:-len(PARTIAL_SUFFIX)])
+    return removed
@@ -0,0 +1,198 @@
+import os
+import gzip
+import json
+import time
+import zlib
+import hashlib
+import logging
+import tempfile
+
+from sparse_io import write_skipping_zeros
+
+# Endung der Backup-Indizes im Chunk-Repository
+INDEX_EXTENSION = '.chunks'
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Ein Kandidat wird mit Wahrscheinlichkeit 1/(BOUNDARY_MASK+1) zur Grenze (~1 MiB im Mittel bei Binärdaten)
+BOUNDARY_MASK = 0xFFF
+ANCHOR = b'\xa5'
+WINDOW = 64
+
+# Nullbytes ergeben nie einen Anker, Löcher zerfallen daher in Chunks maximaler Größe mit diesem Digest
+# (sha256 von MAX_CHUNK_SIZE Nullbytes, fest eingetragen, damit der Import nichts berechnen muss)
+ZERO_CHUNK = bytes(MAX_CHUNK_SIZE)
+ZERO_CHUNK_DIGEST = 'bb9f8df61474d25e71fa00722318cd387396ca1736605e1248821cc0de3d3af8'
+
+# Chunks, die jünger sind, werden von der Garbage Collection nicht gelöscht,
+# da sie zu einem noch laufenden Backup gehören können
+GC_GRACE_SECONDS = 24 * 3600
+
+
+def is_chunk_index(path):
+    return path.endswith(INDEX_EXTENSION)
+
+
+def find_cut_point(data, start=0):
+    # Inhaltsdefinierte Grenze: Kandidaten sind Vorkommen des Ankerbytes, die per bytes.find (in C) gefunden werden.
+    # Ein Kandidat wird zur Grenze, wenn die crc32 des davorliegenden Fensters die Maske erfüllt.
+    # Die Grenze hängt nur vom lokalen Inhalt ab und verschiebt sich bei Einfügungen mit den Daten.
+    end = min(len(data), start + MAX_CHUNK_SIZE)
+    pos = start + MIN_CHUNK_SIZE
+    while pos < end:
+        pos = data.find(ANCHOR, pos, end)
+        if pos < 0:
+            break
+        if zlib.crc32(data[pos - WINDOW:pos + 1]) & BOUNDARY_MASK == 0:
+            return pos + 1
+        pos += 1
+    return end
+
+
+def iter_chunks(fileobj):
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = fileobj.read(MAX_CHUNK_SIZE)
+            if not data:
+                eof = True
+                break
+            buffer += data
+        if not buffer:
+            return
+        if eof and len(buffer) <= MIN_CHUNK_SIZE:
+            cut = len(buffer)
+        else:
+            cut = find_cut_point(buffer)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+class ChunkStore:
+    # Inhaltsadressierter Speicher: jeder Chunk liegt genau einmal unter objects/<xx>/<sha256>
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self._object_path(digest))
+
+    def put_chunk(self, data):
+        # Gibt (Digest, neu geschrieben) zurück; vorhandene Chunks werden nicht erneut geschrieben
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            # Zeitstempel auffrischen, damit eine parallel laufende GC den Chunk nicht als verwaist löscht
+            try:
+                os.utime(path)
+                return digest, False
+            except FileNotFoundError:
+                pass
+
+        compressed = zlib.compress(data, 3)
+        payload = b'Z' + compressed if len(compressed) < len(data) else b'R' + data
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Atomar veröffentlichen, damit parallele Backups nie einen halben Chunk sehen
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return digest, True
+
+    def get_chunk(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            payload = f.read()
+        data = zlib.decompress(payload[1:]) if payload[:1] == b'Z' else payload[1:]
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f'Chunk {digest} ist beschädigt')
+        return data
+
+    def store_file(self, path, wrap_reader=None):
+        # Gibt die Chunk-Liste und die Anzahl neu gespeicherter Bytes zurück
+        chunks = []
+        new_bytes = 0
+        with open(path, 'rb') as f:
+            for data in iter_chunks(wrap_reader(f) if wrap_reader else f):
+                digest, created = self.put_chunk(data)
+                chunks.append(digest)
+                if created:
+                    new_bytes += len(data)
+        return chunks, new_bytes
+
+    def write_file(self, chunks, target, sparse=False):
+        # Bei Sparse-Dateien werden Nullblöcke übersprungen und bleiben Löcher.
+        # Der Null-Chunk wird nie aus dem Store gelesen.
+        with open(target, 'wb') as f:
+            for digest in chunks:
+                data = ZERO_CHUNK if digest == ZERO_CHUNK_DIGEST else self.get_chunk(digest)
+                if sparse:
+                    write_skipping_zeros(f, data)
+                else:
+                    f.write(data)
+            f.truncate()
+
+    def collect_garbage(self, index_paths, check=None):
+        # Mark-and-Sweep: alle von den übrigen Indizes referenzierten Chunks markieren, den Rest löschen.
+        # check() wird vor jedem Präfixverzeichnis aufgerufen und bricht die Bereinigung ab, indem es wirft.
+        started = time.time()
+        referenced = set()
+        for index_path in index_paths:
+            for entry in read_index(index_path):
+                referenced.update(entry.get('chunks', ()))
+
+        removed = 0
+        freed = 0
+        if not os.path.isdir(self.objects_dir):
+            return removed, freed
+        for prefix in os.listdir(self.objects_dir):
+            if check is not None:
+                check()
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            with os.scandir(prefix_dir) as it:
+                for entry in it:
+                    if entry.name in referenced:
+                        continue
+                    st = entry.stat()
+                    if st.st_mtime > started - GC_GRACE_SECONDS:
+                        continue
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    removed += 1
+                    freed += st.st_size
+        logging.info(f'Chunk-GC: {removed} Chunks gelöscht, {freed} Bytes freigegeben.')
+        return removed, freed
+
+
+def write_index(index_path, entries):
+    # Index als gzip-komprimierte JSON-Zeilen, atomar veröffentlicht
+    tmp_path = f'{index_path}.tmp'
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(',', ':')))
+                f.write('\n')
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_index(index_path):
+    with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
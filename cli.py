@@ -1,37 +1,25 @@
-import os
-import shutil
-import subprocess
-import logging
-from datetime import datetime, timedelta
-import argparse
-import configparser
 import sys
-import time
-import threading
-import requests
-from tqdm import tqdm  # Fortschrittsbalken-Bibliothek
-import tarfile
-from colorama import init, Fore, Style
-import socket
+from datetime import datetime
+from colorama import Fore, Style
 
 from config_manager import ConfigManager
-from backup_manager import BackupManager
+from backup_manager import ALL_HOSTS, BackupManager
 from notification_manager import NotificationManager
 from scheduler import Scheduler
+from jobs import JobQueue
+from compression import check_codec_available, parse_codec
 
 class CLI:
     def __init__(self):
         self.config = ConfigManager()
         self.notifier = NotificationManager(self.config.discord_webhook_url)
-        self.backup_manager = BackupManager(
-            self.config.nfs_mount_point,
-            self.config.retention_days,
-            self.notifier,
-            self.config.compress_backups
-        )
+        self.backup_manager = BackupManager.from_config(self.config, self.notifier)
+        # Backup, Restore und Wartung laufen als Jobs im Hintergrund, das Menü bleibt bedienbar
+        self.jobs = JobQueue.from_config(self.config, self.backup_manager).start()
         self.scheduler = Scheduler(
             self.backup_manager,
-            datetime.strptime(f"{self.config.backup_hour}:{self.config.backup_minute}", '%H:%M').time()
+            datetime.strptime(f"{self.config.backup_hour}:{self.config.backup_minute}", '%H:%M').time(),
+            self.jobs
         )
         self.scheduler.start()
         self.main_menu()
@@ -44,7 +32,9 @@ class CLI:
             print("3. Restore durchführen")
             print("4. Datei wiederherstellen")
             print("5. Einstellungen")
-            print("6. Beenden")
+            print("6. Repository (alle Hosts)")
+            print("7. Jobs")
+            print("8. Beenden")
             choice = input("Bitte wählen Sie eine Option: ")
 
             if choice == '1':
@@ -58,19 +48,20 @@ class CLI:
             elif choice == '5':
                 self.settings_menu()
             elif choice == '6':
+                self.repository_menu()
+            elif choice == '7':
+                self.jobs_menu()
+            elif choice == '8':
                 self.exit_program()
             else:
                 print(Fore.RED + "Ungültige Auswahl. Bitte versuchen Sie es erneut." + Style.RESET_ALL)
 
 
     def start_backup(self):
-        print(Fore.GREEN + "\nBackup wird gestartet..." + Style.RESET_ALL)
-        success = self.backup_manager.backup_homes()
-        if success:
-            self.backup_manager.rotate_backups()
-            print(Fore.GREEN + "Backup abgeschlossen." + Style.RESET_ALL)
-        else:
-            print(Fore.RED + "Backup fehlgeschlagen. Siehe Logs für Details." + Style.RESET_ALL)
+        backup = self.jobs.submit('backup', source='cli')
+        rotate = self.jobs.submit('rotate', source='cli')
+        print(Fore.GREEN + f"\nBackup (Job #{backup.id}) und Rotation (Job #{rotate.id}) eingereiht. "
+              "Status unter Menüpunkt 7." + Style.RESET_ALL)
 
 
     def configure_scheduler(self):
@@ -85,7 +76,8 @@ class CLI:
         self.scheduler.stop()
         self.scheduler = Scheduler(
             self.backup_manager,
-            datetime.strptime(f"{self.config.backup_hour}:{self.config.backup_minute}", '%H:%M').time()
+            datetime.strptime(f"{self.config.backup_hour}:{self.config.backup_minute}", '%H:%M').time(),
+            self.jobs
         )
         self.scheduler.start()
         print("Automatische Backups wurden aktualisiert.")
@@ -125,8 +117,11 @@ class CLI:
 
         print(f"\nVerfügbare Backups für Benutzer {selected_user}:")
         for idx, backup in enumerate(user_backups, 1):
-            size = os.path.getsize(backup['path']) / (1024 * 1024)  # Größe in MB
-            print(f"{idx}. {backup['backup']} ({size:.2f} MB)")
+            # Größe aus dem Backup-Bestand; unbekannt bei nachträglich gefundenen Verzeichnis-Snapshots
+            if backup.get('size') is None:
+                print(f"{idx}. {backup['backup']} (Größe unbekannt)")
+            else:
+                print(f"{idx}. {backup['backup']} ({backup['size'] / (1024 * 1024):.2f} MB)")
         print("0. Abbrechen")
 
         while True:
@@ -141,11 +136,10 @@ class CLI:
                 selected_backup = user_backups[backup_idx]
                 confirm = input(f"Sind Sie sicher, dass Sie das Backup '{selected_backup['backup']}' wiederherstellen möchten? (ja/nein): ")
                 if confirm.lower() == 'ja':
-                    success = self.backup_manager.restore_backup(selected_backup['path'], selected_user)
-                    if success:
-                        print("Restore erfolgreich abgeschlossen.")
-                    else:
-                        print("Restore fehlgeschlagen. Siehe Logs für Details.")
+                    # Ein Restore hat Vorrang und wartet nicht auf ein laufendes Backup
+                    job = self.jobs.submit('restore', {'backup_path': selected_backup['path'], 'user': selected_user},
+                                           source='cli')
+                    print(f"Restore als Job #{job.id} eingereiht. Status unter Menüpunkt 7.")
                     return
                 else:
                     print("Wiederherstellung abgebrochen.")
@@ -170,8 +164,9 @@ class CLI:
             if idx < 0 or idx >= len(backups):
                 raise ValueError
             backup_name = backups[idx]
-            search_query = input("Bitte geben Sie den Dateinamen oder einen Teil davon ein: ")
-            matching_files = self.backup_manager.search_file_in_backup(backup_name, search_query)
+            search_query = input("Bitte geben Sie den Dateinamen oder einen Teil davon ein (Platzhalter * ? erlaubt, 're:' für reguläre Ausdrücke, 'prefix:' für Pfadanfänge): ")
+            search_query, mode = self.parse_search_query(search_query)
+            matching_files = self.backup_manager.search_file_in_backup(backup_name, search_query, mode)
             if not matching_files:
                 print("Keine passenden Dateien gefunden.")
                 return
@@ -187,21 +182,127 @@ class CLI:
             file_path = matching_files[file_idx]
             confirm = input(f"Sind Sie sicher, dass Sie die Datei '{file_path}' wiederherstellen möchten? (ja/nein): ")
             if confirm.lower() == 'ja':
-                success = self.backup_manager.restore_file_from_backup(backup_name, file_path)
-                if success:
-                    print("Datei erfolgreich wiederhergestellt.")
-                else:
-                    print("Wiederherstellung fehlgeschlagen. Siehe Logs für Details.")
+                job = self.jobs.submit('restore_file', {'backup_path': backup_name['path'], 'user': backup_name['user'],
+                                                        'file_path': file_path}, source='cli')
+                print(f"Wiederherstellung als Job #{job.id} eingereiht. Status unter Menüpunkt 7.")
         except ValueError:
             print("Ungültige Auswahl.")
 
+    def parse_search_query(self, search_query):
+        if search_query.startswith('re:'):
+            return search_query[3:], 'regex'
+        if search_query.startswith('prefix:'):
+            return search_query[7:], 'prefix'
+        if any(char in search_query for char in '*?['):
+            return search_query, 'glob'
+        return search_query, 'substring'
+
+    def repository_menu(self):
+        # Übersicht und Wartung aller Hosts, die auf dasselbe NFS-Share sichern
+        while True:
+            print("\nRepository (alle Hosts):")
+            print("1. Backups aller Hosts anzeigen")
+            print("2. In allen Hosts suchen")
+            print("3. Alte Backups aller Hosts rotieren")
+            print("4. Backups aller Hosts prüfen")
+            print("5. Zurück zum Hauptmenü")
+            choice = input("Bitte wählen Sie eine Option: ")
+
+            if choice == '1':
+                self.list_all_hosts()
+            elif choice == '2':
+                self.search_all_hosts()
+            elif choice == '3':
+                # Zuerst den Plan anzeigen, gelöscht wird erst nach Bestätigung
+                reports = self.backup_manager.rotate_all_hosts(dry_run=True)
+                if not self.print_rotation_plan(reports):
+                    print("Keine Backups zu löschen.")
+                    continue
+                confirm = input("Diese Backups jetzt löschen? (ja/nein): ")
+                if confirm.lower() == 'ja':
+                    job = self.jobs.submit('rotate', {'all_hosts': True}, source='cli')
+                    print(f"Rotation als Job #{job.id} eingereiht. Status unter Menüpunkt 7 im Hauptmenü.")
+            elif choice == '4':
+                # Das Ergebnis steht nach Abschluss im Status des Jobs
+                job = self.jobs.submit('verify', {'host': ALL_HOSTS}, source='cli')
+                print(f"Prüfung als Job #{job.id} eingereiht. Status unter Menüpunkt 7 im Hauptmenü.")
+            elif choice == '5':
+                break
+            else:
+                print("Ungültige Auswahl.")
+
+    def jobs_menu(self):
+        while True:
+            jobs = self.jobs.status()
+            print("\nJobs (neueste zuerst):")
+            if not jobs:
+                print("Keine Jobs.")
+            colors = {'running': Fore.BLUE, 'done': Fore.GREEN, 'failed': Fore.RED, 'cancelled': Fore.YELLOW}
+            for job in jobs[:20]:
+                submitted = datetime.fromtimestamp(job['submitted']).strftime('%d.%m. %H:%M')
+                target = job['params'].get('user') or job['params'].get('backup_path') or ''
+                detail = f" - {job['detail']}" if job['detail'] else ''
+                print(colors.get(job['state'], '') + f"#{job['id']} {submitted} {job['kind']} {target} "
+                      f"[{job['state']}]{detail}" + Style.RESET_ALL)
+            choice = input("Job-Nummer zum Abbrechen, Enter zum Aktualisieren, 0 für zurück: ").strip().lstrip('#')
+            if choice == '0':
+                break
+            if not choice:
+                continue
+            try:
+                job_id = int(choice)
+            except ValueError:
+                print("Ungültige Auswahl.")
+                continue
+            if self.jobs.cancel(job_id):
+                print(f"Job #{job_id} wird abgebrochen.")
+            else:
+                print(f"Job #{job_id} läuft nicht oder ist bereits beendet.")
+
+    def print_rotation_plan(self, reports):
+        # Gibt die Anzahl der zu löschenden Backups zurück
+        total = 0
+        for host, report in sorted(reports.items()):
+            if report['error']:
+                print(Fore.RED + f"{host}: {report['error']}" + Style.RESET_ALL)
+            for user, plan in sorted(report['plans'].items()):
+                print(Fore.BLUE + f"\n{host}/{user}: {len(plan.keep)} behalten, {len(plan.delete)} löschen" + Style.RESET_ALL)
+                for name, reasons in sorted(plan.keep.items()):
+                    print(f"  behalten: {name} ({', '.join(reasons)})")
+                for backup in plan.delete:
+                    print(Fore.YELLOW + f"  löschen:  {backup['backup']}" + Style.RESET_ALL)
+                total += len(plan.delete)
+        return total
+
+    def list_all_hosts(self):
+        backups = self.backup_manager.list_backups(host=ALL_HOSTS)
+        if not backups:
+            print("Keine Backups verfügbar.")
+            return
+        for host in sorted(set(b['host'] for b in backups)):
+            host_backups = [b for b in backups if b['host'] == host]
+            total = sum(b['size'] or 0 for b in host_backups)
+            print(Fore.BLUE + f"\n{host}: {len(host_backups)} Backups, {total / (1024 * 1024):.2f} MB" + Style.RESET_ALL)
+            for backup in host_backups:
+                print(f"  {backup['user']}: {backup['backup']}")
+
+    def search_all_hosts(self):
+        search_query = input("Bitte geben Sie den Dateinamen oder einen Teil davon ein: ")
+        search_query, mode = self.parse_search_query(search_query)
+        matches = self.backup_manager.search_all_hosts(search_query, mode)
+        if not matches:
+            print("Keine passenden Dateien gefunden.")
+            return
+        for match in matches:
+            print(f"{match['host']}/{match['user']}/{match['backup']}: {match['path']}")
+
     def settings_menu(self):
         while True:
             print("\nEinstellungen:")
             print(f"1. NFS-Mount-Punkt: {self.config.nfs_mount_point}")
             print(f"2. Aufbewahrungszeit in Tagen: {self.config.retention_days}")
             print(f"3. Discord Webhook URL: {'[gesetzt]' if self.config.discord_webhook_url else '[nicht gesetzt]'}")
-            print(f"4. Backups komprimieren: {'Ja' if self.config.compress_backups else 'Nein'}")
+            print(f"4. Backups komprimieren: {self.config.compress_backups or 'Nein'}")
             print("5. Zurück zum Hauptmenü")
             choice = input("Bitte wählen Sie eine Option zum Ändern: ")
 
@@ -243,18 +344,27 @@ class CLI:
             print("Discord Benachrichtigungen deaktiviert.")
 
     def toggle_compression(self):
-        compress = input(f"Backups komprimieren? (ja/nein) [{'ja' if self.config.compress_backups else 'nein'}]: ")
-        if compress.lower() == 'ja':
-            self.config.compress_backups = True
-        else:
-            self.config.compress_backups = False
+        current = self.config.compress_backups or 'nein'
+        compress = input(f"Backups komprimieren? (nein/gzip/zstd/lz4) [{current}]: ") or current
+        try:
+            self.config.compress_backups = parse_codec(compress)
+            check_codec_available(self.config.compress_backups)
+        except (ValueError, RuntimeError) as e:
+            print(Fore.RED + str(e) + Style.RESET_ALL)
+            return
         self.config.save_config()
         self.backup_manager.compress_backups = self.config.compress_backups
-        print(f"Komprimierung {'aktiviert' if self.config.compress_backups else 'deaktiviert'}.")
+        if self.config.compress_backups:
+            print(f"Komprimierung mit {self.config.compress_backups} aktiviert.")
+        else:
+            print("Komprimierung deaktiviert.")
 
     def exit_program(self):
         confirm = input("Sind Sie sicher, dass Sie das Programm beenden möchten? (ja/nein): ")
         if confirm.lower() == 'ja':
             print("Programm wird beendet.")
             self.scheduler.stop()
+            if any(job['state'] == 'running' for job in self.jobs.status()):
+                print("Warte auf laufende Jobs; wartende Jobs werden beim nächsten Start ausgeführt.")
+            self.jobs.stop()
             sys.exit()
\ No newline at end of file
@@ -0,0 +1,230 @@
+import os
+import gzip
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Endungen der Archivformate je Codec
+ARCHIVE_EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+    'lz4': '.tar.lz4',
+}
+
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+    'lz4': 0,
+}
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def parse_codec(value):
+    # 'yes' bleibt aus Kompatibilitätsgründen gleichbedeutend mit gzip, 'no' schaltet die Kompression ab
+    value = (value or '').strip().lower()
+    if value in ('', 'no', 'nein', 'none'):
+        return ''
+    if value in ('yes', 'ja'):
+        return 'gzip'
+    if value not in ARCHIVE_EXTENSIONS:
+        raise ValueError(f'Unbekannter Kompressions-Codec: {value}')
+    return value
+
+
+def archive_extension(codec):
+    return ARCHIVE_EXTENSIONS[codec]
+
+
+def codec_for_path(path):
+    for codec, extension in ARCHIVE_EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+def is_archive(path):
+    return codec_for_path(path) is not None
+
+
+def strip_backup_extension(name):
+    codec = codec_for_path(name)
+    if codec:
+        return name[:-len(ARCHIVE_EXTENSIONS[codec])]
+    return name
+
+
+def check_codec_available(codec):
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError("Für zstd-Kompression wird das Paket 'zstandard' benötigt.")
+    if codec == 'lz4' and lz4 is None:
+        raise RuntimeError("Für lz4-Kompression wird das Paket 'lz4' benötigt.")
+
+
+class BlockCompressWriter:
+    # Teilt den Datenstrom in Blöcke und komprimiert sie parallel in einem Thread-Pool.
+    # Jeder Block wird als eigenständiges gzip-Member bzw. zstd-/lz4-Frame geschrieben,
+    # die Verkettung ist für gzip, zstd und lz4 ein gültiger Datenstrom.
+    # zlib, zstd und lz4 geben das GIL während der Kompression frei.
+    # blocks enthält für jeden Block (Offset unkomprimiert, Offset komprimiert) und erlaubt
+    # damit das Lesen ab einer beliebigen Blockgrenze.
+    def __init__(self, fileobj, codec, level=None, threads=0, block_size=BLOCK_SIZE, resume=None):
+        # resume: (Offset unkomprimiert, Offset komprimiert, bisherige Blöcke) eines fortgesetzten Archivs
+        check_codec_available(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._uncompressed_offset = 0
+        self._compressed_offset = 0
+        self.blocks = []
+        if resume is not None:
+            self._uncompressed_offset, self._compressed_offset, blocks = resume
+            self.blocks = [tuple(block) for block in blocks]
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='compress')
+        self.closed = False
+        # Fehler beim Schreiben der Zieldatei; danach ist das Archiv unbrauchbar
+        self.error = None
+        # Gemessene Zeiten: Kompression summiert über alle Threads, fsync an Blockgrenzen
+        self.compress_seconds = 0.0
+        self.fsync_seconds = 0.0
+        self._time_lock = threading.Lock()
+
+    def _compress_block(self, block):
+        start = time.perf_counter()
+        data = self._compress(block)
+        with self._time_lock:
+            self.compress_seconds += time.perf_counter() - start
+        return data
+
+    def _compress(self, block):
+        if self.codec == 'gzip':
+            return gzip.compress(block, compresslevel=self.level, mtime=0)
+        if self.codec == 'zstd':
+            # ZstdCompressor ist nicht threadsicher, daher eine Instanz pro Thread
+            compressor = getattr(self._local, 'compressor', None)
+            if compressor is None:
+                compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+            return compressor.compress(block)
+        return lz4.frame.compress(block, compression_level=self.level)
+
+    def _submit(self, block):
+        self._pending.append((self._uncompressed_offset, self._executor.submit(self._compress_block, block)))
+        self._uncompressed_offset += len(block)
+        # Begrenzte Anzahl ausstehender Blöcke hält den Speicherbedarf konstant
+        while len(self._pending) > self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        uncompressed_offset, future = self._pending.popleft()
+        data = future.result()
+        self.blocks.append((uncompressed_offset, self._compressed_offset))
+        try:
+            self.fileobj.write(data)
+        except OSError as e:
+            self.error = e
+            raise
+        self._compressed_offset += len(data)
+
+    def flush_block(self):
+        # Schließt den aktuellen Block ab und schreibt alle ausstehenden Blöcke dauerhaft;
+        # danach endet die Datei genau am Ende der bisher geschriebenen Daten
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_next()
+        start = time.perf_counter()
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.fsync_seconds += time.perf_counter() - start
+        return self._uncompressed_offset, self._compressed_offset
+
+    def tell(self):
+        # Position im unkomprimierten Datenstrom
+        return self._uncompressed_offset + len(self._buffer)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_next()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_writer(path, codec, level=None, threads=0, wrap=None, resume=None):
+    # wrap kann das Rohdateiobjekt umhüllen, z. B. um die Schreibrate zu begrenzen.
+    # Mit resume wird die Datei auf den komprimierten Offset gekürzt und dort fortgesetzt.
+    if resume is not None:
+        fileobj = open(path, 'r+b')
+        fileobj.truncate(resume[1])
+        fileobj.seek(resume[1])
+    else:
+        fileobj = open(path, 'wb')
+    return BlockCompressWriter(wrap(fileobj) if wrap else fileobj, codec, level, threads, resume=resume)
+
+
+def open_reader_at(path, fileobj, block, offset):
+    # Liest ab dem unkomprimierten Offset `offset`; block ist der Eintrag (unkomprimiert, komprimiert)
+    # des Blocks, in dem der Offset liegt. Nur die Daten ab diesem Block werden dekomprimiert.
+    fileobj.seek(block[1])
+    reader = open_reader(path, fileobj)
+    remaining = offset - block[0]
+    while remaining > 0:
+        data = reader.read(min(remaining, BLOCK_SIZE))
+        if not data:
+            raise EOFError(f'Offset {offset} liegt hinter dem Ende von {path}')
+        remaining -= len(data)
+    return reader
+
+
+def open_reader(path, fileobj=None):
+    # Wird ein geöffnetes Rohdateiobjekt übergeben (z. B. für Fortschrittsanzeigen), bleibt der Aufrufer dafür zuständig
+    codec = codec_for_path(path)
+    if codec is None:
+        raise ValueError(f'Kein bekanntes Archivformat: {path}')
+    check_codec_available(codec)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb') if fileobj is None else gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if codec == 'zstd':
+        closefd = fileobj is None
+        if fileobj is None:
+            fileobj = open(path, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=closefd)
+    return lz4.frame.open(path, 'rb') if fileobj is None else lz4.frame.LZ4FrameFile(fileobj, 'rb')
@@ -1,6 +1,8 @@
 import configparser
 import os
 
+from compression import parse_codec
+
 class ConfigManager:
     def __init__(self, config_file='backup_config.ini'):
         self.config_file = config_file
@@ -16,7 +18,49 @@ class ConfigManager:
             'backup_hour': '2',
             'backup_minute': '0',
             'discord_webhook_url': '',
-            'compress_backups': 'no'
+            'compress_backups': 'no',
+            'backup_workers': '1',
+            'max_io_jobs': '0',
+            'compression_level': '',
+            'compression_threads': '0',
+            'incremental_snapshots': 'no',
+            'incremental_archives': 'no',
+            'full_backup_interval': '6',
+            'dedup_backups': 'no',
+            'restore_workers': '4',
+            'skip_unchanged': 'no',
+            'snapshot_provider': '',
+            'snapshot_size': '',
+            'read_bandwidth_limit': '0',
+            'write_bandwidth_limit': '0',
+            'adaptive_throttle': 'no',
+            'nice_level': '0',
+            'io_class': '',
+            'io_level': '4',
+            'maintenance_workers': '4',
+            'lease_timeout': '600',
+            'keep_daily': '0',
+            'keep_weekly': '0',
+            'keep_monthly': '0',
+            'keep_yearly': '0',
+            'scrub_budget_gb': '0',
+            'scrub_sample_percent': '100',
+            'metrics_textfile': '/var/lib/prometheus/node-exporter/homebackup.prom',
+            'metrics_json_dir': 'reports',
+            'daemon_interval': '15',
+            'dirty_state_file': 'dirty_paths.json',
+            'jobs_file': 'jobs.json',
+            'nfs_jobs': '2',
+            'cpu_jobs': '1',
+            'disk_jobs': '2'
+        }
+        # Ein- und Ausschlussregeln des Hosts; Regeln einzelner Benutzer in Abschnitten [filters:<benutzer>]
+        self.config['filters'] = {
+            'exclude': '\n.cache/\n.local/share/Trash/\nnode_modules/\n*.tmp',
+            'include': '',
+            'max_file_size_mb': '0',
+            'max_age_days': '0',
+            'exclude_caches': 'yes'
         }
         with open(self.config_file, 'w') as configfile:
             self.config.write(configfile)
@@ -25,17 +69,115 @@ class ConfigManager:
         self.config.read(self.config_file)
         self.nfs_mount_point = self.config['DEFAULT']['nfs_mount_point']
         self.retention_days = int(self.config['DEFAULT']['retention_days'])
+        # Großvater-Vater-Sohn: zusätzlich das neueste Backup der letzten N Tage, Wochen, Monate und Jahre
+        self.keep_daily = int(self.config['DEFAULT'].get('keep_daily', '0'))
+        self.keep_weekly = int(self.config['DEFAULT'].get('keep_weekly', '0'))
+        self.keep_monthly = int(self.config['DEFAULT'].get('keep_monthly', '0'))
+        self.keep_yearly = int(self.config['DEFAULT'].get('keep_yearly', '0'))
         self.backup_hour = int(self.config['DEFAULT']['backup_hour'])
         self.backup_minute = int(self.config['DEFAULT']['backup_minute'])
         self.discord_webhook_url = self.config['DEFAULT'].get('discord_webhook_url', '')
-        self.compress_backups = self.config['DEFAULT'].get('compress_backups', 'no').lower() == 'yes'
+        # 'yes' entspricht gzip, alternativ 'zstd' oder 'lz4'
+        self.compress_backups = parse_codec(self.config['DEFAULT'].get('compress_backups', 'no'))
+        compression_level = self.config['DEFAULT'].get('compression_level', '').strip()
+        self.compression_level = int(compression_level) if compression_level else None
+        self.compression_threads = int(self.config['DEFAULT'].get('compression_threads', '0'))
+        self.incremental_snapshots = self.config['DEFAULT'].get('incremental_snapshots', 'no').lower() == 'yes'
+        self.incremental_archives = self.config['DEFAULT'].get('incremental_archives', 'no').lower() == 'yes'
+        self.full_backup_interval = int(self.config['DEFAULT'].get('full_backup_interval', '6'))
+        self.dedup_backups = self.config['DEFAULT'].get('dedup_backups', 'no').lower() == 'yes'
+        self.restore_workers = int(self.config['DEFAULT'].get('restore_workers', '4'))
+        self.skip_unchanged = self.config['DEFAULT'].get('skip_unchanged', 'no').lower() == 'yes'
+        # Leer = kein Snapshot, sonst 'auto', 'btrfs', 'lvm', 'zfs' oder 'directory'
+        self.snapshot_provider = self.config['DEFAULT'].get('snapshot_provider', '').strip().lower()
+        self.snapshot_size = self.config['DEFAULT'].get('snapshot_size', '').strip()
+        # Bandbreitenlimits in MB/s (0 = unbegrenzt)
+        self.read_bandwidth_limit = int(self.config['DEFAULT'].get('read_bandwidth_limit', '0'))
+        self.write_bandwidth_limit = int(self.config['DEFAULT'].get('write_bandwidth_limit', '0'))
+        self.adaptive_throttle = self.config['DEFAULT'].get('adaptive_throttle', 'no').lower() == 'yes'
+        self.nice_level = int(self.config['DEFAULT'].get('nice_level', '0'))
+        # Leer = unverändert, sonst 'best-effort' oder 'idle'
+        self.io_class = self.config['DEFAULT'].get('io_class', '').strip().lower()
+        self.io_level = int(self.config['DEFAULT'].get('io_level', '4'))
+        self.backup_workers = int(self.config['DEFAULT'].get('backup_workers', '1'))
+        self.max_io_jobs = int(self.config['DEFAULT'].get('max_io_jobs', '0'))
+        # Parallelität der Wartung über alle Hosts und Gültigkeit der Sperrdateien in Sekunden
+        self.maintenance_workers = int(self.config['DEFAULT'].get('maintenance_workers', '4'))
+        self.lease_timeout = int(self.config['DEFAULT'].get('lease_timeout', '600'))
+        # Rollierende Prüfung nach jedem Lauf: gelesene GB pro Lauf (0 = aus), Stichprobe in Prozent
+        self.scrub_budget_gb = int(self.config['DEFAULT'].get('scrub_budget_gb', '0'))
+        self.scrub_sample_percent = int(self.config['DEFAULT'].get('scrub_sample_percent', '100'))
+        # Export der Laufmetriken: Textdatei für den node-exporter und Verzeichnis für JSON-Berichte (leer = aus)
+        self.metrics_textfile = self.config['DEFAULT'].get('metrics_textfile', '/var/lib/prometheus/node-exporter/homebackup.prom').strip()
+        self.metrics_json_dir = self.config['DEFAULT'].get('metrics_json_dir', 'reports').strip()
+        # Daemon-Modus: Mindestabstand der Läufe über gemeldete Änderungen (Minuten) und Zustandsdatei der Änderungsverfolgung
+        self.daemon_interval = int(self.config['DEFAULT'].get('daemon_interval', '15'))
+        self.dirty_state_file = self.config['DEFAULT'].get('dirty_state_file', 'dirty_paths.json').strip()
+        # Job-Warteschlange: Zustandsdatei und gleichzeitige Jobs je Ressource (NFS-Share, CPU, lokale Platte)
+        self.jobs_file = self.config['DEFAULT'].get('jobs_file', 'jobs.json').strip()
+        self.nfs_jobs = int(self.config['DEFAULT'].get('nfs_jobs', '2'))
+        self.cpu_jobs = int(self.config['DEFAULT'].get('cpu_jobs', '1'))
+        self.disk_jobs = int(self.config['DEFAULT'].get('disk_jobs', '2'))
+        # Filterregeln: [filters] für den Host, [filters:<benutzer>] ergänzt bzw. überschreibt sie je Benutzer
+        self.filters = self._read_filters('filters', {'max_file_size_mb': 0, 'max_age_days': 0, 'exclude_caches': False})
+        self.user_filters = {section.split(':', 1)[1]: self._read_filters(section)
+                             for section in self.config.sections() if section.startswith('filters:')}
+
+    def _read_filters(self, section, defaults=None):
+        # Muster stehen zeilenweise (mehrzeiliger Wert); fehlende Grenzen übernimmt der Benutzer vom Host
+        filters = dict(defaults or {})
+        if not self.config.has_section(section):
+            return filters
+        options = self.config[section]
+        for key in ('exclude', 'include'):
+            filters[key] = [line.strip() for line in options.get(key, '').splitlines() if line.strip()]
+        for key in ('max_file_size_mb', 'max_age_days'):
+            if options.get(key, '').strip():
+                filters[key] = int(options[key])
+        if options.get('exclude_caches', '').strip():
+            filters['exclude_caches'] = options['exclude_caches'].strip().lower() == 'yes'
+        return filters
 
     def save_config(self):
         self.config['DEFAULT']['nfs_mount_point'] = self.nfs_mount_point
         self.config['DEFAULT']['retention_days'] = str(self.retention_days)
+        self.config['DEFAULT']['keep_daily'] = str(self.keep_daily)
+        self.config['DEFAULT']['keep_weekly'] = str(self.keep_weekly)
+        self.config['DEFAULT']['keep_monthly'] = str(self.keep_monthly)
+        self.config['DEFAULT']['keep_yearly'] = str(self.keep_yearly)
         self.config['DEFAULT']['backup_hour'] = str(self.backup_hour)
         self.config['DEFAULT']['backup_minute'] = str(self.backup_minute)
         self.config['DEFAULT']['discord_webhook_url'] = self.discord_webhook_url
-        self.config['DEFAULT']['compress_backups'] = 'yes' if self.compress_backups else 'no'
+        self.config['DEFAULT']['compress_backups'] = self.compress_backups or 'no'
+        self.config['DEFAULT']['compression_level'] = '' if self.compression_level is None else str(self.compression_level)
+        self.config['DEFAULT']['compression_threads'] = str(self.compression_threads)
+        self.config['DEFAULT']['incremental_snapshots'] = 'yes' if self.incremental_snapshots else 'no'
+        self.config['DEFAULT']['incremental_archives'] = 'yes' if self.incremental_archives else 'no'
+        self.config['DEFAULT']['full_backup_interval'] = str(self.full_backup_interval)
+        self.config['DEFAULT']['dedup_backups'] = 'yes' if self.dedup_backups else 'no'
+        self.config['DEFAULT']['restore_workers'] = str(self.restore_workers)
+        self.config['DEFAULT']['skip_unchanged'] = 'yes' if self.skip_unchanged else 'no'
+        self.config['DEFAULT']['snapshot_provider'] = self.snapshot_provider
+        self.config['DEFAULT']['snapshot_size'] = self.snapshot_size
+        self.config['DEFAULT']['read_bandwidth_limit'] = str(self.read_bandwidth_limit)
+        self.config['DEFAULT']['write_bandwidth_limit'] = str(self.write_bandwidth_limit)
+        self.config['DEFAULT']['adaptive_throttle'] = 'yes' if self.adaptive_throttle else 'no'
+        self.config['DEFAULT']['nice_level'] = str(self.nice_level)
+        self.config['DEFAULT']['io_class'] = self.io_class
+        self.config['DEFAULT']['io_level'] = str(self.io_level)
+        self.config['DEFAULT']['backup_workers'] = str(self.backup_workers)
+        self.config['DEFAULT']['max_io_jobs'] = str(self.max_io_jobs)
+        self.config['DEFAULT']['maintenance_workers'] = str(self.maintenance_workers)
+        self.config['DEFAULT']['lease_timeout'] = str(self.lease_timeout)
+        self.config['DEFAULT']['scrub_budget_gb'] = str(self.scrub_budget_gb)
+        self.config['DEFAULT']['scrub_sample_percent'] = str(self.scrub_sample_percent)
+        self.config['DEFAULT']['metrics_textfile'] = self.metrics_textfile
+        self.config['DEFAULT']['metrics_json_dir'] = self.metrics_json_dir
+        self.config['DEFAULT']['daemon_interval'] = str(self.daemon_interval)
+        self.config['DEFAULT']['dirty_state_file'] = self.dirty_state_file
+        self.config['DEFAULT']['jobs_file'] = self.jobs_file
+        self.config['DEFAULT']['nfs_jobs'] = str(self.nfs_jobs)
+        self.config['DEFAULT']['cpu_jobs'] = str(self.cpu_jobs)
+        self.config['DEFAULT']['disk_jobs'] = str(self.disk_jobs)
         with open(self.config_file, 'w') as configfile:
             self.config.write(configfile)
@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+
+from snapshot import SNAPSHOT_PREFIX
+
+# Ereignisse und Flags aus linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# Alles, was Inhalt, Metadaten oder Listing eines Verzeichnisses ändert; reine Lesezugriffe nicht
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# Für /home selbst genügen neue, gelöschte und umbenannte Benutzerverzeichnisse
+ROOT_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+_EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+# Höchstens so oft wird der Zustand bei laufenden Änderungen gespeichert (Sekunden)
+SAVE_INTERVAL = 30
+
+
+class _Inotify:
+    # Dünne Hülle um die inotify-Systemaufrufe der libc (ctypes wird erst hier geladen)
+    def __init__(self):
+        import ctypes
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._ctypes = ctypes
+        self.fd = self._check(self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def _check(self, result):
+        if result < 0:
+            error = self._ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    def add_watch(self, path, mask):
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        # Für ein bereits gelöschtes Verzeichnis hat der Kernel die Überwachung schon entfernt
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        # Liefert (wd, mask, cookie, name) für alle gerade vorliegenden Ereignisse
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirtyTracker:
+    # Verfolgt per inotify, in welchen Verzeichnissen unter root (/home) sich seit dem letzten Backup
+    # etwas geändert hat: je Benutzer eine Menge von Verzeichnissen relativ zu seinem Home, die
+    # BackupManager.backup_homes(dirty=...) als Teilscan liest. None statt einer Menge verlangt einen
+    # vollständigen Scan des Homes: nach dem Start (Änderungen während der Ausfallzeit sind unbekannt),
+    # nach einem Überlauf der Ereigniswarteschlange und dauerhaft für Benutzer, deren Verzeichnisse
+    # nicht alle überwacht werden können (fs.inotify.max_user_watches erschöpft).
+    # Von den Filterregeln ausgeschlossene Verzeichnisse werden nicht überwacht.
+    def __init__(self, root, state_file=None, filter_rules=None):
+        self.root = root
+        self.state_file = state_file
+        self.filter_rules = filter_rules
+        # Wird bei jeder neuen Änderung gesetzt; der Scheduler wartet darauf
+        self.changed = threading.Event()
+        self.degraded = set()
+        self._dirty = {}
+        self._full = False
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._paths = {}
+        self._rules = {}
+        self._inotify = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._saved = 0
+        self._unsaved = False
+
+    def start(self):
+        self._load()
+        self._inotify = _Inotify()
+        self._add_watch(None, '', self.root, ROOT_MASK)
+        for user in self._users():
+            self._watch_tree(user, '')
+        # Änderungen vor dem Start hat niemand beobachtet
+        self.mark_all()
+        self._thread = threading.Thread(target=self._run, name='dirty-tracker', daemon=True)
+        self._thread.start()
+        logging.info(f'Änderungsverfolgung für {self.root} aktiv ({len(self._watches)} Verzeichnisse überwacht).')
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self.save()
+
+    def pending(self):
+        with self._lock:
+            return self._full or bool(self._dirty)
+
+    def take(self):
+        # Übernimmt die bisher gesammelten Änderungen für einen Lauf: Benutzer -> Verzeichnisse (oder None),
+        # None bedeutet einen vollständigen Lauf über alle Benutzer
+        with self._lock:
+            dirty = None if self._full else self._dirty
+            self._full = False
+            self._dirty = {user: None for user in self.degraded}
+            self._unsaved = True
+        return dirty
+
+    def restore(self, dirty):
+        # Nach einem fehlgeschlagenen Lauf gehen die übernommenen Änderungen zurück in die Menge
+        if dirty is None:
+            self.mark_all()
+            return
+        for user, paths in dirty.items():
+            self._mark(user, paths)
+
+    def mark_all(self):
+        with self._lock:
+            self._full = True
+            self._unsaved = True
+        self.changed.set()
+
+    def _mark(self, user, paths):
+        # paths: Menge relativer Verzeichnisse oder None für das ganze Home
+        with self._lock:
+            current = self._dirty.get(user, set())
+            if current is not None:
+                self._dirty[user] = None if paths is None else current | set(paths)
+            self._unsaved = True
+        self.changed.set()
+
+    def _users(self):
+        try:
+            with os.scandir(self.root) as it:
+                return sorted(entry.name for entry in it
+                              if entry.is_dir(follow_symlinks=False) and self._is_user(entry.name))
+        except FileNotFoundError:
+            return []
+
+    def _is_user(self, name):
+        # Wie in backup_homes: Reste abgebrochener Snapshots sind keine Benutzer
+        return not name.startswith(f'.{SNAPSHOT_PREFIX}')
+
+    def _user_rules(self, user):
+        if user not in self._rules:
+            rules = self.filter_rules(user) if self.filter_rules is not None else None
+            self._rules[user] = rules if rules is not None and rules.active else None
+        return self._rules[user]
+
+    def _add_watch(self, user, rel_dir, path, mask=WATCH_MASK):
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC and user is not None:
+                if user not in self.degraded:
+                    logging.warning(f'Zu wenige inotify-Watches für {path}, Benutzer {user} wird immer vollständig '
+                                    f'gescannt (fs.inotify.max_user_watches erhöhen).')
+                    self.degraded.add(user)
+                self._mark(user, None)
+            elif e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise
+            return False
+        self._watches[wd] = (user, rel_dir)
+        self._paths[(user, rel_dir)] = wd
+        return True
+
+    def _watch_tree(self, user, rel_dir):
+        # Überwacht ein Verzeichnis samt Unterverzeichnissen; gibt alle erfassten Verzeichnisse zurück
+        home = os.path.join(self.root, user)
+        rules = self._user_rules(user)
+        found = []
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            path = os.path.join(home, current) if current else home
+            if not self._add_watch(user, current, path):
+                continue
+            found.append(current)
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        child = f'{current}/{entry.name}' if current else entry.name
+                        if rules is not None and rules.excluded(child, entry.stat(follow_symlinks=False), entry.path):
+                            continue
+                        stack.append(child)
+            except OSError:
+                # Zwischenzeitlich gelöscht oder nicht lesbar; der Scan des Backups meldet das
+                continue
+        return found
+
+    def _forget(self, user, rel_dir):
+        # Entfernt die Überwachung eines Unterbaums, der aus dem überwachten Bereich verschoben wurde
+        prefix = f'{rel_dir}/' if rel_dir else ''
+        for (owner, path), wd in list(self._paths.items()):
+            if owner == user and (path == rel_dir or path.startswith(prefix)):
+                self._inotify.rm_watch(wd)
+                del self._paths[(owner, path)]
+                self._watches.pop(wd, None)
+
+    def _rename(self, user, old, new):
+        # Ein innerhalb des Homes verschobener Unterbaum behält seine Watches unter neuem Pfad
+        for (owner, path), wd in list(self._paths.items()):
+            if owner == user and (path == old or path.startswith(f'{old}/')):
+                renamed = new + path[len(old):]
+                del self._paths[(owner, path)]
+                self._paths[(owner, renamed)] = wd
+                self._watches[wd] = (owner, renamed)
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._inotify.fd], [], [], 1.0)
+            if ready:
+                self._handle(list(self._inotify.read_events()))
+            if self._unsaved and time.monotonic() - self._saved >= SAVE_INTERVAL:
+                self.save()
+
+    def _handle(self, events):
+        # Verschiebungen von Verzeichnissen: MOVED_FROM und MOVED_TO tragen dasselbe Cookie
+        moved = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify-Warteschlange übergelaufen, nächster Lauf scannt alle Homes vollständig.')
+                self.mark_all()
+                continue
+            if wd not in self._watches:
+                continue
+            user, rel_dir = self._watches[wd]
+            if mask & IN_IGNORED:
+                # Verzeichnis gelöscht oder Watch entfernt
+                del self._watches[wd]
+                if self._paths.get((user, rel_dir)) == wd:
+                    del self._paths[(user, rel_dir)]
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            if user is None:
+                # Ereignis in /home selbst: ein Benutzerverzeichnis kam hinzu oder verschwand
+                if not is_dir or not self._is_user(name):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(name, '')
+                    self._mark(name, None)
+                elif mask & IN_MOVED_FROM:
+                    self._forget(name, '')
+                with self._lock:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._dirty.pop(name, None)
+                continue
+            # Jede Änderung eines Eintrags ändert das Listing bzw. die Signaturen seines Verzeichnisses
+            self._mark(user, [rel_dir])
+            if not is_dir or not name:
+                continue
+            rel_path = f'{rel_dir}/{name}' if rel_dir else name
+            if mask & IN_MOVED_FROM:
+                moved[cookie] = (user, rel_path)
+                continue
+            if mask & IN_MOVED_TO and cookie in moved:
+                old_user, old_path = moved.pop(cookie)
+                if old_user == user:
+                    self._rename(user, old_path, rel_path)
+                    self._mark(user, [rel_path])
+                    continue
+                # In ein anderes Home verschoben: dort wie ein neuer Unterbaum behandeln
+                self._forget(old_user, old_path)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                rules = self._user_rules(user)
+                path = os.path.join(self.root, user, rel_path)
+                try:
+                    if rules is not None and rules.excluded(rel_path, os.lstat(path), path):
+                        continue
+                except FileNotFoundError:
+                    continue
+                # Neue Unterbäume vollständig lesen lassen; ihr Inhalt entstand vor den neuen Watches
+                self._mark(user, self._watch_tree(user, rel_path))
+        # Aus dem Home hinaus verschobene Verzeichnisse
+        for user, rel_path in moved.values():
+            self._forget(user, rel_path)
+
+    def _load(self):
+        # Übernimmt noch nicht gesicherte Änderungen eines früheren Laufs; zusätzlich scannt start() alle
+        # Homes einmal vollständig, weil Änderungen während der Ausfallzeit nicht beobachtet wurden
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f'Zustand der Änderungsverfolgung {self.state_file} nicht lesbar: {e}')
+            return
+        for user, paths in data.get('dirty', {}).items():
+            self._mark(user, None if paths is None else paths)
+
+    def save(self):
+        # Atomar ersetzen, damit ein Absturz keine halbe Datei hinterlässt
+        if not self.state_file:
+            return
+        with self._lock:
+            data = {'full': self._full,
+                    'dirty': {user: None if paths is None else sorted(paths) for user, paths in self._dirty.items()}}
+            self._unsaved = False
+        self._saved = time.monotonic()
+        tmp_path = f'{self.state_file}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logging.warning(f'Zustand der Änderungsverfolgung konnte nicht gespeichert werden: {e}')
@@ -0,0 +1,174 @@
+import os
+import re
+import stat
+import time
+import hashlib
+
+# Verzeichnisse mit dieser Datei und Signatur sind Caches (https://bford.info/cachedir/)
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+_WILDCARDS = re.compile(r'[*?\[\\]')
+
+
+def _translate(pattern):
+    # gitignore-Glob -> regulärer Ausdruck für den relativen Pfad: '*' und '?' nicht über '/',
+    # '**/' am Anfang oder in der Mitte für beliebig viele Verzeichnisse, '/**' am Ende für den ganzen Inhalt
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == n:
+            parts.append('/.*')
+            break
+        c = pattern[i]
+        if c == '*':
+            parts.append('.*' if pattern.startswith('**', i) else '[^/]*')
+            i += 2 if pattern.startswith('**', i) else 1
+            continue
+        if c == '?':
+            parts.append('[^/]')
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                content = pattern[i + 1:end]
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                parts.append('[' + content.replace('\\', '\\\\') + ']')
+                i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+class _Block:
+    # Aufeinanderfolgende Regeln gleicher Wirkung, zusammengefasst zu Namensmengen und je einem regulären Ausdruck
+    def __init__(self, negated):
+        self.negated = negated
+        self.names = set()
+        self.dir_names = set()
+        self.patterns = []
+        self.dir_patterns = []
+        self.regex = None
+        self.dir_regex = None
+
+    def add(self, pattern, dir_only):
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        if not anchored and not _WILDCARDS.search(pattern):
+            # Häufigster Fall (node_modules, .cache): Vergleich des Namens ohne regulären Ausdruck
+            (self.dir_names if dir_only else self.names).add(pattern)
+            return
+        expression = _translate(pattern)
+        if not anchored:
+            expression = '(?:.*/)?' + expression
+        (self.dir_patterns if dir_only else self.patterns).append(expression)
+
+    def compile(self):
+        if self.patterns:
+            self.regex = re.compile('(?:' + '|'.join(self.patterns) + r')\Z', re.DOTALL)
+        if self.dir_patterns:
+            self.dir_regex = re.compile('(?:' + '|'.join(self.dir_patterns) + r')\Z', re.DOTALL)
+
+    def matches(self, rel_path, name, is_dir):
+        if name in self.names or (is_dir and name in self.dir_names):
+            return True
+        if self.regex is not None and self.regex.match(rel_path):
+            return True
+        return is_dir and self.dir_regex is not None and self.dir_regex.match(rel_path) is not None
+
+
+class FilterRules:
+    # Ein- und Ausschlussregeln für ein Home-Verzeichnis, einmal kompiliert und während des
+    # Durchlaufs ausgewertet; ein ausgeschlossenes Verzeichnis wird samt Inhalt übersprungen.
+    # Muster wie in .gitignore (relativ zum Home): '!' schließt wieder ein, '/' am Ende gilt nur
+    # für Verzeichnisse, ein '/' am Anfang oder in der Mitte bindet an das Home, sonst zählt der
+    # Name in jeder Tiefe. Die letzte passende Regel entscheidet; ausdrücklich eingeschlossene
+    # Dateien unterliegen nicht den Grenzen für Größe und Alter.
+    def __init__(self, patterns=(), max_file_size=0, max_age_days=0, exclude_caches=False, now=None):
+        self.patterns = [p for p in (line.strip() for line in patterns) if p and not p.startswith('#')]
+        self.max_file_size = max_file_size
+        self.max_age_days = max_age_days
+        self.exclude_caches = exclude_caches
+        self.min_mtime = (now or time.time()) - max_age_days * 86400 if max_age_days else None
+        self._blocks = []
+        for pattern in self.patterns:
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if not self._blocks or self._blocks[-1].negated != negated:
+                self._blocks.append(_Block(negated))
+            self._blocks[-1].add(pattern, dir_only)
+        for block in self._blocks:
+            block.compile()
+        # Die letzte passende Regel entscheidet, daher von hinten prüfen
+        self._blocks.reverse()
+
+    @classmethod
+    def from_config(cls, host, user=None):
+        # host/user: Dictionaries aus ConfigManager.filters bzw. user_filters; Muster werden
+        # angehängt, Grenzen des Benutzers ersetzen die des Hosts
+        user = user or {}
+        patterns = host.get('exclude', []) + ['!' + p for p in host.get('include', [])]
+        patterns += user.get('exclude', []) + ['!' + p for p in user.get('include', [])]
+
+        def limit(key):
+            value = user.get(key)
+            return host.get(key, 0) if value is None else value
+
+        exclude_caches = user.get('exclude_caches')
+        return cls(patterns, limit('max_file_size_mb') * 1024 * 1024, limit('max_age_days'),
+                   host.get('exclude_caches', False) if exclude_caches is None else exclude_caches)
+
+    @property
+    def active(self):
+        return bool(self._blocks or self.max_file_size or self.min_mtime or self.exclude_caches)
+
+    @property
+    def fingerprint(self):
+        # Ändern sich die Regeln, gilt der Stat-Cache nicht mehr als Beleg für unveränderte Unterbäume
+        data = repr((self.patterns, self.max_file_size, self.max_age_days, self.exclude_caches))
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def excluded(self, rel_path, st, abs_path):
+        name = rel_path.rpartition('/')[2]
+        is_dir = stat.S_ISDIR(st.st_mode)
+        for block in self._blocks:
+            if block.matches(rel_path, name, is_dir):
+                return not block.negated
+        if is_dir:
+            return self.exclude_caches and is_cache_dir(abs_path)
+        if stat.S_ISREG(st.st_mode):
+            if self.max_file_size and st.st_size > self.max_file_size:
+                return True
+            if self.min_mtime is not None and st.st_mtime < self.min_mtime:
+                return True
+        return False
+
+
+def is_cache_dir(path):
+    try:
+        with open(os.path.join(path, CACHEDIR_TAG), 'rb') as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+def rsync_exclude_pattern(rel_path):
+    # Exakter, an das Quellverzeichnis gebundener rsync-Ausschluss für einen Pfad. Platzhalter
+    # werden maskiert; rsync wertet den Backslash dann als Maskierung aus.
+    return '/' + re.sub(r'([*?\[\\])', r'\\\1', rel_path)
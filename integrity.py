@@ -0,0 +1,174 @@
+import os
+import random
+import hashlib
+import tarfile
+
+from chunk_store import ChunkStore
+from sparse_io import data_regions, hash_zeros, is_sparse
+
+# Prüfsumme pro Datei: BLAKE2b mit 128 Bit aus der Standardbibliothek (schnell, ohne Zusatzpaket)
+DIGEST_SIZE = 16
+READ_SIZE = 1024 * 1024
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def file_checksum(path, wrap_reader=None):
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        source = wrap_reader(f) if wrap_reader else f
+        st = os.fstat(f.fileno())
+        if not is_sparse(st):
+            _hash_stream(hasher, source)
+            return hasher.hexdigest()
+        # Löcher von Sparse-Dateien werden nicht gelesen, sondern als Nullen gerechnet
+        position = 0
+        for offset, length in data_regions(f.fileno(), st.st_size):
+            hash_zeros(hasher, offset - position)
+            f.seek(offset)
+            _hash_stream(hasher, source, length)
+            position = offset + length
+        hash_zeros(hasher, st.st_size - position)
+    return hasher.hexdigest()
+
+
+def _hash_stream(hasher, source, length=None):
+    # Gibt die Anzahl gelesener Bytes zurück
+    count = 0
+    while length is None or count < length:
+        data = source.read(READ_SIZE if length is None else min(READ_SIZE, length - count))
+        if not data:
+            break
+        hasher.update(data)
+        count += len(data)
+    return count
+
+
+def sample_paths(paths, sample):
+    # Zufällige Stichprobe (Anteil 0 < sample <= 1, mindestens ein Eintrag)
+    paths = list(paths)
+    if sample >= 1 or not paths:
+        return paths
+    return random.sample(paths, max(1, round(len(paths) * sample)))
+
+
+class VerifyResult:
+    # Ergebnis der Prüfung eines Backups: beschädigte und fehlende Einträge sowie ein Fehler, der die
+    # Prüfung abgebrochen hat (z. B. unlesbarer komprimierter Block)
+    def __init__(self):
+        self.corrupt = []
+        self.missing = []
+        self.error = None
+        self.checked = 0
+        self.bytes_read = 0
+
+    @property
+    def ok(self):
+        return not self.corrupt and not self.missing and self.error is None
+
+    def describe(self):
+        parts = []
+        if self.error:
+            parts.append(self.error)
+        for label, paths in (('beschädigt', self.corrupt), ('fehlt', self.missing)):
+            if paths:
+                shown = ', '.join(sorted(paths)[:5])
+                more = f' (+{len(paths) - 5} weitere)' if len(paths) > 5 else ''
+                parts.append(f'{len(paths)} {label}: {shown}{more}')
+        return '; '.join(parts)
+
+
+def verify_archive(reader, expected):
+    # reader: entpackter Datenstrom eines Tar-Archivs; expected: Pfad -> (Typ, Größe, Prüfsumme) aus dem Katalog.
+    # Liest jedes Mitglied vollständig, vergleicht die Prüfsumme und meldet Katalogeinträge, die im Archiv fehlen.
+    result = VerifyResult()
+    seen = set()
+    try:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                seen.add(member.name)
+                if not member.isfile():
+                    continue
+                hasher = new_hasher()
+                source = tar.extractfile(member)
+                if member.sparse is not None:
+                    # Nur die Datenbereiche lesen, Löcher als Nullen rechnen
+                    position = 0
+                    for offset, length in member.sparse:
+                        # GNU-Sparse-Karten enthalten leere Füllbereiche (0, 0)
+                        if not length:
+                            continue
+                        hash_zeros(hasher, offset - position)
+                        source.raw.seek(offset)
+                        result.bytes_read += _hash_stream(hasher, source.raw, length)
+                        position = offset + length
+                    hash_zeros(hasher, member.size - position)
+                else:
+                    result.bytes_read += _hash_stream(hasher, source)
+                result.checked += 1
+                entry = expected.get(member.name)
+                if entry is None:
+                    continue
+                kind, size, checksum = entry
+                if size is not None and member.size != size or checksum and hasher.hexdigest() != checksum:
+                    result.corrupt.append(member.name)
+        # Rest des Datenstroms lesen, damit auch die abschließende Prüfsumme des Codecs geprüft wird
+        while reader.read(READ_SIZE):
+            pass
+    except (tarfile.TarError, OSError, EOFError, ValueError) as e:
+        result.error = f'Archiv nicht lesbar: {e}'
+        return result
+    result.missing = [path for path in expected if path not in seen]
+    return result
+
+
+def verify_directory(backup_path, expected, executor, sample=1.0, wrap_reader=None):
+    # Prüft die Dateien eines Verzeichnis-Snapshots parallel gegen den Katalog
+    result = VerifyResult()
+    paths = sample_paths((path for path, (kind, size, checksum) in expected.items() if kind == 'file'), sample)
+
+    def check(path):
+        full_path = os.path.join(backup_path, path)
+        try:
+            size = os.lstat(full_path).st_size
+            checksum = expected[path][2]
+            return path, size, file_checksum(full_path, wrap_reader) if checksum else None
+        except FileNotFoundError:
+            return path, None, None
+
+    for path, size, checksum in executor.map(check, paths):
+        kind, expected_size, expected_checksum = expected[path]
+        if size is None:
+            result.missing.append(path)
+            continue
+        result.checked += 1
+        result.bytes_read += size if checksum else 0
+        if expected_size is not None and size != expected_size or checksum != expected_checksum:
+            result.corrupt.append(path)
+    return result
+
+
+def verify_chunks(chunk_root, digests, executor, sample=1.0):
+    # Prüft die Chunks eines deduplizierten Backups; get_chunk vergleicht den SHA-256 des Inhalts
+    result = VerifyResult()
+    store = ChunkStore(chunk_root)
+
+    def check(digest):
+        try:
+            return digest, len(store.get_chunk(digest)), None
+        except FileNotFoundError:
+            return digest, None, 'missing'
+        except Exception as e:
+            return digest, None, str(e)
+
+    for digest, size, error in executor.map(check, sample_paths(set(digests), sample)):
+        if error == 'missing':
+            result.missing.append(digest)
+        elif error:
+            result.corrupt.append(digest)
+        else:
+            result.checked += 1
+            result.bytes_read += size
+    return result
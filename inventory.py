@@ -0,0 +1,315 @@
+import os
+import time
+import sqlite3
+from datetime import datetime
+from urllib.parse import quote
+
+from compression import codec_for_path, strip_backup_extension
+from chunk_store import INDEX_EXTENSION
+
+INVENTORY_NAME = '.inventory.sqlite'
+
+# Namenszusatz inkrementeller Archive: backup_<Datum>.delta.tar.<codec>
+DELTA_SUFFIX = '.delta'
+
+# Ein Verzeichnis, dessen mtime so kurz vor dem Scan liegt, kann sich innerhalb derselben
+# Zeitauflösung (NFS: oft eine Sekunde) noch ändern; seine mtime wird daher nicht übernommen
+MTIME_SETTLE_SECONDS = 2
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    kind TEXT NOT NULL,
+    codec TEXT,
+    size INTEGER,
+    data_size INTEGER,
+    files INTEGER,
+    status TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (user, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS backups_created ON backups (created);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS verifications (
+    host TEXT NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    verified_at REAL NOT NULL,
+    verify_status TEXT NOT NULL,
+    PRIMARY KEY (host, user, name)
+) WITHOUT ROWID;
+'''
+# Version 1: ein Bestand je Host; Version 0 war ein gemeinsamer Bestand im Wurzelverzeichnis des Shares
+SCHEMA_VERSION = 1
+
+
+def parse_backup_date(name):
+    # Zeitstempel aus 'backup_<Datum>' bzw. 'backup_<Datum>.tar.<codec>', None bei fremden Einträgen
+    if not name.startswith('backup_'):
+        return None
+    try:
+        date_str = strip_backup_extension(name)[len('backup_'):]
+        if date_str.endswith(INDEX_EXTENSION):
+            date_str = date_str[:-len(INDEX_EXTENSION)]
+        if date_str.endswith(DELTA_SUFFIX):
+            date_str = date_str[:-len(DELTA_SUFFIX)]
+        return datetime.strptime(date_str, '%Y-%m-%d_%H-%M-%S')
+    except ValueError:
+        return None
+
+
+def backup_kind(name):
+    # 'chunks' (deduplizierter Index), 'delta', 'full' (Archiv) oder 'snapshot' (Verzeichnis)
+    if name.endswith(INDEX_EXTENSION):
+        return 'chunks'
+    if codec_for_path(name):
+        return 'delta' if strip_backup_extension(name).endswith(DELTA_SUFFIX) else 'full'
+    return 'snapshot'
+
+
+def _readonly(path):
+    return sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True, timeout=30)
+
+
+class BackupInventory:
+    # Bestand der Backups eines Hosts (SQLite im Host-Verzeichnis auf dem NFS-Share).
+    # Pro Backup: Benutzer, Name, Zeitpunkt, Art, Codec, Größe auf dem Share, Größe der enthaltenen Dateien,
+    # Dateianzahl und Status ('complete' = beim Backup erfasst, 'discovered' = beim Abgleich gefunden,
+    # Größen ggf. unbekannt). Dazu die Prüfergebnisse, die dieser Host für Backups beliebiger Hosts ermittelt hat.
+    # Abgleiche mit dem Share lesen nur Verzeichnisse, deren mtime sich seit dem letzten Abgleich geändert hat.
+    # SQLite-Sperren sind über NFS unzuverlässig, daher schreibt nur der Host selbst seinen Bestand (Backup und
+    # Rotation unter seiner Sperre). Mit readonly wird die Datei nur gelesen und in den Speicher kopiert;
+    # Abgleich und Änderungen wirken dann nur auf die Kopie.
+    def __init__(self, nfs_mount_point, host, readonly=False):
+        self.root = nfs_mount_point
+        self.host = host
+        self.host_dir = os.path.join(nfs_mount_point, host)
+        self.path = os.path.join(self.host_dir, INVENTORY_NAME)
+        self.readonly = readonly or not os.path.isdir(self.host_dir)
+        if self.readonly:
+            self.connection = sqlite3.connect(':memory:')
+            if os.path.exists(self.path):
+                source = _readonly(self.path)
+                try:
+                    source.backup(self.connection)
+                finally:
+                    source.close()
+        else:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_SCHEMA)
+        if not self.readonly and self.connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self._import_legacy()
+
+    def _import_legacy(self):
+        # Übernimmt die Einträge dieses Hosts aus dem früheren gemeinsamen Bestand (wird nur gelesen)
+        legacy_path = os.path.join(self.root, INVENTORY_NAME)
+        rows = verifications = []
+        if os.path.exists(legacy_path):
+            try:
+                legacy = _readonly(legacy_path)
+                try:
+                    columns = {row[1] for row in legacy.execute('PRAGMA table_info(backups)')}
+                    rows = legacy.execute(
+                        'SELECT user, name, created, kind, codec, size, data_size, files, status, recorded_at '
+                        'FROM backups WHERE host = ?', (self.host,)).fetchall()
+                    if 'verified_at' in columns:
+                        verifications = legacy.execute(
+                            'SELECT host, user, name, verified_at, verify_status FROM backups '
+                            'WHERE host = ? AND verified_at IS NOT NULL', (self.host,)).fetchall()
+                finally:
+                    legacy.close()
+            except sqlite3.Error:
+                # Fehlende Einträge nimmt der Abgleich auf, nur ohne Dateianzahl
+                rows = verifications = []
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO backups (user, name, created, kind, codec, size, data_size, files, status, recorded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO verifications (host, user, name, verified_at, verify_status) VALUES (?, ?, ?, ?, ?)',
+                verifications
+            )
+            self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def record_backup(self, user, name, size=None, data_size=None, files=None):
+        created = parse_backup_date(name)
+        if created is None:
+            raise ValueError(f'Kein gültiger Backup-Name: {name}')
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO backups (user, name, created, kind, codec, size, data_size, files, status, recorded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (user, name, created.timestamp(), backup_kind(name), codec_for_path(name),
+                 size, data_size, files, 'complete', time.time())
+            )
+
+    def remove_backups(self, user, names):
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM backups WHERE user = ? AND name = ?', [(user, name) for name in names]
+            )
+            self.connection.executemany(
+                'DELETE FROM verifications WHERE host = ? AND user = ? AND name = ?',
+                [(self.host, user, name) for name in names]
+            )
+
+    def record_verification(self, host, user, name, status, verified_at=None):
+        # Ergebnis einer Prüfung durch diesen Host, auch für Backups anderer Hosts. status: 'ok' oder 'corrupt'
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO verifications (host, user, name, verified_at, verify_status) VALUES (?, ?, ?, ?, ?)',
+                (host, user, name, verified_at or time.time(), status)
+            )
+
+    def prune_verifications(self):
+        # Entfernt Ergebnisse für inzwischen gelöschte Backups, auch solche, die ein anderer Host rotiert hat
+        gone = [(row['host'], row['user'], row['name']) for row in self.connection.execute('SELECT * FROM verifications')
+                if not os.path.lexists(os.path.join(self.root, row['host'], row['user'], row['name']))]
+        with self.connection:
+            self.connection.executemany('DELETE FROM verifications WHERE host = ? AND user = ? AND name = ?', gone)
+
+    def verifications(self):
+        # (Host, Benutzer, Name) -> (Zeitpunkt, Ergebnis) aller Prüfungen durch diesen Host
+        return {(row['host'], row['user'], row['name']): (row['verified_at'], row['verify_status'])
+                for row in self.connection.execute('SELECT * FROM verifications')}
+
+    def refresh(self):
+        # Gleicht den Bestand mit dem Host-Verzeichnis auf dem Share ab
+        if not os.path.isdir(self.host_dir):
+            with self.connection:
+                self.connection.execute('DELETE FROM backups')
+                self.connection.execute('DELETE FROM directories')
+            return
+        known = self._known_users()
+        users = self._changed_entries('')
+        if users is None:
+            users = known
+        else:
+            users = [user for user in users if os.path.isdir(os.path.join(self.host_dir, user))]
+            for user in set(known) - set(users):
+                self._forget(user)
+        for user in users:
+            self._refresh_user(user)
+
+    def _known_users(self):
+        # Beim letzten Abgleich gesehene Benutzerverzeichnisse
+        return [row['path'] for row in self.connection.execute("SELECT path FROM directories WHERE path != ''")]
+
+    def _refresh_user(self, user):
+        user_backup_dir = os.path.join(self.host_dir, user)
+        names = self._changed_entries(user)
+        if names is None:
+            return
+        present = {name for name in names if parse_backup_date(name)}
+        known = {row['name'] for row in self.connection.execute('SELECT name FROM backups WHERE user = ?', (user,))}
+        rows = []
+        for name in present - known:
+            try:
+                st = os.stat(os.path.join(user_backup_dir, name))
+            except FileNotFoundError:
+                continue
+            # Bei Verzeichnis-Snapshots wäre die Größe nur über einen vollständigen Durchlauf zu ermitteln
+            size = None if backup_kind(name) == 'snapshot' else st.st_size
+            rows.append((user, name, parse_backup_date(name).timestamp(), backup_kind(name), codec_for_path(name),
+                         size, None, None, 'discovered', time.time()))
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO backups (user, name, created, kind, codec, size, data_size, files, status, recorded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self.connection.executemany(
+                'DELETE FROM backups WHERE user = ? AND name = ?', [(user, name) for name in known - present]
+            )
+
+    def _changed_entries(self, relative_path):
+        # Inhalt des Verzeichnisses (relativ zum Host-Verzeichnis, ohne versteckte Einträge), falls sich seine
+        # mtime seit dem letzten Abgleich geändert hat, sonst None
+        directory = os.path.join(self.host_dir, relative_path) if relative_path else self.host_dir
+        try:
+            st = os.stat(directory)
+        except FileNotFoundError:
+            return None
+        row = self.connection.execute('SELECT mtime_ns FROM directories WHERE path = ?', (relative_path,)).fetchone()
+        if row is not None and row['mtime_ns'] == st.st_mtime_ns:
+            return None
+        names = [name for name in os.listdir(directory) if not name.startswith('.')]
+        settled = time.time() - st.st_mtime_ns / 1e9 > MTIME_SETTLE_SECONDS
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO directories (path, mtime_ns) VALUES (?, ?)',
+                                    (relative_path, st.st_mtime_ns if settled else None))
+        return names
+
+    def _forget(self, user):
+        with self.connection:
+            self.connection.execute('DELETE FROM backups WHERE user = ?', (user,))
+            self.connection.execute('DELETE FROM directories WHERE path = ?', (user,))
+
+    def query(self, user=None, since=None, until=None, kind=None):
+        # Backups als Dictionaries, sortiert nach Name; since/until sind datetime-Grenzen (einschließlich).
+        # Prüfergebnisse ergänzt der Aufrufer aus den Beständen aller gelesenen Hosts (merge_verifications).
+        conditions = []
+        params = []
+        for column, value in (('user', user), ('kind', kind)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            conditions.append('created >= ?')
+            params.append(since.timestamp())
+        if until is not None:
+            conditions.append('created <= ?')
+            params.append(until.timestamp())
+        sql = 'SELECT * FROM backups'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY name, user'
+        backups = []
+        for row in self.connection.execute(sql, params):
+            backups.append({
+                'host': self.host,
+                'user': row['user'],
+                'backup': row['name'],
+                'path': os.path.join(self.host_dir, row['user'], row['name']),
+                'date': datetime.fromtimestamp(row['created']),
+                'kind': row['kind'],
+                'codec': row['codec'],
+                'size': row['size'],
+                'data_size': row['data_size'],
+                'files': row['files'],
+                'status': row['status'],
+                'verified_at': None,
+                'verify_status': None,
+            })
+        return backups
+
+
+def merge_verifications(backups, verifications):
+    # Trägt in backups das jeweils neueste Prüfergebnis ein; verifications: Ergebnisse mehrerer Hosts
+    # als Liste von Dictionaries (Host, Benutzer, Name) -> (Zeitpunkt, Ergebnis)
+    latest = {}
+    for results in verifications:
+        for key, result in results.items():
+            if key not in latest or result[0] > latest[key][0]:
+                latest[key] = result
+    for backup in backups:
+        result = latest.get((backup['host'], backup['user'], backup['backup']))
+        if result is not None:
+            backup['verified_at'] = datetime.fromtimestamp(result[0])
+            backup['verify_status'] = result[1]
+    return backups
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# Niedrigere Zahl = höhere Priorität: ein Restore wartet nie hinter Backup oder Wartung
+PRIORITIES = {'restore': 0, 'restore_file': 0, 'backup': 1, 'rotate': 2, 'verify': 3, 'scrub': 3}
+# Belegte Ressourcen je Art. 'host' steht für die Sperre des Hosts auf dem Share: Backup und Rotation
+# desselben Hosts schließen sich ohnehin aus und würden sonst nur auf die Sperre warten.
+RESOURCES = {
+    'backup': ('host', 'nfs', 'cpu', 'disk'),
+    'restore': ('nfs', 'disk'),
+    'restore_file': ('nfs', 'disk'),
+    'rotate': ('host', 'nfs'),
+    'verify': ('nfs', 'cpu'),
+    'scrub': ('nfs', 'cpu'),
+}
+DEFAULT_LIMITS = {'host': 1, 'nfs': 2, 'cpu': 1, 'disk': 2}
+FINISHED = ('done', 'failed', 'cancelled')
+# Abgeschlossene Jobs, die für Statusabfragen in der Zustandsdatei bleiben
+HISTORY = 50
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # Ein Auftrag in der Warteschlange. params muss sich als JSON speichern lassen; cancel wird von
+    # den Operationen an sicheren Stellen geprüft (Backup: vor jeder Datei, Restore: vor jedem Eintrag).
+    def __init__(self, job_id, kind, params=None, priority=None, source='', submitted=None):
+        self.id = job_id
+        self.kind = kind
+        self.params = params or {}
+        self.priority = PRIORITIES[kind] if priority is None else priority
+        self.source = source
+        self.submitted = submitted or time.time()
+        self.started = None
+        self.finished = None
+        self.state = 'queued'
+        self.detail = ''
+        self.cancel = threading.Event()
+
+    @property
+    def resources(self):
+        return RESOURCES[self.kind]
+
+    def describe(self):
+        target = self.params.get('user') or self.params.get('backup_path') or ''
+        return f'#{self.id} {self.kind}{" " + target if target else ""}'
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'params': self.params, 'priority': self.priority,
+            'source': self.source, 'submitted': self.submitted, 'started': self.started,
+            'finished': self.finished, 'state': self.state, 'detail': self.detail,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['id'], data['kind'], data.get('params'), data.get('priority'), data.get('source', ''),
+                  data.get('submitted'))
+        job.started = data.get('started')
+        job.finished = data.get('finished')
+        job.state = data.get('state', 'queued')
+        job.detail = data.get('detail', '')
+        return job
+
+
+class JobQueue:
+    # Persistente Warteschlange für Backup, Restore und Wartung. Ein Dispatcher startet jeweils den
+    # Job mit der höchsten Priorität, dessen Ressourcen frei sind, in einem eigenen Thread. Ein Job
+    # niedrigerer Priorität darf vorbeiziehen, wenn er keine Ressource braucht, auf die ein wartender
+    # Job höherer Priorität wartet. handlers: Art -> Funktion(job), Rückgabe False = fehlgeschlagen.
+    # Nach einem Neustart laufen wartende und unterbrochene Jobs erneut (Backups setzen am Checkpoint fort).
+    def __init__(self, handlers, state_file=None, limits=None):
+        self.handlers = handlers
+        self.state_file = state_file
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self._jobs = {}
+        self._next_id = 1
+        self._busy = {resource: 0 for resource in self.limits}
+        self._threads = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._dispatcher = None
+        self._lock_file = None
+
+    @classmethod
+    def from_config(cls, config, backup_manager):
+        limits = {'nfs': max(1, config.nfs_jobs), 'cpu': max(1, config.cpu_jobs), 'disk': max(1, config.disk_jobs)}
+        return cls(manager_handlers(backup_manager), config.jobs_file or None, limits)
+
+    def start(self):
+        self._load()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='jobs')
+        self._dispatcher.start()
+        return self
+
+    def stop(self):
+        # Wartende Jobs bleiben gespeichert, laufende werden noch abgeschlossen
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+        for thread in list(self._threads.values()):
+            thread.join()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def submit(self, kind, params=None, priority=None, source=''):
+        if kind not in self.handlers:
+            raise ValueError(f'Unbekannte Job-Art: {kind}')
+        with self._cond:
+            # Ein gleicher, noch wartender Auftrag (z. B. geplantes Backup) wird nicht doppelt eingereiht
+            for job in self._jobs.values():
+                if job.state == 'queued' and job.kind == kind and job.params == (params or {}):
+                    return job
+            job = Job(self._next_id, kind, params, priority, source)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._save()
+            self._cond.notify_all()
+        logging.info(f'Job {job.describe()} eingereiht.')
+        return job
+
+    def cancel(self, job_id):
+        # Wartende Jobs entfallen sofort, laufende brechen an der nächsten sicheren Stelle ab
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in FINISHED:
+                return False
+            job.cancel.set()
+            if job.state == 'queued':
+                self._finish(job, 'cancelled')
+            logging.info(f'Job {job.describe()} wird abgebrochen.')
+            return True
+
+    def status(self, job_id=None):
+        # Kopien der Jobs (als Dictionary), neueste zuerst
+        with self._cond:
+            if job_id is None:
+                jobs = sorted(self._jobs.values(), key=lambda j: -j.id)
+            else:
+                jobs = [self._jobs[job_id]] if job_id in self._jobs else []
+            return [job.to_dict() for job in jobs]
+
+    def wait(self, job_id, timeout=None):
+        # Wartet auf das Ende eines Jobs; gibt seinen Zustand zurück (None bei Zeitüberschreitung
+        # oder wenn der Job nicht mehr bekannt ist)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while job_id in self._jobs and self._jobs[job_id].state not in FINISHED:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            job = self._jobs.get(job_id)
+            return job.state if job is not None else None
+
+    def drain(self):
+        # Wartet, bis keine Jobs mehr warten oder laufen (Service-Modus)
+        with self._cond:
+            while any(job.state not in FINISHED for job in self._jobs.values()):
+                self._cond.wait()
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._stopping:
+                job = self._next_job()
+                if job is None:
+                    self._cond.wait()
+                    continue
+                for resource in job.resources:
+                    self._busy[resource] += 1
+                job.state = 'running'
+                job.started = time.time()
+                self._save()
+                thread = threading.Thread(target=self._run, args=(job,), name=f'job-{job.id}')
+                self._threads[job.id] = thread
+                thread.start()
+
+    def _next_job(self):
+        blocked = set()
+        for job in sorted((j for j in self._jobs.values() if j.state == 'queued'), key=lambda j: (j.priority, j.id)):
+            needed = set(job.resources)
+            if not needed & blocked and all(self._busy[r] < self.limits[r] for r in needed):
+                return job
+            blocked |= needed
+        return None
+
+    def _run(self, job):
+        logging.info(f'Job {job.describe()} gestartet.')
+        state = 'failed'
+        try:
+            ok = self.handlers[job.kind](job)
+            state = 'cancelled' if job.cancel.is_set() else 'done' if ok is not False else 'failed'
+        except JobCancelled:
+            state = 'cancelled'
+        except Exception as e:
+            logging.error(f'Job {job.describe()} fehlgeschlagen: {e}')
+            job.detail = job.detail or str(e)
+        with self._cond:
+            for resource in job.resources:
+                self._busy[resource] -= 1
+            self._threads.pop(job.id, None)
+            self._finish(job, state)
+        logging.info(f'Job {job.describe()} beendet: {state}.')
+
+    def _finish(self, job, state):
+        # Nur mit gehaltenem self._cond aufrufen
+        job.state = state
+        job.finished = time.time()
+        finished = sorted((j for j in self._jobs.values() if j.state in FINISHED), key=lambda j: j.id)
+        for old in finished[:-HISTORY]:
+            del self._jobs[old.id]
+        self._save()
+        self._cond.notify_all()
+
+    def _load(self):
+        if not self.state_file:
+            return
+        # Nur ein Prozess führt die gespeicherte Warteschlange; ein zweiter (z. B. das Menü neben dem
+        # Daemon) arbeitet mit einer eigenen, nicht gespeicherten Warteschlange
+        import fcntl
+        lock_file = open(f'{self.state_file}.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logging.warning(f'Job-Warteschlange {self.state_file} wird von einem anderen Prozess geführt, '
+                            f'Jobs dieses Prozesses werden nicht gespeichert.')
+            self.state_file = None
+            return
+        self._lock_file = lock_file
+        jobs = read_jobs(self.state_file)
+        with self._cond:
+            for data in jobs:
+                job = Job.from_dict(data)
+                if job.state == 'running':
+                    # Vom Ende des letzten Prozesses unterbrochen
+                    logging.info(f'Job {job.describe()} wurde unterbrochen und wird erneut ausgeführt.')
+                    job.state = 'queued'
+                self._jobs[job.id] = job
+                self._next_id = max(self._next_id, job.id + 1)
+
+    def _save(self):
+        # Nur mit gehaltenem self._cond aufrufen; atomar ersetzen, damit ein Absturz keine halbe Datei hinterlässt
+        if not self.state_file:
+            return
+        tmp_path = f'{self.state_file}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump([job.to_dict() for job in self._jobs.values()], f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logging.warning(f'Job-Warteschlange konnte nicht gespeichert werden: {e}')
+
+
+def read_jobs(state_file):
+    # Gespeicherte Jobs als Dictionaries, auch für Statusabfragen aus einem anderen Prozess
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logging.warning(f'Job-Warteschlange {state_file} nicht lesbar: {e}')
+        return []
+
+
+def manager_handlers(backup_manager):
+    # Verbindet die Job-Arten mit den Operationen des BackupManagers
+    def backup(job):
+        return backup_manager.backup_homes(dirty=job.params.get('dirty'), cancel=job.cancel)
+
+    def restore(job):
+        return backup_manager.restore_backup(job.params['backup_path'], job.params['user'], cancel=job.cancel)
+
+    def restore_file(job):
+        backup = {'path': job.params['backup_path'], 'user': job.params['user']}
+        return backup_manager.restore_file_from_backup(backup, job.params['file_path'])
+
+    def rotate(job):
+        if job.params.get('all_hosts'):
+            reports = backup_manager.rotate_all_hosts()
+        else:
+            reports = backup_manager.rotate_backups()
+        deleted = sum(len(report['deleted']) for report in reports.values())
+        # Nicht löschbare Backups und übersprungene Hosts lassen den Job scheitern und stehen im Detail
+        problems = [f'{host}: {report["error"]}' for host, report in sorted(reports.items()) if report['error']]
+        problems += [f'{path}: {error}' for report in reports.values() for path, error in report['errors'].items()]
+        job.detail = '; '.join([f'{deleted} Backups gelöscht'] + problems)
+        return not problems
+
+    def verify(job):
+        failed = backup_manager.verify_backups(host=job.params.get('host'))
+        job.detail = '; '.join(f'{path}: {error}' for path, error in failed.items())
+        return not failed
+
+    def scrub(job):
+        failed = backup_manager.scrub(job.params.get('budget_gb'), host=job.params.get('host'))
+        job.detail = '; '.join(f'{path}: {error}' for path, error in failed.items())
+        return not failed
+
+    return {'backup': backup, 'restore': restore, 'restore_file': restore_file, 'rotate': rotate,
+            'verify': verify, 'scrub': scrub}
+
+
+def run_full_pass(jobs, backup_manager, source):
+    # Der tägliche Durchgang als Jobs: Backup, Rotation und ggf. Prüfung, die Metriken gelten für den
+    # ganzen Durchgang. Gibt zurück, ob das Backup erfolgreich war.
+    backup_manager.metrics.reset()
+    submitted = [jobs.submit('backup', source=source), jobs.submit('rotate', source=source)]
+    if backup_manager.scrub_budget_gb:
+        submitted.append(jobs.submit('scrub', source=source))
+    states = [jobs.wait(job.id) for job in submitted]
+    backup_manager.write_metrics()
+    return states[0] == 'done'
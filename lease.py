@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+# Gültigkeit einer Sperre ohne Verlängerung; der Besitzer verlängert sie nach einem Drittel der Zeit
+LEASE_TTL = 600
+POLL_INTERVAL = 5
+# Wartezeit nach der Übernahme einer abgelaufenen Sperre, bevor geprüft wird, ob ein anderer Host schneller war
+STEAL_SETTLE = 1.0
+
+
+class LeaseError(Exception):
+    pass
+
+
+class LeaseLost(LeaseError):
+    pass
+
+
+class Lease:
+    # Sperrdatei mit Ablaufzeit auf dem NFS-Share, damit mehrere Hosts nicht gleichzeitig dieselben
+    # Daten rotieren oder bereinigen. Angelegt wird exklusiv (O_EXCL); eine abgelaufene Sperre eines
+    # abgestürzten Besitzers wird übernommen, die eines beendeten Prozesses auf diesem Host sofort.
+    # Ablaufzeiten sind Wanduhrzeit, die Uhren der Hosts müssen daher synchron laufen (NTP).
+    def __init__(self, path, ttl=LEASE_TTL, wait=0):
+        self.path = path
+        self.ttl = ttl
+        self.wait = wait
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}'
+        # Wird gesetzt, wenn die Sperre während des Haltens übernommen wurde oder ohne Verlängerung abgelaufen ist
+        self.lost = False
+        # Ablaufzeit laut der zuletzt erfolgreich geschriebenen Sperrdatei
+        self._expires = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, wait=None):
+        wait = self.wait if wait is None else wait
+        deadline = time.monotonic() + wait
+        while not self._try_acquire():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                holder = self.holder()
+                raise LeaseError(f'{self.path} ist belegt von {holder["owner"] if holder else "unbekannt"}')
+            time.sleep(min(POLL_INTERVAL, remaining))
+        self.lost = False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name='lease', daemon=True)
+        self._thread.start()
+        return self
+
+    def release(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        holder = self.holder()
+        if holder is not None and holder['owner'] == self.owner:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def held(self):
+        return self._thread is not None and not self.lost and time.time() < self._expires
+
+    def check(self):
+        # Vor jedem zerstörenden Schritt aufrufen: ohne sicher gehaltene Sperre wird der Lauf abgebrochen
+        if not self.held():
+            self.lost = True
+            raise LeaseLost(f'Sperre {self.path} verloren, Vorgang abgebrochen')
+
+    def holder(self):
+        # Inhalt der Sperrdatei oder None, wenn sie fehlt oder (noch) nicht lesbar ist
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _content(self):
+        self._pending_expires = time.time() + self.ttl
+        return json.dumps({'owner': self.owner, 'expires': self._pending_expires})
+
+    def _try_acquire(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if self._owner_gone():
+                logging.warning(f'Sperre {self.path} eines beendeten Prozesses wird übernommen.')
+            elif self._expired():
+                logging.warning(f'Abgelaufene Sperre {self.path} wird übernommen.')
+            else:
+                return False
+            # Besitzer ist abgestürzt: übernehmen und prüfen, ob ein anderer Host gleichzeitig übernommen hat
+            self._write()
+            time.sleep(STEAL_SETTLE)
+            holder = self.holder()
+            return holder is not None and holder['owner'] == self.owner
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._content())
+            f.flush()
+            os.fsync(f.fileno())
+        self._expires = self._pending_expires
+        return True
+
+    def _owner_gone(self):
+        # Nach einem Absturz (oder kill -9) auf diesem Host muss der nächste Lauf nicht den Ablauf abwarten
+        holder = self.holder()
+        if holder is None:
+            return False
+        try:
+            hostname, pid, _ = holder['owner'].rsplit(':', 2)
+            pid = int(pid)
+        except (KeyError, ValueError):
+            return False
+        if hostname != socket.gethostname() or pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _expired(self):
+        holder = self.holder()
+        if holder is not None:
+            return holder['expires'] < time.time()
+        # Unlesbare Sperrdatei (z. B. gerade geschrieben): nach ihrer Änderungszeit beurteilen
+        try:
+            return os.path.getmtime(self.path) + self.ttl < time.time()
+        except FileNotFoundError:
+            return True
+
+    def _write(self):
+        tmp_path = f'{self.path}.{self.owner.replace(":", "-")}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self._content())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._expires = self._pending_expires
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            holder = self.holder()
+            if holder is not None and holder['owner'] != self.owner:
+                logging.error(f'Sperre {self.path} wurde von {holder["owner"]} übernommen.')
+                self.lost = True
+                return
+            try:
+                self._write()
+            except OSError as e:
+                # Beim nächsten Intervall erneut versuchen; die Sperre ist noch bis zum Ablauf gültig
+                logging.warning(f'Sperre {self.path} konnte nicht verlängert werden: {e}')
+                if time.time() >= self._expires:
+                    logging.error(f'Sperre {self.path} ist ohne Verlängerung abgelaufen.')
+                    self.lost = True
+                    return
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
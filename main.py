@@ -1,25 +1,9 @@
-import os
-import shutil
-import subprocess
-import logging
-from datetime import datetime, timedelta
-import argparse
-import configparser
 import sys
 import time
-import threading
-import requests
-from tqdm import tqdm  # Fortschrittsbalken-Bibliothek
-import tarfile
-from colorama import init, Fore, Style
-import socket
-from cli import CLI
-from config_manager import ConfigManager
-from notification_manager import NotificationManager
-from backup_manager import BackupManager
-
-init(autoreset=True)
+import logging
 
+# Startzeitpunkt für das Startprofil (--profile-startup)
+STARTED = time.perf_counter()
 
 # Logging konfigurieren
 logging.basicConfig(
@@ -28,19 +12,140 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)s:%(message)s'
 )
 
+# Alle Module werden erst im jeweiligen Modus geladen: der Service-Modus, der per systemd-Timer auf
+# vielen Hosts startet, lädt weder Menü noch Fortschrittsbalken noch die HTTP-Bibliothek.
+
+
+def create_backup_manager(headless=False, config=None):
+    from config_manager import ConfigManager
+    from notification_manager import NotificationManager
+    from backup_manager import BackupManager
+    config = config or ConfigManager()
+    notifier = NotificationManager(config.discord_webhook_url)
+    backup_manager = BackupManager.from_config(config, notifier)
+    # Ohne Terminal keine Fortschrittsbalken, tqdm wird dann nicht geladen
+    backup_manager.show_progress = not headless
+    return backup_manager
+
+
+def run_service():
+    # Service-Modus: keine Benutzerinteraktion, nur geplante Backups. Gespeicherte Jobs eines früheren
+    # Prozesses (z. B. ein unterbrochener Restore) werden mit abgearbeitet.
+    from config_manager import ConfigManager
+    from jobs import JobQueue, run_full_pass
+    config = ConfigManager()
+    backup_manager = create_backup_manager(headless=True, config=config)
+    jobs = JobQueue.from_config(config, backup_manager).start()
+    logging.info(f'Service-Modus bereit nach {(time.perf_counter() - STARTED) * 1000:.0f} ms.')
+    try:
+        run_full_pass(jobs, backup_manager, 'service')
+        jobs.drain()
+    finally:
+        jobs.stop()
+
+
+def run_daemon():
+    # Daemon-Modus: läuft dauerhaft, sichert gemeldete Änderungen alle daemon_interval Minuten und
+    # einmal täglich zur Backup-Zeit alle Homes vollständig
+    import signal
+    from datetime import time as day_time
+    from config_manager import ConfigManager
+    from dirty_tracker import DirtyTracker
+    from jobs import JobQueue
+    from scheduler import Scheduler
+    config = ConfigManager()
+    backup_manager = create_backup_manager(headless=True, config=config)
+    jobs = JobQueue.from_config(config, backup_manager).start()
+    tracker = DirtyTracker(backup_manager.home_dir, config.dirty_state_file, backup_manager.filter_rules).start()
+    scheduler = Scheduler(backup_manager, day_time(config.backup_hour, config.backup_minute), jobs, tracker,
+                          config.daemon_interval * 60)
+    # systemd beendet den Dienst mit SIGTERM; ein laufendes Backup wird noch abgeschlossen
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    logging.info(f'Daemon-Modus bereit nach {(time.perf_counter() - STARTED) * 1000:.0f} ms.')
+    try:
+        scheduler.run_scheduler()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tracker.stop()
+        jobs.stop()
+
+
+def print_jobs():
+    # Status der gespeicherten Job-Warteschlange, auch während ein anderer Prozess sie abarbeitet
+    from datetime import datetime
+    from config_manager import ConfigManager
+    from jobs import read_jobs
+    config = ConfigManager()
+    for job in sorted(read_jobs(config.jobs_file), key=lambda j: -j['id']):
+        submitted = datetime.fromtimestamp(job['submitted']).strftime('%Y-%m-%d %H:%M:%S')
+        target = job['params'].get('user') or job['params'].get('backup_path')
+        parts = [f'#{job["id"]}', submitted, job['kind']] + ([target] if target else []) + [job['state']]
+        if job.get('detail'):
+            parts.append(f'({job["detail"]})')
+        print(' '.join(parts))
+
+
+def run_maintenance(command):
+    # Wartung des gesamten Repositorys von einem Admin-Knoten aus: alle Hosts parallel
+    from backup_manager import ALL_HOSTS
+    backup_manager = create_backup_manager(headless=True)
+    if command == '--maintenance':
+        # Mit --dry-run wird nur der Plan ausgegeben
+        dry_run = '--dry-run' in sys.argv
+        reports = backup_manager.rotate_all_hosts(dry_run=dry_run)
+        if dry_run:
+            for host, report in sorted(reports.items()):
+                for user, plan in sorted(report['plans'].items()):
+                    for name, reasons in sorted(plan.keep.items()):
+                        print(f'{host}/{user}/{name}: behalten ({", ".join(reasons)})')
+                    for backup in plan.delete:
+                        print(f'{host}/{user}/{backup["backup"]}: löschen')
+    elif command == '--scrub':
+        # Rollierende Prüfung aller Hosts im konfigurierten Budget (ohne Budget: 10 GB)
+        budget = backup_manager.scrub_budget_gb or 10
+        sys.exit(1 if backup_manager.scrub(budget, host=ALL_HOSTS) else 0)
+    else:
+        sys.exit(1 if backup_manager.verify_backups(host=ALL_HOSTS) else 0)
+
+
+def load_interactive():
+    from colorama import init
+    from cli import CLI
+    init(autoreset=True)
+    return CLI
+
+
+def run_interactive():
+    # Interaktiver Modus für manuelle Nutzung
+    load_interactive()()
+
+
+def startup_check(mode):
+    # Wird vom Startprofil in einem eigenen Prozess aufgerufen: nur starten, nichts sichern
+    import json
+    if mode == 'service':
+        create_backup_manager(headless=True)
+    else:
+        load_interactive()
+    print(json.dumps({'ready_ms': (time.perf_counter() - STARTED) * 1000, 'modules': sorted(sys.modules)}))
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1 and sys.argv[1] == '--service':
-        # Service-Modus: keine Benutzerinteraktion, nur geplante Backups
-        config = ConfigManager()
-        notifier = NotificationManager(config.discord_webhook_url)
-        backup_manager = BackupManager(
-            config.nfs_mount_point,
-            config.retention_days,
-            notifier,
-            config.compress_backups
-        )
-        backup_manager.backup_homes()
-        backup_manager.rotate_backups()
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == '--service':
+        run_service()
+    elif command == '--daemon':
+        run_daemon()
+    elif command == '--jobs':
+        print_jobs()
+    elif command in ('--maintenance', '--verify', '--scrub'):
+        run_maintenance(command)
+    elif command == '--profile-startup':
+        # Importzeiten und Startdauer eines Modus ausgeben (Standard: service)
+        from startup_profile import print_startup_profile
+        print_startup_profile(sys.argv[2] if len(sys.argv) > 2 else 'service')
+    elif command == '--startup-check':
+        startup_check(sys.argv[2])
     else:
-        # Interaktiver Modus für manuelle Nutzung
-        CLI()
+        run_interactive()
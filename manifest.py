@@ -0,0 +1,77 @@
+import os
+import gzip
+import json
+import logging
+
+MANIFEST_NAME = '.manifest.json.gz'
+
+
+class ArchiveManifest:
+    # Dateizustand und Abhängigkeiten der inkrementellen Archivkette eines Benutzers.
+    # state:    relativer Pfad -> [Größe, mtime_ns, Inode] zum Zeitpunkt des letzten Archivs
+    # archives: Archivname -> {'base': Vollbackup, 'parent': Vorgänger oder None, 'deleted': [Pfade]}
+    def __init__(self, user_backup_dir):
+        self.path = os.path.join(user_backup_dir, MANIFEST_NAME)
+        self.state = {}
+        self.archives = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            self.state = data.get('state', {})
+            self.archives = data.get('archives', {})
+        except (OSError, ValueError) as e:
+            # Ein beschädigtes Manifest erzwingt ein neues Vollbackup
+            logging.warning(f'Manifest {self.path} konnte nicht gelesen werden: {e}')
+            self.state = {}
+            self.archives = {}
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'state': self.state, 'archives': self.archives}, f)
+        os.replace(tmp_path, self.path)
+
+    def latest_archive(self):
+        # Das zuletzt geschriebene Archiv, sofern es noch existiert
+        directory = os.path.dirname(self.path)
+        for name in sorted(self.archives, reverse=True):
+            if os.path.exists(os.path.join(directory, name)):
+                return name
+        return None
+
+    def chain(self, name):
+        # Alle Archive, die für die Wiederherstellung von `name` nötig sind, vom Vollbackup an
+        chain = []
+        while name:
+            if name not in self.archives:
+                raise ValueError(f'Archiv {name} ist nicht im Manifest verzeichnet')
+            chain.append(name)
+            name = self.archives[name]['parent']
+        return list(reversed(chain))
+
+    def chain_length(self, name):
+        return len(self.chain(name)) - 1
+
+    def add_archive(self, name, parent, state, deleted):
+        base = self.archives[parent]['base'] if parent else name
+        self.archives[name] = {'base': base, 'parent': parent, 'deleted': sorted(deleted)}
+        self.state = state
+
+    def remove_archives(self, names):
+        for name in names:
+            self.archives.pop(name, None)
+        if not self.archives:
+            # Ohne verbleibende Archive muss das nächste Backup wieder vollständig sein
+            self.state = {}
+
+    def chains(self):
+        # Vollbackup -> Liste aller davon abhängigen Archive (einschließlich des Vollbackups)
+        chains = {}
+        for name, info in self.archives.items():
+            chains.setdefault(info['base'], []).append(name)
+        return chains
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Präfix aller exportierten Metriken
+METRIC_PREFIX = 'homebackup'
+# Anzahl der JSON-Berichte, die im Berichtsverzeichnis erhalten bleiben
+REPORTS_KEEP = 30
+
+# Name -> (Typ, Beschreibung). Zähler beziehen sich immer auf den letzten Lauf.
+METRICS = {
+    'run_start_timestamp_seconds': ('gauge', 'Startzeit des Laufs'),
+    'run_duration_seconds': ('gauge', 'Dauer des Laufs'),
+    'phase_seconds': ('gauge', 'Zeit pro Phase in Sekunden (Phasen können sich überlappen, Kompression summiert über alle Threads)'),
+    'phase_calls': ('gauge', 'Anzahl Aufrufe pro Phase'),
+    'bytes': ('gauge', 'Übertragene Bytes pro Richtung'),
+    'files': ('gauge', 'Gesicherte Einträge'),
+    'files_skipped': ('gauge', 'Unveränderte, nicht erneut gesicherte Einträge'),
+    'errors': ('gauge', 'Fehler pro Phase'),
+    'users_skipped': ('gauge', 'Benutzer mit unverändertem Home, deren Backup übersprungen wurde'),
+    'user_duration_seconds': ('gauge', 'Dauer des Backups pro Benutzer'),
+    'user_success': ('gauge', '1, wenn das Backup des Benutzers erfolgreich war'),
+    'user_files': ('gauge', 'Dateien im Backup des Benutzers'),
+    'user_bytes': ('gauge', 'Datenmenge im Backup des Benutzers'),
+    'backups_deleted': ('gauge', 'Bei der Rotation gelöschte Backups'),
+    'backups_corrupt': ('gauge', 'Bei der Prüfung als fehlerhaft erkannte Backups'),
+}
+
+
+class _TimedFile:
+    # Leitet Zugriffe an fileobj weiter und misst Zeit und Bytes von read und write
+    def __init__(self, fileobj, metrics, phase, direction):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.phase = phase
+        self.direction = direction
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.fileobj.read(size)
+        self.metrics.add_time(self.phase, time.perf_counter() - start, len(data), self.direction)
+        return data
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        count = self.fileobj.readinto(buffer)
+        self.metrics.add_time(self.phase, time.perf_counter() - start, count or 0, self.direction)
+        return count
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self.fileobj.write(data)
+        self.metrics.add_time(self.phase, time.perf_counter() - start, len(data), self.direction)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class RunMetrics:
+    # Zähler und Phasenzeiten eines Laufs, threadsicher. Export als Textdatei für den
+    # node-exporter (textfile collector) und als JSON-Bericht.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._values = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def add_time(self, phase, seconds, amount=0, direction=None):
+        with self._lock:
+            for name, value in (('phase_seconds', seconds), ('phase_calls', 1)):
+                key = (name, (('phase', phase),))
+                self._values[key] = self._values.get(key, 0) + value
+            if direction is not None:
+                key = ('bytes', (('direction', direction),))
+                self._values[key] = self._values.get(key, 0) + amount
+
+    @contextmanager
+    def phase(self, phase):
+        # Misst die Dauer eines Abschnitts; Ausnahmen werden als Fehler der Phase gezählt
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count('errors', phase=phase)
+            raise
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def timed(self, iterable, phase):
+        # Misst die Zeit, die das Erzeugen der Elemente kostet (z. B. den Verzeichnisdurchlauf)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.perf_counter() - start)
+                return
+            self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def reader(self, fileobj, phase='read'):
+        return _TimedFile(fileobj, self, phase, 'read')
+
+    def writer(self, fileobj, phase='write'):
+        return _TimedFile(fileobj, self, phase, 'written')
+
+    def values(self):
+        # (Name, Labels, Wert) aller Metriken, einschließlich Start und Dauer des Laufs
+        with self._lock:
+            items = sorted(self._values.items())
+            started = self.started
+        values = [('run_start_timestamp_seconds', (), started), ('run_duration_seconds', (), time.time() - started)]
+        return values + [(name, labels, value) for (name, labels), value in items]
+
+    def report(self):
+        # Bericht als Dictionary: Metriken ohne Labels als Wert, sonst als Liste mit Labels und Wert
+        report = {'host': socket.gethostname(), 'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                  'metrics': {}}
+        for name, labels, value in self.values():
+            if labels:
+                report['metrics'].setdefault(name, []).append({**dict(labels), 'value': value})
+            else:
+                report['metrics'][name] = value
+        return report
+
+    def write_prometheus(self, path):
+        # Atomar ersetzen, damit der node-exporter nie eine halb geschriebene Datei liest
+        lines = []
+        described = set()
+        for name, labels, value in self.values():
+            metric = f'{METRIC_PREFIX}_{name}'
+            if name not in described:
+                described.add(name)
+                kind, description = METRICS.get(name, ('gauge', name))
+                lines.append(f'# HELP {metric} {description}')
+                lines.append(f'# TYPE {metric} {kind}')
+            label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+            lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+    def write_json(self, directory):
+        # Ein Bericht pro Lauf; ältere Berichte über REPORTS_KEEP hinaus werden entfernt
+        os.makedirs(directory, exist_ok=True)
+        name = f'run_{datetime.fromtimestamp(self.started).strftime("%Y-%m-%d_%H-%M-%S")}.json'
+        _write_atomic(os.path.join(directory, name), json.dumps(self.report(), indent=2, ensure_ascii=False))
+        reports = sorted(f for f in os.listdir(directory) if f.startswith('run_') and f.endswith('.json'))
+        for old in reports[:-REPORTS_KEEP]:
+            try:
+                os.remove(os.path.join(directory, old))
+            except OSError as e:
+                logging.warning(f'Alter Bericht {old} konnte nicht gelöscht werden: {e}')
+        return os.path.join(directory, name)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -1,33 +1,152 @@
 ## notification_manager.py
-import requests
-import logging
-import os
-import shutil
-import subprocess
-import logging
-from datetime import datetime, timedelta
-import argparse
-import configparser
-import sys
 import time
+import queue
+import atexit
+import logging
 import threading
-import requests
-from tqdm import tqdm  # Fortschrittsbalken-Bibliothek
-import tarfile
-from colorama import init, Fore, Style
-import socket
+
+# Discord begrenzt den Nachrichteninhalt auf 2000 Zeichen
+MAX_MESSAGE_LENGTH = 2000
+# Obergrenze für Wartezeiten bei Rate-Limits und Wiederholungen
+MAX_RETRY_DELAY = 60
+
 
 class NotificationManager:
-    def __init__(self, webhook_url):
+    # Nachrichten werden in eine begrenzte Warteschlange gestellt und von einem Hintergrund-Thread
+    # über eine wiederverwendete HTTP-Sitzung gesendet. Nachrichten, die innerhalb von batch_window
+    # Sekunden eintreffen, werden zu einer Nachricht zusammengefasst. Backups warten so nie auf den Webhook.
+    def __init__(self, webhook_url, timeout=10, queue_size=100, batch_window=2.0, max_retries=5):
         self.webhook_url = webhook_url
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._session = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._flushing = threading.Event()
+        # Zeitpunkt, bis zu dem laut Rate-Limit nicht gesendet werden darf
+        self._blocked_until = 0
+        atexit.register(self.flush)
 
     def send_notification(self, message):
         if not self.webhook_url:
             return
-        data = {"content": message}
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            logging.warning(f'Benachrichtigungswarteschlange voll, Nachricht verworfen: {message}')
+
+    def flush(self, timeout=30):
+        # Wartet, bis alle eingereihten Nachrichten gesendet sind (z. B. vor Programmende)
+        if self._thread is None:
+            return True
+        self._flushing.set()
+        deadline = time.monotonic() + timeout
         try:
-            response = requests.post(self.webhook_url, json=data)
-            if response.status_code != 204:
-                logging.error(f"Fehler beim Senden der Benachrichtigung: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Ausnahme beim Senden der Benachrichtigung: {e}")
\ No newline at end of file
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logging.warning(f'{self._queue.unfinished_tasks} Benachrichtigungen konnten nicht gesendet werden.')
+                        return False
+                    self._queue.all_tasks_done.wait(remaining)
+            return True
+        finally:
+            self._flushing.clear()
+
+    def _ensure_worker(self):
+        with self._thread_lock:
+            if self._thread is None:
+                # requests erst laden, wenn tatsächlich gesendet wird
+                import requests
+                self._session = requests.Session()
+                self._thread = threading.Thread(target=self._run, name='notifications', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                remaining = 0 if self._flushing.is_set() else deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for content in _pack_messages(batch):
+                    self._post(content)
+            except Exception as e:
+                logging.error(f'Ausnahme beim Senden der Benachrichtigung: {e}')
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _post(self, content):
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = self._session.post(self.webhook_url, json={'content': content}, timeout=self.timeout)
+            except OSError as e:  # requests.RequestException ist eine Unterklasse von OSError
+                logging.warning(f'Ausnahme beim Senden der Benachrichtigung (Versuch {attempt + 1}): {e}')
+                retry_after = delay
+            else:
+                self._note_rate_limit(response)
+                if response.status_code < 300:
+                    return True
+                if response.status_code == 429:
+                    retry_after = _retry_after(response, delay)
+                    logging.warning(f'Webhook-Rate-Limit erreicht, neuer Versuch in {retry_after:.1f} s.')
+                elif response.status_code >= 500:
+                    retry_after = delay
+                else:
+                    logging.error(f'Fehler beim Senden der Benachrichtigung: {response.status_code}')
+                    return False
+            self._blocked_until = time.monotonic() + min(retry_after, MAX_RETRY_DELAY)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+        logging.error(f'Benachrichtigung nach {self.max_retries + 1} Versuchen verworfen.')
+        return False
+
+    def _note_rate_limit(self, response):
+        # Ist das Kontingent erschöpft, bis zum Reset warten, statt in ein 429 zu laufen
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            try:
+                reset_after = float(response.headers.get('X-RateLimit-Reset-After', '0'))
+            except ValueError:
+                return
+            self._blocked_until = time.monotonic() + min(reset_after, MAX_RETRY_DELAY)
+
+
+def _retry_after(response, default):
+    try:
+        return float(response.json().get('retry_after', default))
+    except (ValueError, AttributeError):
+        pass
+    try:
+        return float(response.headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+
+def _pack_messages(messages):
+    # Fasst Nachrichten zeilenweise zu möglichst wenigen Inhalten unterhalb der Längengrenze zusammen
+    packed = []
+    current = ''
+    for message in messages:
+        for i in range(0, max(len(message), 1), MAX_MESSAGE_LENGTH):
+            part = message[i:i + MAX_MESSAGE_LENGTH]
+            if current and len(current) + 1 + len(part) > MAX_MESSAGE_LENGTH:
+                packed.append(current)
+                current = ''
+            current = f'{current}\n{part}' if current else part
+    if current:
+        packed.append(current)
+    return packed
@@ -0,0 +1,34 @@
+# Fortschrittsanzeige: tqdm wird erst beim ersten Balken geladen. Ohne Anzeige (Service-Modus)
+# wird ein stiller Ersatz verwendet, sodass tqdm gar nicht importiert wird.
+
+
+class NullProgress:
+    # Zählt wie tqdm mit, gibt aber nichts aus
+    def __init__(self, total=None, **kwargs):
+        self.total = total
+        self.n = 0
+
+    def update(self, n=1):
+        self.n += n
+
+    def refresh(self):
+        pass
+
+    def set_postfix(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_progress(enabled=True, **kwargs):
+    if not enabled:
+        return NullProgress(**kwargs)
+    from tqdm import tqdm
+    return tqdm(**kwargs)
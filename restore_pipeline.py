@@ -0,0 +1,243 @@
+import os
+import stat
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sparse_io import write_regions
+
+# Dateien bis zu dieser Größe werden aus dem Stream gelesen und im Thread-Pool geschrieben,
+# größere direkt im lesenden Thread, damit der Speicherbedarf begrenzt bleibt
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def safe_join(target_path, relative_path):
+    # Verhindert, dass Einträge mit absoluten Pfaden oder '..' außerhalb des Ziels landen
+    full_path = os.path.normpath(os.path.join(target_path, relative_path))
+    if os.path.isabs(relative_path) or os.path.commonpath([full_path, os.path.normpath(target_path)]) != os.path.normpath(target_path):
+        raise ValueError(f'Unzulässiger Pfad im Backup: {relative_path}')
+    return full_path
+
+
+def resolves_inside(target_path, full_path):
+    # Prüft, ob das Elternverzeichnis von full_path ohne Umweg über symbolische Links im Ziel liegt
+    parent = os.path.dirname(full_path)
+    expected = os.path.join(os.path.realpath(target_path), os.path.relpath(parent, target_path))
+    return os.path.realpath(parent) == os.path.normpath(expected)
+
+
+def apply_metadata(path, entry, follow_symlinks=True):
+    try:
+        os.chown(path, entry['uid'], entry['gid'], follow_symlinks=follow_symlinks)
+    except (PermissionError, NotImplementedError):
+        pass
+    if follow_symlinks:
+        os.chmod(path, entry['mode'])
+    try:
+        os.utime(path, (entry['mtime'], entry['mtime']), follow_symlinks=follow_symlinks)
+    except NotImplementedError:
+        pass
+
+
+class ParallelRestorer:
+    # Stellt Einträge in Ankunftsreihenfolge wieder her: Verzeichnisse sofort, Dateiinhalte
+    # parallel im Thread-Pool. Rechte, Besitzer und Zeitstempel werden am Ende gesammelt gesetzt,
+    # Verzeichnisse zuletzt und von innen nach außen, damit ihre mtime erhalten bleibt.
+    # Symbolische Links im Ziel werden nie verfolgt: bei einer Kette kann ein früheres Archiv 'x -> /etc'
+    # enthalten und ein späteres das Verzeichnis 'x/' mit Dateien. Ein Verzeichniseintrag ersetzt den Link,
+    # Einträge, deren Elternpfad durch einen Link führt, werden abgelehnt.
+    def __init__(self, target_path, workers=4, governor=None):
+        self.target_path = target_path
+        # Begrenzt die Schreibrate (ResourceGovernor), None = unbegrenzt
+        self.governor = governor
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='restore')
+        # Begrenzt die Anzahl gepufferter Dateien, die auf einen freien Worker warten
+        self._slots = threading.BoundedSemaphore(max(1, workers) * 4)
+        self._futures = []
+        # Pfade, deren Inhalt noch im Pool geschrieben wird
+        self._pending_paths = set()
+        self._created_dirs = set()
+        self._file_metadata = []
+        self._dir_metadata = []
+        self._hardlinks = []
+
+    def _ensure_dir(self, full_path, replace=False):
+        # Legt full_path samt fehlender Elternverzeichnisse an, ohne symbolischen Links zu folgen.
+        # replace: ein anderer Eintrag an full_path selbst (Datei, Link) wird durch das Verzeichnis ersetzt.
+        if full_path in self._created_dirs:
+            return
+        if full_path == os.path.normpath(self.target_path):
+            os.makedirs(full_path, exist_ok=True)
+        else:
+            self._ensure_dir(os.path.dirname(full_path))
+            try:
+                st = os.lstat(full_path)
+            except FileNotFoundError:
+                os.mkdir(full_path)
+            else:
+                if not stat.S_ISDIR(st.st_mode):
+                    if not replace:
+                        raise ValueError(f'Unzulässiger Pfad im Backup: {full_path} ist kein Verzeichnis')
+                    os.remove(full_path)
+                    os.mkdir(full_path)
+        self._created_dirs.add(full_path)
+
+    def _settle(self, full_path):
+        # Kommt ein Pfad im Archiv mehrfach vor, muss das Schreiben des früheren Eintrags abgeschlossen sein,
+        # bevor er ersetzt wird; sonst schriebe der Pool z. B. durch einen inzwischen angelegten Link
+        if full_path in self._pending_paths:
+            self._collect()
+            self._pending_paths.clear()
+
+    def _prepare(self, relative_path):
+        full_path = safe_join(self.target_path, relative_path)
+        self._ensure_dir(os.path.dirname(full_path))
+        self._settle(full_path)
+        try:
+            if not stat.S_ISDIR(os.lstat(full_path).st_mode):
+                os.remove(full_path)
+        except FileNotFoundError:
+            pass
+        return full_path
+
+    def _submit(self, function, *args):
+        self._slots.acquire()
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        # Abgeschlossene Futures regelmäßig prüfen, damit Fehler früh auffallen
+        if len(self._futures) > 1024:
+            self._collect(done_only=True)
+
+    def _collect(self, done_only=False):
+        pending = []
+        for future in self._futures:
+            if done_only and not future.done():
+                pending.append(future)
+                continue
+            future.result()
+        self._futures = pending
+
+    def directory(self, relative_path, metadata):
+        full_path = safe_join(self.target_path, relative_path)
+        self._settle(full_path)
+        self._ensure_dir(full_path, replace=True)
+        self._dir_metadata.append((full_path, metadata))
+
+    def file_data(self, relative_path, metadata, data):
+        full_path = self._prepare(relative_path)
+        self._submit(self._write_data, full_path, data)
+        self._pending_paths.add(full_path)
+        self._file_metadata.append((full_path, metadata))
+
+    def file_stream(self, relative_path, metadata, fileobj):
+        # Große Dateien direkt aus dem Stream schreiben
+        full_path = self._prepare(relative_path)
+        with open(full_path, 'wb') as f:
+            while True:
+                data = fileobj.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                self._throttle(len(data))
+                f.write(data)
+        self._file_metadata.append((full_path, metadata))
+
+    def file_sparse(self, relative_path, metadata, fileobj, regions, size):
+        # Sparse-Datei direkt aus dem Stream: nur die Datenbereiche werden geschrieben, Löcher bleiben unbelegt
+        full_path = self._prepare(relative_path)
+        write_regions(fileobj, full_path, regions, size, self._throttle)
+        self._file_metadata.append((full_path, metadata))
+
+    def file_from(self, relative_path, metadata, write_function):
+        # write_function(full_path) erzeugt den Dateiinhalt, z. B. aus dem Chunk-Store
+        full_path = self._prepare(relative_path)
+        self._submit(self._write_from, write_function, full_path, metadata.get('size', 0))
+        self._pending_paths.add(full_path)
+        self._file_metadata.append((full_path, metadata))
+
+    def symlink(self, relative_path, linkname, metadata):
+        full_path = self._prepare(relative_path)
+        os.symlink(linkname, full_path)
+        self._file_metadata.append((full_path, dict(metadata, symlink=True)))
+
+    def hardlink(self, relative_path, target_relative_path, metadata):
+        # Erst nach dem Schreiben aller Dateien anlegen, da das Ziel noch im Pool sein kann
+        self._hardlinks.append((relative_path, target_relative_path))
+
+    def fifo(self, relative_path, metadata):
+        full_path = self._prepare(relative_path)
+        os.mkfifo(full_path)
+        self._file_metadata.append((full_path, metadata))
+
+    def _write_data(self, full_path, data):
+        self._throttle(len(data))
+        with open(full_path, 'wb') as f:
+            f.write(data)
+
+    def _write_from(self, write_function, full_path, size):
+        self._throttle(size)
+        write_function(full_path)
+
+    def _throttle(self, size):
+        if self.governor is not None:
+            self.governor.write(size)
+
+    def finish(self):
+        try:
+            self._collect()
+        finally:
+            self._executor.shutdown(wait=True)
+
+        for relative_path, target_relative_path in self._hardlinks:
+            full_path = self._prepare(relative_path)
+            target_path = safe_join(self.target_path, target_relative_path)
+            self._ensure_dir(os.path.dirname(target_path))
+            try:
+                # Ein Link als Ziel wird selbst verknüpft, nicht die Datei, auf die er zeigt
+                os.link(target_path, full_path, follow_symlinks=False)
+            except FileNotFoundError:
+                logging.warning(f'Hardlink-Ziel {target_relative_path} für {relative_path} fehlt')
+
+        # Ein später im Archiv folgender Link gleichen Namens darf Rechte und Besitzer nicht auf sein Ziel lenken
+        for full_path, metadata in self._file_metadata:
+            if metadata.get('symlink') or not os.path.islink(full_path):
+                apply_metadata(full_path, metadata, follow_symlinks=not metadata.get('symlink'))
+        for full_path, metadata in sorted(self._dir_metadata, key=lambda item: item[0].count(os.sep), reverse=True):
+            if not os.path.islink(full_path):
+                apply_metadata(full_path, metadata)
+
+    def abort(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def restore_tar_stream(tar, restorer, select=None):
+    # Einmaliger Durchlauf über ein im Stream-Modus geöffnetes Archiv. select(Name) wählt einzelne
+    # Einträge aus (Einzeldatei oder Unterbaum); geliefert werden nur die wiederhergestellten.
+    for member in tar:
+        name = member.name.rstrip('/')
+        if select is not None and not select(name):
+            continue
+        metadata = {'uid': member.uid, 'gid': member.gid, 'mode': member.mode, 'mtime': member.mtime}
+        if member.isdir():
+            restorer.directory(name, metadata)
+        elif member.isreg():
+            fileobj = tar.extractfile(member)
+            if member.sparse is not None:
+                # Der gepufferte Leser verlangt im Stream-Modus ein seekbares Archiv; der Rohleser
+                # springt über die Löcher, ohne im Archiv zurückzugehen
+                restorer.file_sparse(name, metadata, fileobj.raw, member.sparse, member.size)
+            elif member.size <= SMALL_FILE_SIZE:
+                restorer.file_data(name, metadata, fileobj.read())
+            else:
+                restorer.file_stream(name, metadata, fileobj)
+        elif member.issym():
+            restorer.symlink(name, member.linkname, metadata)
+        elif member.islnk():
+            restorer.hardlink(name, member.linkname, metadata)
+        elif member.isfifo():
+            restorer.fifo(name, metadata)
+        else:
+            logging.warning(f'Eintrag {name} vom Typ {member.type!r} wird übersprungen')
+        yield member
+
@@ -0,0 +1,131 @@
+import os
+import shutil
+import logging
+from datetime import datetime, timedelta
+
+# Zu löschende Verzeichnisse werden zuerst unter diesem Namen versteckt, damit sie sofort aus
+# Listen und Rotation verschwinden; Reste abgebrochener Löschvorgänge entfernt die nächste Rotation
+DELETING_SUFFIX = '.deleting'
+
+
+class RetentionPlan:
+    # Ergebnis einer Aufbewahrungsregel für die Backups eines Benutzers.
+    # keep:   Backup-Name -> Gründe, aus denen es behalten wird
+    # delete: Backups (Einträge aus list_backups), die gelöscht werden
+    def __init__(self):
+        self.keep = {}
+        self.delete = []
+
+    def protect(self, names, reason):
+        # Backups nachträglich behalten, z. B. Vorgänger eines behaltenen Deltas
+        for backup in [b for b in self.delete if b['backup'] in names]:
+            self.delete.remove(backup)
+            self.keep[backup['backup']] = [reason]
+
+
+class RetentionPolicy:
+    # Großvater-Vater-Sohn-Aufbewahrung: alle Backups der letzten days Tage, dazu jeweils das neueste
+    # Backup der letzten daily Tage, weekly Wochen, monthly Monate und yearly Jahre, in denen es
+    # Backups gibt. Das neueste Backup bleibt immer erhalten.
+    PERIODS = (
+        ('daily', 'täglich', lambda date: date.date()),
+        ('weekly', 'wöchentlich', lambda date: date.isocalendar()[:2]),
+        ('monthly', 'monatlich', lambda date: (date.year, date.month)),
+        ('yearly', 'jährlich', lambda date: date.year),
+    )
+
+    def __init__(self, days, daily=0, weekly=0, monthly=0, yearly=0):
+        self.days = days
+        self.counts = {'daily': daily, 'weekly': weekly, 'monthly': monthly, 'yearly': yearly}
+
+    def plan(self, backups, now=None):
+        # backups: Einträge mit 'backup' und 'date'
+        now = now or datetime.now()
+        cutoff_date = now - timedelta(days=self.days)
+        plan = RetentionPlan()
+        ordered = sorted(backups, key=lambda b: b['date'], reverse=True)
+        if not ordered:
+            return plan
+        keep = plan.keep
+        keep.setdefault(ordered[0]['backup'], []).append('neuestes')
+        for backup in ordered:
+            if backup['date'] >= cutoff_date:
+                keep.setdefault(backup['backup'], []).append('aktuell')
+        for name, label, period_of in self.PERIODS:
+            count = self.counts[name]
+            seen = set()
+            for backup in ordered:
+                if len(seen) >= count:
+                    break
+                period = period_of(backup['date'])
+                if period in seen:
+                    continue
+                seen.add(period)
+                keep.setdefault(backup['backup'], []).append(label)
+        plan.delete = [backup for backup in reversed(ordered) if backup['backup'] not in keep]
+        return plan
+
+
+def delete_backups(paths, executor, check=None):
+    # Löscht Backups parallel über executor. Verzeichnisse werden zuerst versteckt und dann pro
+    # Unterverzeichnis der obersten Ebene parallel entfernt, sodass auch wenige große Snapshot-Bäume
+    # auf mehrere Worker verteilt werden. Gibt (gelöschte Pfade, Pfad -> Fehler) zurück.
+    # check() wird vor jedem Backup aufgerufen; wirft es, bleiben die übrigen Backups mit diesem Fehler liegen.
+    tasks = {}
+    errors = {}
+    for index, path in enumerate(paths):
+        if check is not None:
+            try:
+                check()
+            except Exception as e:
+                errors.update((rest, e) for rest in paths[index:])
+                break
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                directory, name = os.path.split(path)
+                hidden = os.path.join(directory, f'.{name}{DELETING_SUFFIX}')
+                os.rename(path, hidden)
+                tasks[path] = (hidden, [executor.submit(_remove, os.path.join(hidden, child))
+                                        for child in os.listdir(hidden)])
+            else:
+                tasks[path] = (None, [executor.submit(_remove, path)])
+        except FileNotFoundError:
+            tasks[path] = (None, [])
+        except OSError as e:
+            errors[path] = e
+
+    deleted = []
+    for path, (hidden, futures) in tasks.items():
+        try:
+            for future in futures:
+                future.result()
+            if hidden:
+                os.rmdir(hidden)
+            deleted.append(path)
+            logging.info(f'Altes Backup {path} gelöscht.')
+        except OSError as e:
+            if hidden:
+                # Das Backup ist bereits unsichtbar; die Reste entfernt die nächste Rotation
+                logging.warning(f'Backup {path} nicht vollständig gelöscht, Reste in {hidden}: {e}')
+                deleted.append(path)
+                continue
+            logging.error(f'Backup {path} konnte nicht gelöscht werden: {e}')
+            errors[path] = e
+    return deleted, errors
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_deletions(user_backup_dir):
+    # Reste abgebrochener Löschvorgänge
+    for name in os.listdir(user_backup_dir):
+        if name.startswith('.') and name.endswith(DELETING_SUFFIX):
+            shutil.rmtree(os.path.join(user_backup_dir, name), ignore_errors=True)
@@ -1,10 +1,20 @@
+import time
+import logging
 import threading
 from datetime import datetime, timedelta
 
+from jobs import run_full_pass
+
 class Scheduler:
-    def __init__(self, backup_manager, backup_time):
+    # Ohne tracker ein vollständiger Lauf täglich zur backup_time. Mit tracker (DirtyTracker, Daemon-Modus)
+    # zusätzlich kleine Läufe über die gemeldeten Änderungen, frühestens interval Sekunden nach dem letzten.
+    # Alle Läufe werden als Jobs in jobs (JobQueue) eingereiht, sodass z. B. ein Restore nicht auf sie wartet.
+    def __init__(self, backup_manager, backup_time, jobs, tracker=None, interval=900):
         self.backup_manager = backup_manager
         self.backup_time = backup_time
+        self.jobs = jobs
+        self.tracker = tracker
+        self.interval = interval
         self.stop_event = threading.Event()
         self.thread = None
 
@@ -12,24 +22,75 @@ class Scheduler:
         self.thread = threading.Thread(target=self.run_scheduler)
         self.thread.start()
 
+    def _next_run(self):
+        now = datetime.now()
+        run_time = datetime.combine(now.date(), self.backup_time)
+        if now >= run_time:
+            run_time += timedelta(days=1)
+        return run_time
+
     def run_scheduler(self):
+        if self.tracker is not None:
+            self.run_daemon()
+            return
         while not self.stop_event.is_set():
-            now = datetime.now()
-            run_time = datetime.combine(now.date(), self.backup_time)
-            if now >= run_time:
-                run_time += timedelta(days=1)
-            wait_seconds = (run_time - now).total_seconds()
+            wait_seconds = (self._next_run() - datetime.now()).total_seconds()
 
             # Warte bis zur nächsten geplanten Zeit oder bis das Stop-Event gesetzt ist
             if self.stop_event.wait(timeout=wait_seconds):
                 # Stop-Event wurde gesetzt, Thread beenden
                 break
 
-            # Backup-Operationen durchführen
-            self.backup_manager.backup_homes()
-            self.backup_manager.rotate_backups()
+            self.full_run()
+
+    def full_run(self):
+        return run_full_pass(self.jobs, self.backup_manager, 'scheduler')
+
+    def run_daemon(self):
+        # Nach dem Start meldet der Tracker alle Homes als geändert, der erste Lauf erfolgt daher sofort
+        next_full = self._next_run()
+        last_run = time.monotonic() - self.interval
+        while not self.stop_event.is_set():
+            if datetime.now() >= next_full:
+                # Der tägliche Lauf liest alle Homes vollständig und übernimmt Rotation und Prüfung
+                self.tracker.take()
+                if not self.full_run():
+                    self.tracker.mark_all()
+                next_full = self._next_run()
+                last_run = time.monotonic()
+                continue
+            timeout = (next_full - datetime.now()).total_seconds()
+            self.tracker.changed.clear()
+            if self.tracker.pending():
+                remaining = last_run + self.interval - time.monotonic()
+                if remaining <= 0:
+                    self.incremental_run()
+                    last_run = time.monotonic()
+                    continue
+                # Änderungen sammeln sich bis zum Ablauf des Intervalls
+                if self.stop_event.wait(timeout=min(timeout, remaining)):
+                    break
+            else:
+                self.tracker.changed.wait(timeout=timeout)
+
+    def incremental_run(self):
+        dirty = self.tracker.take()
+        if dirty is not None and not dirty:
+            return
+        scope = 'alle Benutzer' if dirty is None else ', '.join(sorted(dirty))
+        logging.info(f'Inkrementeller Lauf für {scope}.')
+        self.backup_manager.metrics.reset()
+        params = {} if dirty is None else {'dirty': {user: None if paths is None else sorted(paths)
+                                                     for user, paths in dirty.items()}}
+        job = self.jobs.submit('backup', params, source='daemon')
+        if self.jobs.wait(job.id) != 'done':
+            # Die Änderungen bleiben offen und werden nach interval erneut gesichert
+            self.tracker.restore(dirty)
+        self.backup_manager.write_metrics()
 
     def stop(self):
         self.stop_event.set()
+        if self.tracker is not None:
+            self.tracker.changed.set()
         if self.thread is not None:
-            self.thread.join()
\ No newline at end of file
+            self.thread.join()
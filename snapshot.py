@@ -0,0 +1,182 @@
+import os
+import shutil
+import logging
+from datetime import datetime
+
+# Name der Snapshots; enthält den Zeitpunkt, damit Reste abgebrochener Läufe erkennbar sind
+SNAPSHOT_PREFIX = 'backup-snapshot'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _run(command):
+    # subprocess erst laden, wenn tatsächlich ein Snapshot angelegt wird
+    import subprocess
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise SnapshotError(f'{command[0]} ist nicht installiert')
+    except subprocess.CalledProcessError as e:
+        raise SnapshotError(f'{" ".join(command)} fehlgeschlagen: {e.stderr.strip() or e.returncode}')
+    return result.stdout.strip()
+
+
+def _mount_info(path):
+    # (Quelle, Mount-Punkt, Dateisystemtyp) des Dateisystems, auf dem path liegt
+    output = _run(['findmnt', '-n', '-o', 'SOURCE,TARGET,FSTYPE', '--target', path])
+    source, target, fstype = output.splitlines()[0].split()
+    # Bei btrfs enthält SOURCE das Subvolume in eckigen Klammern, z. B. /dev/sda2[/@home]
+    return source.split('[')[0], target, fstype
+
+
+class SnapshotProvider:
+    # Erzeugt einen schreibgeschützten, konsistenten Zustand von source und gibt den Pfad zurück,
+    # unter dem der Inhalt von source im Snapshot liegt. release() gibt den Snapshot wieder frei.
+    name = None
+
+    def __init__(self, source, **options):
+        self.source = os.path.abspath(source)
+        self.options = options
+        self.path = None
+
+    def create(self):
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def _snapshot_name(self):
+        return f'{SNAPSHOT_PREFIX}-{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}'
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class BtrfsSnapshot(SnapshotProvider):
+    # source muss ein btrfs-Subvolume sein; der Snapshot liegt als verstecktes Subvolume daneben
+    name = 'btrfs'
+
+    def create(self):
+        path = os.path.join(self.source, f'.{self._snapshot_name()}')
+        _run(['btrfs', 'subvolume', 'snapshot', '-r', self.source, path])
+        self.path = path
+        return self.path
+
+    def release(self):
+        if self.path:
+            _run(['btrfs', 'subvolume', 'delete', self.path])
+            self.path = None
+
+
+class ZfsSnapshot(SnapshotProvider):
+    # Snapshots sind unter <Mount-Punkt>/.zfs/snapshot/<Name> ohne eigenes Mounten lesbar
+    name = 'zfs'
+
+    def create(self):
+        dataset, mountpoint, _ = _mount_info(self.source)
+        snapshot_name = self._snapshot_name()
+        _run(['zfs', 'snapshot', f'{dataset}@{snapshot_name}'])
+        self._snapshot = f'{dataset}@{snapshot_name}'
+        relative = os.path.relpath(self.source, mountpoint)
+        self.path = os.path.normpath(os.path.join(mountpoint, '.zfs', 'snapshot', snapshot_name, relative))
+        return self.path
+
+    def release(self):
+        if self.path:
+            _run(['zfs', 'destroy', self._snapshot])
+            self.path = None
+
+
+class LvmSnapshot(SnapshotProvider):
+    # Copy-on-Write-Snapshot des Logical Volumes, schreibgeschützt unter /run eingehängt.
+    # snapshot_size legt den Platz für Änderungen während des Backups fest (z. B. '10%ORIGIN' oder '5G').
+    name = 'lvm'
+
+    def create(self):
+        device, mountpoint, fstype = _mount_info(self.source)
+        size = self.options.get('snapshot_size') or '10%ORIGIN'
+        snapshot_name = self._snapshot_name()
+        size_option = ['-l', size] if '%' in size else ['-L', size]
+        _run(['lvcreate', '-s', '-n', snapshot_name, *size_option, device])
+        self._device = os.path.join(os.path.dirname(device), snapshot_name)
+        if device.startswith('/dev/mapper/'):
+            # /dev/mapper/vg-lv -> /dev/vg/<Snapshot>
+            volume_group = _run(['lvs', '--noheadings', '-o', 'vg_name', device])
+            self._device = os.path.join('/dev', volume_group, snapshot_name)
+        self._mountpoint = os.path.join('/run', snapshot_name)
+        try:
+            os.makedirs(self._mountpoint, exist_ok=True)
+            mount_options = 'ro,nouuid' if fstype == 'xfs' else 'ro'
+            _run(['mount', '-o', mount_options, self._device, self._mountpoint])
+        except (OSError, SnapshotError):
+            _run(['lvremove', '-f', self._device])
+            raise
+        self.path = os.path.normpath(os.path.join(self._mountpoint, os.path.relpath(self.source, mountpoint)))
+        return self.path
+
+    def release(self):
+        if self.path:
+            try:
+                _run(['umount', self._mountpoint])
+                os.rmdir(self._mountpoint)
+            finally:
+                _run(['lvremove', '-f', self._device])
+            self.path = None
+
+
+class DirectorySnapshot(SnapshotProvider):
+    # Ersatz ohne Snapshot-fähiges Dateisystem und für Tests: eine Kopie von source unter snapshot_dir.
+    # Konsistent nur, solange während des Kopierens nicht geschrieben wird.
+    name = 'directory'
+
+    def create(self):
+        snapshot_dir = self.options.get('snapshot_dir') or os.path.join(os.path.dirname(self.source), f'.{SNAPSHOT_PREFIX}')
+        path = os.path.join(snapshot_dir, self._snapshot_name())
+        try:
+            shutil.copytree(self.source, path, symlinks=True)
+        except (OSError, shutil.Error) as e:
+            shutil.rmtree(path, ignore_errors=True)
+            raise SnapshotError(f'Kopie von {self.source} fehlgeschlagen: {e}')
+        self.path = path
+        return self.path
+
+    def release(self):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+
+SNAPSHOT_PROVIDERS = {
+    provider.name: provider for provider in (BtrfsSnapshot, ZfsSnapshot, LvmSnapshot, DirectorySnapshot)
+}
+
+
+def detect_provider(source):
+    # Passenden Provider anhand des Dateisystems wählen; None, wenn keiner verfügbar ist
+    try:
+        device, _, fstype = _mount_info(source)
+    except SnapshotError as e:
+        logging.warning(f'Dateisystem von {source} konnte nicht ermittelt werden: {e}')
+        return None
+    if fstype in ('btrfs', 'zfs'):
+        return fstype
+    if device.startswith('/dev/mapper/') and shutil.which('lvcreate'):
+        return 'lvm'
+    return None
+
+
+def create_snapshot_provider(name, source, **options):
+    # name: 'auto' oder ein Schlüssel aus SNAPSHOT_PROVIDERS
+    if name == 'auto':
+        name = detect_provider(source)
+        if name is None:
+            return None
+    if name not in SNAPSHOT_PROVIDERS:
+        raise ValueError(f'Unbekannter Snapshot-Provider: {name}')
+    return SNAPSHOT_PROVIDERS[name](source, **options)
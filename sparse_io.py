@@ -0,0 +1,193 @@
+import os
+import mmap
+import errno
+import stat
+import logging
+
+# Dateien ab dieser Größe kopiert der rsync-Modus selbst im Kernel (copy_file_range/sendfile)
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+# Puffer für Kopien und Nullvergleiche; per mmap angelegt und damit an Seitengrenzen ausgerichtet
+BUFFER_SIZE = 8 * 1024 * 1024
+# Kleinste Lücke, die beim Restore als Loch statt als Nullen geschrieben wird
+HOLE_BLOCK = 64 * 1024
+# Kleinere Dateien werden nie nach Löchern durchsucht
+SPARSE_MIN_SIZE = 1024 * 1024
+# ioctl zum Klonen einer Datei (btrfs, XFS, NFS 4.2), aus linux/fs.h
+FICLONE = 0x40049409
+
+ZERO_BLOCK = bytes(BUFFER_SIZE)
+# Fehler, nach denen auf die nächste Kopiermethode ausgewichen wird
+_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+
+def is_sparse(st):
+    # Weniger belegte Blöcke als Daten: die Datei enthält vermutlich Löcher (oder ist vom Dateisystem komprimiert)
+    return stat.S_ISREG(st.st_mode) and st.st_size >= SPARSE_MIN_SIZE and st.st_blocks * 512 < st.st_size
+
+
+def data_regions(fd, size):
+    # (Offset, Länge) aller Datenbereiche per SEEK_DATA/SEEK_HOLE. Ohne Unterstützung des
+    # Dateisystems gilt die ganze Datei als ein Bereich.
+    regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nur noch ein Loch bis zum Dateiende
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            regions.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        regions = [(0, size)] if size else []
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return regions
+
+
+def has_holes(regions, size):
+    return sum(length for _, length in regions) < size
+
+
+def is_zero(data):
+    # Vergleich gegen einen Nullblock per memcmp, deutlich schneller als Zählen der Bytes
+    n = len(data)
+    for start in range(0, n, BUFFER_SIZE):
+        end = min(n, start + BUFFER_SIZE)
+        if data[start:end] != ZERO_BLOCK[:end - start]:
+            return False
+    return True
+
+
+def write_skipping_zeros(f, data):
+    # Schreibt data an die aktuelle Position von f; Nullblöcke werden übersprungen und bleiben Löcher
+    view = memoryview(data)
+    for start in range(0, len(view), HOLE_BLOCK):
+        block = view[start:start + HOLE_BLOCK]
+        if is_zero(block):
+            f.seek(len(block), os.SEEK_CUR)
+        else:
+            f.write(block)
+
+
+def hash_zeros(hasher, count):
+    # Löcher gehen als Nullbytes in die Prüfsumme ein, ohne dass sie gelesen werden
+    view = memoryview(ZERO_BLOCK)
+    while count > 0:
+        n = min(count, BUFFER_SIZE)
+        hasher.update(view[:n])
+        count -= n
+
+
+def reflink(source_fd, target_fd):
+    # Klont die Datei ohne Datenkopie, wenn Quelle und Ziel auf demselben Dateisystem mit Reflinks liegen
+    import fcntl
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED + (errno.EPERM,):
+            return False
+        raise
+
+
+class _RangeCopier:
+    # Kopiert Bereiche zwischen zwei Dateideskriptoren ohne Umweg über den Benutzeradressraum:
+    # copy_file_range (bei NFS 4.2 serverseitig), sonst sendfile, zuletzt über einen ausgerichteten Puffer.
+    # Eine Methode, die einmal fehlschlägt, wird für diese Datei nicht erneut versucht.
+    def __init__(self, source_fd, target_fd, throttle=None):
+        self.source_fd = source_fd
+        self.target_fd = target_fd
+        self.throttle = throttle
+        self.method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile'
+        self._buffer = None
+
+    def copy(self, offset, length):
+        # Gibt die Anzahl kopierter Bytes zurück; weniger als length, wenn die Quelle inzwischen kürzer ist
+        done = 0
+        while done < length:
+            count = min(length - done, BUFFER_SIZE)
+            if self.throttle is not None:
+                self.throttle(count)
+            copied = self._copy_once(offset + done, count)
+            if not copied:
+                break
+            done += copied
+        return done
+
+    def _copy_once(self, offset, count):
+        if self.method == 'copy_file_range':
+            try:
+                return os.copy_file_range(self.source_fd, self.target_fd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                self.method = 'sendfile'
+        if self.method == 'sendfile':
+            try:
+                os.lseek(self.target_fd, offset, os.SEEK_SET)
+                return os.sendfile(self.target_fd, self.source_fd, offset, count)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                logging.debug(f'sendfile nicht möglich ({e}), kopiere über Puffer.')
+                self.method = 'buffer'
+        if self._buffer is None:
+            self._buffer = mmap.mmap(-1, BUFFER_SIZE)
+        view = memoryview(self._buffer)[:count]
+        read = os.preadv(self.source_fd, [view], offset)
+        written = 0
+        while written < read:
+            written += os.pwrite(self.target_fd, view[written:read], offset + written)
+        return read
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+
+def copy_file(source, target, throttle=None):
+    # Kopiert den Inhalt von source nach target und erhält Löcher. Gibt die Anzahl übertragener Bytes
+    # zurück (0 bei einem Reflink). throttle(n) wird vor jedem Abschnitt aufgerufen.
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        st = os.fstat(src.fileno())
+        if reflink(src.fileno(), dst.fileno()):
+            return 0
+        regions = data_regions(src.fileno(), st.st_size) if is_sparse(st) else [(0, st.st_size)]
+        copier = _RangeCopier(src.fileno(), dst.fileno(), throttle)
+        copied = 0
+        try:
+            for offset, length in regions:
+                copied += copier.copy(offset, length)
+        finally:
+            copier.close()
+        # Setzt die Größe auch hinter einem abschließenden Loch
+        os.ftruncate(dst.fileno(), st.st_size)
+        return copied
+
+
+def write_regions(fileobj, target, regions, size, throttle=None):
+    # Schreibt die Datenbereiche einer Sparse-Datei aus fileobj (seekbar, liefert die Datei mit Nullen
+    # in den Löchern) nach target; die Löcher werden übersprungen und bleiben unbelegt
+    with open(target, 'wb') as f:
+        for offset, length in regions:
+            fileobj.seek(offset)
+            f.seek(offset)
+            while length > 0:
+                data = fileobj.read(min(length, BUFFER_SIZE))
+                if not data:
+                    break
+                if throttle is not None:
+                    throttle(len(data))
+                f.write(data)
+                length -= len(data)
+        f.truncate(size)
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+
+# Anzahl der Starts, aus denen der Median gebildet wird
+RUNS = 5
+# Anzahl der Module mit der längsten Importzeit im Bericht
+TOP_MODULES = 15
+# Module, die der Service-Modus nie laden soll
+INTERACTIVE_MODULES = ('cli', 'colorama', 'tqdm', 'requests')
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def _start(mode, importtime=False):
+    # Startet main.py --startup-check in einem neuen Interpreter; gibt (Dauer in ms, Bericht, stderr) zurück
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [MAIN_PATH, '--startup-check', mode]
+    started = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    elapsed = (time.perf_counter() - started) * 1000
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(output):
+    # Zeilen von -X importtime: 'import time: <selbst µs> | <kumuliert µs> | <Einrückung><Modul>'
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # Eine Ebene entspricht zwei Leerzeichen; Importe auf oberster Ebene haben eines
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def startup_profile(mode='service', runs=RUNS):
+    # Median der Prozessdauer und der Zeit bis zur Betriebsbereitschaft, dazu die teuersten Importe
+    timings = [_start(mode) for _ in range(runs)]
+    _, report, importtime = _start(mode, importtime=True)
+    modules = parse_importtime(importtime)
+    return {
+        'mode': mode,
+        'process_ms': statistics.median(elapsed for elapsed, _, _ in timings),
+        'ready_ms': statistics.median(run['ready_ms'] for _, run, _ in timings),
+        'modules_loaded': len(report['modules']),
+        'interactive_modules': [name for name in INTERACTIVE_MODULES if name in report['modules']],
+        'top_level': sorted(((name, cumulative) for name, _, cumulative, depth in modules if depth == 0),
+                            key=lambda item: item[1], reverse=True)[:TOP_MODULES],
+        'self_time': sorted(((name, self_us) for name, self_us, _, _ in modules),
+                            key=lambda item: item[1], reverse=True)[:TOP_MODULES],
+    }
+
+
+def print_startup_profile(mode='service'):
+    profile = startup_profile(mode)
+    print(f"Startprofil ({profile['mode']}, Median aus {RUNS} Starts)")
+    print(f"  Prozess gesamt:     {profile['process_ms']:.1f} ms")
+    print(f"  bis betriebsbereit: {profile['ready_ms']:.1f} ms (ab Start von main.py)")
+    print(f"  geladene Module:    {profile['modules_loaded']}")
+    if mode == 'service' and profile['interactive_modules']:
+        print(f"  WARNUNG: interaktive Module geladen: {', '.join(profile['interactive_modules'])}")
+    print('\nImporte auf oberster Ebene (kumuliert):')
+    for name, cumulative in profile['top_level']:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+    print('\nEinzelne Module (ohne Untermodule):')
+    for name, self_us in profile['self_time']:
+        print(f'  {self_us / 1000:8.1f} ms  {name}')
@@ -0,0 +1,273 @@
+import os
+import gzip
+import json
+import stat
+import hashlib
+import logging
+
+STAT_CACHE_NAME = '.statcache.json.gz'
+
+
+def signature(st):
+    # Ändert sich eine dieser Angaben, gilt der Eintrag als verändert. ctime erfasst auch
+    # Änderungen, bei denen die mtime zurückgesetzt wurde, sowie geänderte Rechte und Besitzer.
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_mode, st.st_uid, st.st_gid]
+
+
+def _join(rel_dir, name):
+    return f'{rel_dir}/{name}' if rel_dir else name
+
+
+class StatCache:
+    # Persistenter Stat-Cache eines Benutzers im Backup-Verzeichnis.
+    # dirs:   relativer Verzeichnispfad -> {'digest': Baum-Digest oder None, 'entries': Name -> Signatur}
+    # backup: Name des Backups, das genau diesen Zustand gesichert hat
+    # rules:  Fingerabdruck der Filterregeln, mit denen dieser Zustand gesichert wurde
+    def __init__(self, user_backup_dir):
+        self.path = os.path.join(user_backup_dir, STAT_CACHE_NAME)
+        self.backup = None
+        self.rules = None
+        self.dirs = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            self.backup = data.get('backup')
+            self.rules = data.get('rules')
+            self.dirs = data.get('dirs', {})
+        except (OSError, ValueError) as e:
+            # Ein unlesbarer Cache bedeutet nur, dass alles als verändert gilt
+            logging.warning(f'Stat-Cache {self.path} konnte nicht gelesen werden: {e}')
+            self.backup = None
+            self.dirs = {}
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'backup': self.backup, 'rules': self.rules, 'dirs': self.dirs}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    @property
+    def digest(self):
+        return self.dirs.get('', {}).get('digest')
+
+    def scan(self, source_dir, rules=None, dirty=None):
+        return TreeScan(self, source_dir, rules, dirty)
+
+    def update(self, tree, backup):
+        # Übernimmt den Zustand eines erfolgreich gesicherten Scans. Verzeichnisse mit nicht
+        # gesicherten Einträgen erhalten keinen Digest und gelten beim nächsten Lauf als verändert.
+        invalid = set(tree.failed_dirs)
+        for path in tree.failed:
+            rel_dir = path
+            while True:
+                invalid.add(rel_dir)
+                if not rel_dir:
+                    break
+                rel_dir = os.path.dirname(rel_dir)
+
+        dirs = {}
+        for rel_dir, listing in tree.listings.items():
+            entries = {}
+            for name, st in listing:
+                if _join(rel_dir, name) not in tree.failed:
+                    entries[name] = signature(st)
+            digest = None if rel_dir in invalid else tree.digests.get(rel_dir)
+            dirs[rel_dir] = {'digest': digest, 'entries': entries}
+        if tree.reused:
+            # Von einem Teilscan nicht gelesene Unterbäume bleiben, wie sie im Cache stehen
+            for rel_dir, cached in self.dirs.items():
+                if rel_dir in dirs or not tree.is_reused(rel_dir):
+                    continue
+                entries = {name: sig for name, sig in cached['entries'].items() if _join(rel_dir, name) not in tree.failed}
+                dirs[rel_dir] = {'digest': None if rel_dir in invalid else cached['digest'], 'entries': entries}
+        self.dirs = dirs
+        self.backup = backup
+        self.rules = tree.rules_fingerprint
+
+
+class TreeScan:
+    # Ein einziger Durchlauf mit os.scandir und lstat über den Quellbaum. Pro Verzeichnis wird ein
+    # Digest über die Signaturen aller Einträge und die Digests der Unterverzeichnisse gebildet,
+    # sodass ein gleicher Digest den gesamten Unterbaum als unverändert ausweist.
+    # Von rules ausgeschlossene Einträge fehlen in den Listings; ausgeschlossene Verzeichnisse
+    # werden nicht gelesen und stehen mit allen anderen Ausschlüssen in excluded.
+    # Mit dirty (Verzeichnisse relativ zu source_dir, in denen seit dem gecachten Zustand Änderungen
+    # gemeldet wurden) entsteht ein Teilscan: gelesen werden nur diese Verzeichnisse, ihre Vorfahren
+    # und Verzeichnisse ohne gültigen Cache-Eintrag. Alle übrigen Unterbäume (reused) übernehmen
+    # ihren Digest aus dem Cache und werden von walk(prune_unchanged=True) übersprungen.
+    def __init__(self, cache, source_dir, rules=None, dirty=None):
+        self.cache = cache
+        self.source_dir = source_dir
+        self.rules = rules if rules is not None and rules.active else None
+        self.rules_fingerprint = self.rules.fingerprint if self.rules is not None else None
+        self.excluded = []
+        self.reused = set()
+        # Nach geänderten Regeln beschreibt der Cache nicht mehr, was gesichert würde
+        self.partial = dirty is not None and bool(cache.dirs) and cache.rules == self.rules_fingerprint
+        self.listings = {}
+        self.dir_stats = {}
+        self.digests = {}
+        # Nicht lesbare Verzeichnisse und Einträge, die beim Backup fehlgeschlagen sind
+        self.failed_dirs = set()
+        self.failed = set()
+        self._pruned = []
+        self._scan(dirty if self.partial else None)
+
+    def _must_scan(self, rel_path, st, rel_dir, dirty):
+        if rel_path in dirty:
+            return True
+        cached = self.cache.dirs.get(rel_path)
+        if cached is None or cached.get('digest') is None:
+            return True
+        # Auch ohne Meldung: ein Verzeichnis mit geänderten Einträgen hat eine neue mtime
+        return self.cache.dirs.get(rel_dir, {}).get('entries', {}).get(rel_path.rpartition('/')[2]) != signature(st)
+
+    def _scan(self, dirty=None):
+        if dirty is not None:
+            # Vorfahren gemeldeter Verzeichnisse werden ebenfalls gelesen, damit ihre Digests neu entstehen
+            closure = set()
+            for rel_dir in dirty:
+                while rel_dir and rel_dir not in closure:
+                    closure.add(rel_dir)
+                    rel_dir = os.path.dirname(rel_dir)
+            dirty = closure
+        order = []
+        stack = ['']
+        try:
+            self.dir_stats[''] = os.lstat(self.source_dir)
+        except OSError:
+            self.dir_stats[''] = None
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = os.path.join(self.source_dir, rel_dir) if rel_dir else self.source_dir
+            listing = []
+            subdirs = []
+            try:
+                with os.scandir(abs_dir) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except PermissionError:
+                logging.warning(f'Zugriff verweigert: {abs_dir}')
+                self.failed_dirs.add(rel_dir)
+                entries = []
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                except PermissionError:
+                    logging.warning(f'Zugriff verweigert: {entry.path}')
+                    self.failed_dirs.add(rel_dir)
+                    continue
+                rel_path = _join(rel_dir, entry.name)
+                if self.rules is not None and self.rules.excluded(rel_path, st, entry.path):
+                    self.excluded.append(rel_path)
+                    continue
+                listing.append((entry.name, st))
+                if stat.S_ISDIR(st.st_mode):
+                    self.dir_stats[rel_path] = st
+                    if dirty is None or self._must_scan(rel_path, st, rel_dir, dirty):
+                        subdirs.append(rel_path)
+                    else:
+                        self.reused.add(rel_path)
+                        self.digests[rel_path] = self.cache.dirs[rel_path]['digest']
+            self.listings[rel_dir] = listing
+            order.append(rel_dir)
+            stack.extend(reversed(subdirs))
+
+        # Unterverzeichnisse stehen in order immer hinter ihrem Elternverzeichnis
+        for rel_dir in reversed(order):
+            own = self.dir_stats.get(rel_dir)
+            digest = None if rel_dir in self.failed_dirs or own is None else hashlib.sha1()
+            if digest is not None:
+                # Die eigene Signatur gehört dazu, damit geänderte Rechte das Verzeichnis nicht überspringen lassen
+                digest.update(repr(signature(own)).encode())
+            for name, st in self.listings[rel_dir]:
+                if digest is None:
+                    break
+                digest.update(name.encode('utf-8', 'surrogateescape'))
+                digest.update(repr(signature(st)).encode())
+                if stat.S_ISDIR(st.st_mode):
+                    child = self.digests.get(_join(rel_dir, name))
+                    if child is None:
+                        digest = None
+                        break
+                    digest.update(child.encode())
+            self.digests[rel_dir] = digest.hexdigest() if digest is not None else None
+
+    @property
+    def digest(self):
+        return self.digests.get('')
+
+    def unchanged(self, rel_dir=''):
+        # Unterbaum seit dem letzten gesicherten Zustand unverändert. Nach geänderten Regeln
+        # kann ein bisher ausgeschlossener Eintrag hinzukommen, daher gilt dann alles als verändert.
+        if self.rules_fingerprint != self.cache.rules:
+            return False
+        digest = self.digests.get(rel_dir)
+        return digest is not None and digest == self.cache.dirs.get(rel_dir, {}).get('digest')
+
+    def file_unchanged(self, path, st):
+        cached = self.cache.dirs.get(os.path.dirname(path), {}).get('entries', {})
+        return cached.get(os.path.basename(path)) == signature(st)
+
+    def mark_failed(self, path):
+        self.failed.add(path)
+
+    def is_reused(self, rel_dir):
+        # Liegt rel_dir in einem aus dem Cache übernommenen Unterbaum?
+        while rel_dir:
+            if rel_dir in self.reused:
+                return True
+            rel_dir = os.path.dirname(rel_dir)
+        return False
+
+    def _children(self, rel_dir):
+        # (Name, stat oder None, Verzeichnis?) aus dem Scan, für übernommene Unterbäume aus dem Cache
+        if rel_dir in self.listings:
+            for name, st in self.listings[rel_dir]:
+                yield name, st, stat.S_ISDIR(st.st_mode)
+        else:
+            for name, sig in self.cache.dirs.get(rel_dir, {}).get('entries', {}).items():
+                yield name, None, stat.S_ISDIR(sig[4])
+
+    def walk(self, prune_unchanged=False):
+        # Liefert (Pfad, relativer Pfad, stat) in derselben Reihenfolge wie scan_tree, ohne erneute
+        # Systemaufrufe. Mit prune_unchanged werden unveränderte Unterbäume vollständig übersprungen.
+        if self.partial and not prune_unchanged:
+            raise ValueError('Ein Teilscan enthält nicht alle Einträge und kann nur mit prune_unchanged durchlaufen werden')
+        self._pruned = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            subdirs = []
+            for name, st in self.listings.get(rel_dir, ()):
+                rel_path = _join(rel_dir, name)
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if is_dir and prune_unchanged and self.unchanged(rel_path):
+                    self._pruned.append(rel_path)
+                    continue
+                yield os.path.join(self.source_dir, rel_path), rel_path, st
+                if is_dir:
+                    subdirs.append(rel_path)
+            stack.extend(reversed(subdirs))
+
+    def pruned_entries(self):
+        # Alle Einträge der beim letzten walk() übersprungenen Unterbäume, einschließlich der Verzeichnisse
+        # selbst; bei aus dem Cache übernommenen Unterbäumen ohne stat (None)
+        for rel_dir in self._pruned:
+            yield rel_dir, self.dir_stats[rel_dir]
+            stack = [rel_dir]
+            while stack:
+                current = stack.pop()
+                for name, st, is_dir in self._children(current):
+                    rel_path = _join(current, name)
+                    yield rel_path, st
+                    if is_dir:
+                        stack.append(rel_path)
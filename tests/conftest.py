@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup_manager import BackupManager
+
+
+class RecordingNotifier:
+    def __init__(self):
+        self.messages = []
+
+    def send_notification(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    # Backup-Manager auf einem lokalen Verzeichnis statt des NFS-Shares, Homes unter tmp_path/home
+    home_dir = tmp_path / 'home'
+    nfs_dir = tmp_path / 'nfs'
+    home_dir.mkdir()
+    nfs_dir.mkdir()
+
+    def make(compress='gzip', **options):
+        manager = BackupManager(str(nfs_dir), 30, RecordingNotifier(), compress, **options)
+        manager.home_dir = str(home_dir)
+        manager.require_mount = False
+        manager.show_progress = False
+        return manager
+    return make
+
+
+@pytest.fixture
+def home(tmp_path):
+    # Home des Benutzers alice
+    path = tmp_path / 'home' / 'alice'
+    path.mkdir(parents=True)
+    return path
@@ -0,0 +1,38 @@
+import os
+import socket
+import sqlite3
+
+from catalog import CATALOG_NAME
+
+
+def foreign_catalog(make_manager, home, tmp_path):
+    # Backup wie von einem anderen Host: das Host-Verzeichnis wird umbenannt
+    (home / 'a.txt').write_text('a')
+    manager = make_manager()
+    assert manager.backup_homes()
+    nfs_dir = tmp_path / 'nfs'
+    os.rename(nfs_dir / socket.gethostname(), nfs_dir / 'otherhost')
+    return manager, nfs_dir / 'otherhost' / 'alice' / CATALOG_NAME
+
+
+def test_foreign_catalog_is_only_read(make_manager, home, tmp_path):
+    manager, catalog_path = foreign_catalog(make_manager, home, tmp_path)
+    before = catalog_path.read_bytes()
+    matches = manager.search_user_backups('alice', 'a.txt', host='otherhost')
+    assert [match['path'] for match in matches] == ['a.txt']
+    assert catalog_path.read_bytes() == before
+
+
+def test_foreign_legacy_catalog_is_migrated_in_memory(make_manager, home, tmp_path):
+    manager, catalog_path = foreign_catalog(make_manager, home, tmp_path)
+    # Katalog im alten Format (Pfade als Text) ohne das Backup in der Liste der indizierten Backups
+    connection = sqlite3.connect(catalog_path)
+    with connection:
+        connection.execute('UPDATE files SET path = CAST(path AS TEXT)')
+        connection.execute('DELETE FROM backups')
+        connection.execute('PRAGMA user_version = 0')
+    connection.close()
+    before = catalog_path.read_bytes()
+    matches = manager.search_user_backups('alice', 'a.txt', host='otherhost')
+    assert [match['path'] for match in matches] == ['a.txt']
+    assert catalog_path.read_bytes() == before
@@ -0,0 +1,61 @@
+import os
+import time
+
+import chunk_store
+
+
+def chunk_files(manager):
+    objects_dir = manager.chunk_store.objects_dir
+    return {name for _, _, names in os.walk(objects_dir) for name in names}
+
+
+def test_dedup_round_trip(make_manager, home, tmp_path):
+    (home / 'docs').mkdir()
+    (home / 'docs' / 'a.txt').write_bytes(b'a' * 100000)
+    (home / 'docs' / 'bin').write_bytes(os.urandom(300000))
+    os.link(home / 'docs' / 'a.txt', home / 'b.txt')
+    os.link(home / 'docs' / 'a.txt', home / 'c.txt')
+    os.symlink('docs/a.txt', home / 'link')
+    (home / 'empty').mkdir()
+    manager = make_manager(dedup_backups=True)
+    assert manager.backup_homes()
+    backup = manager.list_backups()[0]
+    assert manager.verify_backups() == {}
+
+    manager.home_dir = str(tmp_path / 'restore')
+    assert manager.restore_backup(backup['path'], 'alice')
+    restored = tmp_path / 'restore' / 'alice'
+    assert (restored / 'docs' / 'a.txt').read_bytes() == (home / 'docs' / 'a.txt').read_bytes()
+    assert (restored / 'docs' / 'bin').read_bytes() == (home / 'docs' / 'bin').read_bytes()
+    assert os.stat(restored / 'b.txt').st_ino == os.stat(restored / 'docs' / 'a.txt').st_ino
+    assert os.stat(restored / 'docs' / 'a.txt').st_nlink == 3
+    assert os.readlink(restored / 'link') == 'docs/a.txt'
+    assert (restored / 'empty').is_dir()
+
+
+def test_garbage_collection_keeps_referenced_chunks(make_manager, home, tmp_path, monkeypatch):
+    (home / 'kept.txt').write_bytes(b'kept' * 10000)
+    (home / 'old.txt').write_bytes(b'old' * 10000)
+    manager = make_manager(dedup_backups=True)
+    assert manager.backup_homes()
+    first = manager.list_backups()[0]
+    chunks_before = chunk_files(manager)
+
+    # Zeitstempel der Backups auf Sekunden genau
+    time.sleep(1.1)
+    (home / 'old.txt').unlink()
+    assert manager.backup_homes()
+    assert len(manager.list_backups()) == 2
+
+    os.remove(first['path'])
+    monkeypatch.setattr(chunk_store, 'GC_GRACE_SECONDS', -60)
+    manager.collect_chunk_garbage()
+    chunks_after = chunk_files(manager)
+    assert chunks_after and chunks_after < chunks_before
+
+    latest = [b for b in manager.list_backups() if b['path'] != first['path']][0]
+    assert manager.verify_backups() == {}
+    manager.home_dir = str(tmp_path / 'restore')
+    assert manager.restore_backup(latest['path'], 'alice')
+    assert (tmp_path / 'restore' / 'alice' / 'kept.txt').read_bytes() == b'kept' * 10000
+    assert not (tmp_path / 'restore' / 'alice' / 'old.txt').exists()
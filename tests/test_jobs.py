@@ -0,0 +1,21 @@
+from backup_manager import _rotation_report
+from jobs import Job, manager_handlers
+
+
+def test_rotate_job_fails_on_delete_errors(make_manager, monkeypatch):
+    manager = make_manager()
+    report = _rotation_report()
+    report['deleted'] = ['/nfs/host/alice/backup_1']
+    report['errors'] = {'/nfs/host/alice/backup_2': PermissionError('Zugriff verweigert')}
+    monkeypatch.setattr(manager, 'rotate_backups', lambda: {'host': report})
+    job = Job(1, 'rotate')
+    assert manager_handlers(manager)['rotate'](job) is False
+    assert job.detail == '1 Backups gelöscht; /nfs/host/alice/backup_2: Zugriff verweigert'
+
+
+def test_rotate_job_succeeds_without_errors(make_manager, monkeypatch):
+    manager = make_manager()
+    monkeypatch.setattr(manager, 'rotate_backups', lambda: {'host': _rotation_report()})
+    job = Job(1, 'rotate')
+    assert manager_handlers(manager)['rotate'](job) is True
+    assert job.detail == '0 Backups gelöscht'
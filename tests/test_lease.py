@@ -0,0 +1,97 @@
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import lease
+from lease import Lease, LeaseLost
+from retention import delete_backups
+
+
+def write_holder(path, owner, expires_in):
+    with open(path, 'w') as f:
+        json.dump({'owner': owner, 'expires': time.time() + expires_in}, f)
+
+
+def test_check_raises_after_takeover(tmp_path):
+    path = str(tmp_path / 'lease')
+    held = Lease(path, ttl=0.3).acquire()
+    held.check()
+    # Ein anderer Host übernimmt die Sperre
+    write_holder(path, 'other:1:x', 60)
+    time.sleep(0.3)
+    assert held.lost
+    with pytest.raises(LeaseLost):
+        held.check()
+    held.release()
+    # Die Sperre des neuen Besitzers bleibt erhalten
+    assert json.load(open(path))['owner'] == 'other:1:x'
+
+
+def test_check_raises_after_release(tmp_path):
+    held = Lease(str(tmp_path / 'lease')).acquire()
+    held.release()
+    with pytest.raises(LeaseLost):
+        held.check()
+
+
+def test_delete_stops_when_lease_lost(tmp_path):
+    paths = []
+    for name in ('backup_1', 'backup_2'):
+        (tmp_path / name).mkdir()
+        paths.append(str(tmp_path / name))
+
+    def check():
+        raise LeaseLost('verloren')
+    with ThreadPoolExecutor(2) as executor:
+        deleted, errors = delete_backups(paths, executor, check)
+    assert deleted == []
+    assert set(errors) == set(paths)
+    assert all(os.path.isdir(path) for path in paths)
+
+
+def test_backup_aborts_when_lease_lost(make_manager, home, monkeypatch):
+    (home / 'a.txt').write_text('a')
+    manager = make_manager()
+    monkeypatch.setattr(lease.Lease, 'held', lambda self: False)
+    assert manager.backup_homes() is False
+    assert any('Sperre' in message for message in manager.notifier.messages)
+    assert not os.path.exists(os.path.join(manager.nfs_mount_point, socket.gethostname(), 'alice'))
+
+
+def test_expired_lease_is_taken_over(tmp_path, monkeypatch):
+    monkeypatch.setattr(lease, 'STEAL_SETTLE', 0)
+    path = str(tmp_path / 'lease')
+    write_holder(path, 'other:1:x', -1)
+    with Lease(path) as held:
+        assert held.holder()['owner'] == held.owner
+
+
+def test_valid_lease_of_other_host_is_not_taken(tmp_path):
+    path = str(tmp_path / 'lease')
+    write_holder(path, 'other:1:x', 60)
+    with pytest.raises(lease.LeaseError):
+        Lease(path).acquire()
+    assert json.load(open(path))['owner'] == 'other:1:x'
+
+
+def test_lease_of_dead_local_process_is_taken_over(tmp_path, monkeypatch):
+    monkeypatch.setattr(lease, 'STEAL_SETTLE', 0)
+    path = str(tmp_path / 'lease')
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    write_holder(path, f'{socket.gethostname()}:{pid}:x', 60)
+    with Lease(path) as held:
+        assert held.holder()['owner'] == held.owner
+
+
+def test_lease_of_live_local_process_is_not_taken(tmp_path):
+    path = str(tmp_path / 'lease')
+    write_holder(path, f'{socket.gethostname()}:{os.getppid()}:x', 60)
+    with pytest.raises(lease.LeaseError):
+        Lease(path).acquire()
@@ -0,0 +1,86 @@
+import io
+import os
+import shutil
+import tarfile
+
+import pytest
+
+from restore_pipeline import ParallelRestorer, restore_tar_stream
+
+
+def make_tar(entries):
+    # entries: (Name, Typ, Inhalt bzw. Linkziel)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, kind, value in entries:
+            info = tarfile.TarInfo(name)
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif kind == 'link':
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+                tar.addfile(info)
+            else:
+                info.size = len(value)
+                tar.addfile(info, io.BytesIO(value))
+    buffer.seek(0)
+    return buffer
+
+
+def restore(entries, target):
+    restorer = ParallelRestorer(str(target))
+    try:
+        with tarfile.open(fileobj=make_tar(entries), mode='r|') as tar:
+            for _ in restore_tar_stream(tar, restorer):
+                pass
+        restorer.finish()
+    except BaseException:
+        restorer.abort()
+        raise
+
+
+def test_file_below_symlink_is_refused(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    with pytest.raises(ValueError):
+        restore([('x', 'link', str(outside)), ('x/evil', 'file', b'boom')], tmp_path / 'target')
+    assert not (outside / 'evil').exists()
+
+
+def test_directory_replaces_symlink(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    target = tmp_path / 'target'
+    restore([('x', 'link', str(outside)), ('x', 'dir', None), ('x/file', 'file', b'data')], target)
+    assert not os.path.islink(target / 'x')
+    assert (target / 'x' / 'file').read_bytes() == b'data'
+    assert os.listdir(outside) == []
+
+
+def test_parent_traversal_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        restore([('../evil', 'file', b'boom')], tmp_path / 'target')
+    assert not (tmp_path / 'evil').exists()
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    pytest.param({'compress': None}, marks=pytest.mark.skipif(shutil.which('rsync') is None, reason='rsync fehlt')),
+])
+def test_single_file_restore_does_not_follow_planted_symlink(make_manager, home, tmp_path, options):
+    (home / 'docs').mkdir()
+    (home / 'docs' / 'file.txt').write_text('original')
+    manager = make_manager(**options)
+    assert manager.backup_homes()
+    backup = manager.list_backups()[0]
+
+    # Nach dem Backup zeigt docs auf ein fremdes Verzeichnis
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (home / 'docs' / 'file.txt').unlink()
+    (home / 'docs').rmdir()
+    os.symlink(outside, home / 'docs')
+
+    manager.restore_file_from_backup(backup, 'docs/file.txt')
+    assert os.listdir(outside) == []
@@ -0,0 +1,50 @@
+import os
+
+from sparse_io import data_regions
+
+
+def make_sparse(path, size=50 * 1024 * 1024, data=b'payload'):
+    # Datei mit einem Datenbereich am Ende, der Rest ist ein Loch
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        f.seek(size - len(data))
+        f.write(data)
+
+
+def test_verify_fresh_archive_with_sparse_file(make_manager, home):
+    make_sparse(home / 'disk.img')
+    (home / 'note.txt').write_text('hello')
+    manager = make_manager()
+    manager.backup_homes()
+
+    assert manager.verify_backups() == {}
+
+
+def test_sparse_file_restores_sparse(make_manager, home, tmp_path):
+    make_sparse(home / 'disk.img')
+    manager = make_manager()
+    manager.backup_homes()
+    backup = manager.list_backups()[0]
+
+    manager.home_dir = str(tmp_path / 'restore')
+    assert manager.restore_backup(backup['path'], 'alice')
+
+    restored = tmp_path / 'restore' / 'alice' / 'disk.img'
+    assert restored.read_bytes() == (home / 'disk.img').read_bytes()
+    assert restored.stat().st_blocks * 512 < 1024 * 1024
+    with open(restored, 'rb') as f:
+        assert data_regions(f.fileno(), restored.stat().st_size)[0][0] > 0
+
+
+def test_sparse_file_in_dedup_backup(make_manager, home, tmp_path):
+    make_sparse(home / 'disk.img')
+    manager = make_manager(dedup_backups=True)
+    manager.backup_homes()
+    backup = manager.list_backups()[0]
+    assert manager.verify_backups() == {}
+
+    manager.home_dir = str(tmp_path / 'restore')
+    assert manager.restore_backup(backup['path'], 'alice')
+    restored = tmp_path / 'restore' / 'alice' / 'disk.img'
+    assert restored.read_bytes() == (home / 'disk.img').read_bytes()
+    assert restored.stat().st_blocks * 512 < 1024 * 1024
@@ -0,0 +1,245 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Adaptiver Modus: oberhalb dieser Werte wird die Rate halbiert, darunter schrittweise wieder erhöht
+MAX_LOAD_PER_CPU = 1.5
+MAX_DISK_LATENCY_MS = 50
+ADAPT_INTERVAL = 1.0
+MIN_RATE = 1024 * 1024
+
+# I/O-Scheduling-Klassen wie bei ionice
+IO_CLASSES = {'': 0, 'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+# Systemaufrufnummern von ioprio_set/ioprio_get, Python bietet dafür keine Funktion
+_IOPRIO_SYSCALLS = {
+    'x86_64': (251, 252),
+    'aarch64': (30, 31),
+    'i686': (289, 290),
+    'armv7l': (314, 315),
+    'ppc64le': (273, 274),
+    's390x': (282, 283),
+}
+
+
+class TokenBucket:
+    # Begrenzt den Durchsatz aller Threads gemeinsam auf rate Bytes pro Sekunde (0 = unbegrenzt)
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._allowance = 0
+        self._last = time.monotonic()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+
+    def consume(self, amount):
+        if not amount:
+            return
+        with self._lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            # Höchstens eine Sekunde Guthaben, damit nach Pausen kein großer Burst entsteht
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate) - amount
+            self._last = now
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _ThrottledFile:
+    # Leitet Zugriffe an fileobj weiter und rechnet gelesene bzw. geschriebene Bytes ab
+    def __init__(self, fileobj, governor):
+        self.fileobj = fileobj
+        self.governor = governor
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.governor.read(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = self.fileobj.readinto(buffer)
+        self.governor.read(count or 0)
+        return count
+
+    def write(self, data):
+        self.governor.write(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class ResourceGovernor:
+    # Gemeinsame Lese- und Schreiblimits (Bytes/s, 0 = unbegrenzt) für Backup und Restore.
+    # Im adaptiven Modus werden beide Raten halbiert, solange Systemlast oder Plattenlatenz
+    # zu hoch sind, und danach schrittweise bis zum konfigurierten Limit wieder angehoben.
+    def __init__(self, read_limit=0, write_limit=0, adaptive=False):
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.adaptive = adaptive
+        self._read_bucket = TokenBucket(read_limit)
+        self._write_bucket = TokenBucket(write_limit)
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self._transferred = 0
+        self._disk_sample = _read_disk_stats()
+        # Ohne festes Limit dient der zuletzt gemessene Durchsatz als Ausgangswert
+        self._baseline = 0
+
+    @property
+    def active(self):
+        return bool(self.read_limit or self.write_limit or self.adaptive)
+
+    def read(self, amount):
+        self._account(amount)
+        self._read_bucket.consume(amount)
+
+    def write(self, amount):
+        self._account(amount)
+        self._write_bucket.consume(amount)
+
+    def reader(self, fileobj):
+        return _ThrottledFile(fileobj, self) if self.active else fileobj
+
+    def writer(self, fileobj):
+        return _ThrottledFile(fileobj, self) if self.active else fileobj
+
+    def rsync_bwlimit(self):
+        # rsync kennt nur ein Limit in KiB/s; das strengere der beiden aktuellen Raten
+        rates = [rate for rate in (self._read_bucket.rate, self._write_bucket.rate) if rate]
+        if not rates:
+            return None
+        return max(1, min(rates) // 1024)
+
+    def _account(self, amount):
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._transferred += amount
+            now = time.monotonic()
+            elapsed = now - self._last_check
+            if elapsed < ADAPT_INTERVAL:
+                return
+            throughput = self._transferred / elapsed
+            self._transferred = 0
+            self._last_check = now
+            sample = _read_disk_stats()
+            latency = _disk_latency_ms(self._disk_sample, sample)
+            self._disk_sample = sample
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load > MAX_LOAD_PER_CPU or latency > MAX_DISK_LATENCY_MS:
+                self._back_off(throughput, load, latency)
+            else:
+                self._recover()
+
+    def _back_off(self, throughput, load, latency):
+        for bucket in (self._read_bucket, self._write_bucket):
+            current = bucket.rate or max(throughput, MIN_RATE)
+            if not bucket.rate and not self._baseline:
+                self._baseline = current
+            bucket.set_rate(max(MIN_RATE, int(current / 2)))
+        logging.info(f'Drosselung: Last {load:.2f} pro CPU, Plattenlatenz {latency:.0f} ms, '
+                     f'Lesen {self._read_bucket.rate // 1024} KiB/s, Schreiben {self._write_bucket.rate // 1024} KiB/s')
+
+    def _recover(self):
+        for bucket, limit in ((self._read_bucket, self.read_limit), (self._write_bucket, self.write_limit)):
+            if not bucket.rate or bucket.rate == limit:
+                continue
+            rate = int(bucket.rate * 1.25)
+            ceiling = limit or self._baseline
+            # Ohne festes Limit wird die Drosselung ganz aufgehoben, sobald der Ausgangswert erreicht ist
+            bucket.set_rate(limit if rate >= ceiling else rate)
+        if not self._read_bucket.rate and not self._write_bucket.rate:
+            self._baseline = 0
+
+
+def _read_disk_stats():
+    # Summe über alle Blockgeräte: (abgeschlossene I/Os, Millisekunden für Lesen und Schreiben)
+    ios = 0
+    ticks = 0
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 11 or fields[2].startswith(('loop', 'ram')):
+                    continue
+                ios += int(fields[3]) + int(fields[7])
+                ticks += int(fields[6]) + int(fields[10])
+    except OSError:
+        pass
+    return ios, ticks
+
+
+def _disk_latency_ms(before, after):
+    ios = after[0] - before[0]
+    if ios <= 0:
+        return 0
+    return (after[1] - before[1]) / ios
+
+
+def _ioprio_syscalls():
+    return _IOPRIO_SYSCALLS.get(os.uname().machine)
+
+
+def _syscall(*args):
+    # ctypes wird erst bei Bedarf geladen, da es den Start jedes Laufs spürbar verlängert.
+    # Gibt (Rückgabewert, errno) zurück.
+    import ctypes
+    result = ctypes.CDLL(None, use_errno=True).syscall(*args)
+    return result, ctypes.get_errno()
+
+
+def get_io_priority():
+    syscalls = _ioprio_syscalls()
+    if syscalls is None:
+        return None
+    value, _ = _syscall(syscalls[1], _IOPRIO_WHO_PROCESS, 0)
+    return None if value < 0 else value
+
+
+def set_io_priority(io_class, level=4):
+    # Wirkt auf den aufrufenden Thread; danach gestartete Threads und Prozesse (rsync) erben die Priorität
+    syscalls = _ioprio_syscalls()
+    if syscalls is None:
+        logging.warning(f'I/O-Priorität wird auf {os.uname().machine} nicht unterstützt.')
+        return False
+    if isinstance(io_class, str):
+        io_class = IO_CLASSES[io_class]
+    value = (io_class << _IOPRIO_CLASS_SHIFT) | (level if io_class in (1, 2) else 0)
+    result, error = _syscall(syscalls[0], _IOPRIO_WHO_PROCESS, 0, value)
+    if result < 0:
+        logging.warning(f'I/O-Priorität konnte nicht gesetzt werden: {os.strerror(error)}')
+        return False
+    return True
+
+
+@contextmanager
+def lowered_priority(nice_level=0, io_class='', io_level=4):
+    # Senkt CPU- und I/O-Priorität für die Dauer des Blocks. Unter Linux gelten beide pro Thread und
+    # werden an neu gestartete Threads und Kindprozesse vererbt, daher vor dem Start der Pools aufrufen.
+    previous_nice = None
+    previous_io = None
+    try:
+        if nice_level:
+            previous_nice = os.getpriority(os.PRIO_PROCESS, 0)
+            os.setpriority(os.PRIO_PROCESS, 0, max(previous_nice, min(19, nice_level)))
+        if io_class:
+            previous_io = get_io_priority()
+            set_io_priority(io_class, io_level)
+        yield
+    finally:
+        if previous_nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, previous_nice)
+            except PermissionError:
+                # Ohne Root-Rechte lässt sich die Priorität nicht wieder anheben
+                pass
+        if previous_io is not None:
+            set_io_priority(previous_io >> _IOPRIO_CLASS_SHIFT, previous_io & 0xFF)